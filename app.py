@@ -1,15 +1,46 @@
 import json
-from flask import Flask, Response, request, redirect, url_for, render_template
-from utils import get_trains, get_seat_availability, fetch_stations
+from flask import Flask, Response, g, request, redirect, url_for, render_template, stream_with_context
+from utils import get_trains, get_journeys, iter_trains_range, resolve_stations, get_seat_availability, stream_seat_availability, stream_seat_counts, fetch_stations, cache_stats, circuit_stats, current_user, upstream_limiter
+from utils.layouts import layout_store
+from utils.metrics import HTTP_REQUEST_SECONDS, Timings, current_timings, render_metrics, span
+from utils.models import DATETIME_FORMAT, Train, encode_json
+from utils.deadline import deadline_scope
+from utils.prefetch import PREFETCH, prefetcher
+from utils.seatmap import count_seats, seats_to_dict
+from utils.sessions import SearchSession, create_session, get_session, save_session
+from utils.watch import parse_seat_types, watch_scheduler
 from requests.exceptions import ConnectionError
 from datetime import datetime
+from typing import Iterator
+import gzip
+import queue
 import webbrowser
 import threading
-import ast
+import os
+import time
 
 
 app = Flask(__name__)
 
+# Seat transfer search mode: "binary" probes spans of the route, "segments" fetches every pair of adjacent stations once
+app.config["TRANSFER_MODE"] = os.environ.get("TRICKYTRAIN_TRANSFER_MODE", "binary")
+
+# Render the seats page immediately and stream the seats to the browser as they are found
+app.config["STREAM_SEATS"] = os.environ.get("TRICKYTRAIN_STREAM_SEATS", "1") == "1"
+
+# Add the time spent in each stage of the request to the response as a Server-Timing header
+app.config["SERVER_TIMING"] = os.environ.get("TRICKYTRAIN_SERVER_TIMING", "0") == "1"
+
+# Compress the pages, seat maps and JSON responses with gzip for clients which accept it
+app.config["COMPRESS_RESPONSES"] = os.environ.get("TRICKYTRAIN_COMPRESS_RESPONSES", "1") == "1"
+
+# Content types compressed with gzip and the minimum size of a compressed response in bytes
+COMPRESSED_TYPES = {"text/html", "image/svg+xml", "application/json", "text/plain", "text/css", "application/javascript", "text/javascript"}
+COMPRESS_MIN_SIZE = 1024
+
+# Time (in seconds) for which browsers keep a carriage layout, the layouts are addressed by the hash of their content and never change
+LAYOUT_MAX_AGE = 365 * 24 * 3600
+
 
 # Open the default web browser with the application URL
 def open_browser() -> None:
@@ -18,9 +49,9 @@ def open_browser() -> None:
 
 # Custom Jinja2 filter for formatting datetime objects in templates
 @app.template_filter('format_datetime')
-def format_datetime(value: str, format: str ='%H:%M %d:%m:%Y') -> str:
+def format_datetime(value: datetime | str, format: str ='%H:%M %d:%m:%Y') -> str:
     if isinstance(value, str):  
-        value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")  
+        value = datetime.strptime(value, DATETIME_FORMAT)  
     return value.strftime(format)
 
 
@@ -36,13 +67,63 @@ def format_duration(minutes: int) -> str:
 
 # Custom Jinja2 filter for calculating duration between two datetime timestamps
 @app.template_filter('calculate_duration')
-def calculate_duration(departure: str, arrival: str) -> str:
-    departure = datetime.strptime(departure, "%Y-%m-%d %H:%M:%S")
-    arrival = datetime.strptime(arrival, "%Y-%m-%d %H:%M:%S")
+def calculate_duration(departure: datetime, arrival: datetime) -> str:
     minutes = int((arrival - departure).total_seconds() // 60)
     return format_duration(minutes)
 
 
+# Tag upstream calls with the client address, so queued calls are served fairly across users
+@app.before_request
+def set_current_user() -> None:
+    current_user.set(request.remote_addr or "")
+
+
+# Start measuring the request and, if enabled, collecting the time spent in its stages
+@app.before_request
+def start_timings() -> None:
+    g.started = time.perf_counter()
+    if app.config["SERVER_TIMING"]:
+        current_timings.set(Timings())
+
+
+# Record the duration of the request and add the timing breakdown to the response.
+# Streamed responses are measured until the headers are sent, their body is still being produced.
+@app.after_request
+def finish_timings(response: Response) -> Response:
+    elapsed = time.perf_counter() - g.started
+    HTTP_REQUEST_SECONDS.observe(elapsed, request.url_rule.rule if request.url_rule else "unknown", str(response.status_code))
+
+    timings = current_timings.get()
+    if timings is not None:
+        breakdown = timings.server_timing()
+        response.headers["Server-Timing"] = f"{breakdown + ', ' if breakdown else ''}total;dur={elapsed * 1000:.1f}"
+    return response
+
+
+# Compress complete responses of the compressible types with gzip, streamed responses are sent as they are produced.
+# The ETag of a compressed response gets a "-gzip" suffix, so the compressed and the plain body have different tags.
+@app.after_request
+def compress_response(response: Response) -> Response:
+    if not app.config["COMPRESS_RESPONSES"] or response.is_streamed or response.direct_passthrough:
+        return response
+    if response.status_code != 200 or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSED_TYPES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if "gzip" not in request.accept_encodings:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(gzip.compress(body, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-gzip", weak)
+    return response
+
+
 # Route for the main page
 @app.route('/', methods=['GET'])
 def main():
@@ -58,9 +139,21 @@ def trains():
             input_time = request.form["time"]
             departure_station = request.form["from"]
             arrival_station = request.form["to"]
+            # Optional end of a search over several days
+            end_date = request.form.get("date_to") or None
+            end_time = request.form.get("time_to") or None
             try:
-                data, stations = get_trains(departure_station, arrival_station, input_date, input_time)
-                return render_template('trains.html', data=data, stations=stations)
+                with deadline_scope():
+                    data, stations = get_trains(departure_station, arrival_station, input_date, input_time, end_date, end_time)
+
+                # Keep the search results on the server, the page only passes their key and the index of the train
+                search = create_session(stations, data) if isinstance(data, list) else None
+                if PREFETCH and search is not None:
+                    prefetcher.submit(data, stations)
+                query = {key: request.form[key] for key in ("from", "to", "date", "time")}
+                multi_day = isinstance(data, list) and len({train.departure.date() for train in data}) > 1
+                with span("render_template"):
+                    return render_template('trains.html', data=data, stations=stations, search=search, query=query, multi_day=multi_day)
             except ConnectionError as e:
                 print(e)
                 return render_template('trains.html', data={"error": f"Sprawdź połączenie z Internetem i spróbuj ponownie: {str(e)}"})
@@ -70,32 +163,391 @@ def trains():
     return redirect(url_for('main'))
 
 
+# Route for the journeys with changes of trains
+@app.route('/journeys', methods=['GET', 'POST'])
+def journeys():
+    if request.method == 'POST':
+        if all(key in request.form for key in ("from", "to", "date", "time")):
+            try:
+                with deadline_scope():
+                    data, stations = get_journeys(request.form["from"], request.form["to"], request.form["date"], request.form["time"])
+                with span("render_template"):
+                    return render_template('journeys.html', data=data, stations=stations)
+            except ConnectionError as e:
+                print(e)
+                return render_template('journeys.html', data={"error": f"Sprawdź połączenie z Internetem i spróbuj ponownie: {str(e)}"})
+            except Exception as e:
+                print(e)
+                return render_template('journeys.html', data={"error": str(e)})
+    return redirect(url_for('main'))
+
+
+# Route streaming the trains of a search over several days as newline-delimited JSON events in chronological order.
+# The first event holds the key of the search session, the trains are added to it as they are streamed.
+@app.route('/trains/stream', methods=['POST'])
+def trains_stream():
+    if not all(key in request.form for key in ("from", "to", "date", "time", "date_to")):
+        return Response(status=400)
+
+    def error(message: str) -> Response:
+        return Response(json.dumps({"type": "error", "message": message}, ensure_ascii=False) + "\n", status=400, content_type="application/x-ndjson; charset=utf-8")
+
+    try:
+        stations = resolve_stations(request.form["from"], request.form["to"])
+    except Exception as e:
+        print(e)
+        return error(str(e))
+    if "error" in stations:
+        return error(stations["error"])
+
+    key = create_session(stations, [])
+    search = get_session(key)
+    trains = iter_trains_range(stations, request.form["date"], request.form["time"], request.form["date_to"], request.form.get("time_to") or "23:59")
+
+    def generate():
+        yield json.dumps({"type": "search", "search": key}) + "\n"
+        try:
+            for train in trains:
+                search.trains.append(train)
+                save_session(key, search)
+                yield json.dumps({"type": "train", "index": len(search.trains) - 1, "train": train.to_dict()}, ensure_ascii=False) + "\n"
+            if PREFETCH:
+                prefetcher.submit(search.trains, stations)
+            yield json.dumps({"type": "done", "count": len(search.trains)}) + "\n"
+        except Exception as e:
+            print(e)
+            yield json.dumps({"type": "error", "message": str(e)}, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), content_type="application/x-ndjson; charset=utf-8")
+
+
+# Message shown when the search results of the page are no longer kept on the server
+SEARCH_EXPIRED = "Wyniki wyszukiwania wygasły, wyszukaj połączenia ponownie"
+
+
+# Get the search session and the selected train from the form, returns None if the session expired or the train is unknown
+def selected_train(form: dict) -> tuple[SearchSession, int, Train] | None:
+    if not form.get("index", "").isdigit():
+        return None
+    index = int(form["index"])
+    search = get_session(form.get("search"), index)
+    if search is None:
+        return None
+    train = search.train(index)
+    if train is None:
+        return None
+    return search, index, train
+
+
 # Route for the seats page
 @app.route('/seats', methods=['GET', 'POST'])
 def seats():
     if request.method == 'POST':
-        if "row" in request.form and "stations" in request.form:
-            train = request.form["row"]
-            stations = request.form["stations"]
+        if "search" in request.form and "index" in request.form:
+            selected = selected_train(request.form)
+            if selected is None:
+                return render_template('seats.html', data={"error": SEARCH_EXPIRED})
+            search, index, train = selected
+            stations = search.stations
 
-            # Convert string representation of dictionaries into actual Python dictionaries
-            train = ast.literal_eval(train)
-            stations = ast.literal_eval(stations)
+            # Render the page without seats, the browser fetches them from /seats/stream
+            if app.config["STREAM_SEATS"]:
+                return render_template('seats.html', data={"status": "streaming"}, train=train, stations=stations, search=request.form["search"], index=index)
 
             try:
-                data = get_seat_availability(train, stations)
+                with deadline_scope():
+                    data = get_seat_availability(train, stations, app.config["TRANSFER_MODE"], train_info=search.train_details.get(index))
             except ConnectionError as e:
                 print(e)
                 return render_template('seats.html', data={"error": f"Sprawdź połączenie z Internetem i spróbuj ponownie: {str(e)}"})
             except Exception  as e:
                 print(e)
                 return render_template('seats.html', data={"error": str(e)})
-            data["departure_datetime"] = datetime.strptime(data["departure_datetime"], "%Y-%m-%d %H:%M:%S")
-            data["arrival_datetime"] = datetime.strptime(data["arrival_datetime"], "%Y-%m-%d %H:%M:%S")
-            return render_template('seats.html', data=data, stations=stations)
+            data["available_seats"] = seats_to_dict(data["available_seats"])
+            with span("render_template"):
+                return render_template('seats.html', data=data, train=train, stations=stations, search=request.form["search"], index=index)
     return redirect(url_for('main'))
 
 
+# Response of the streaming routes when the search results are no longer kept on the server
+def search_expired_stream() -> Response:
+    return Response(json.dumps({"type": "error", "message": SEARCH_EXPIRED}, ensure_ascii=False) + "\n", status=410, content_type="application/x-ndjson; charset=utf-8")
+
+
+# Route streaming the seats of a train as newline-delimited JSON events
+@app.route('/seats/stream', methods=['POST'])
+def seats_stream():
+    if "search" not in request.form or "index" not in request.form:
+        return Response(status=400)
+
+    selected = selected_train(request.form)
+    if selected is None:
+        return search_expired_stream()
+    search, index, train = selected
+
+    def generate():
+        for event in stream_seat_availability(train, search.stations, app.config["TRANSFER_MODE"], search.train_details.get(index)):
+            yield json.dumps(event, ensure_ascii=False, default=encode_json) + "\n"
+
+    return Response(stream_with_context(generate()), content_type="application/x-ndjson; charset=utf-8")
+
+
+# Route streaming the number of direct seats of every listed train as newline-delimited JSON events
+@app.route('/trains/seat_counts', methods=['POST'])
+def trains_seat_counts():
+    if "search" not in request.form:
+        return Response(status=400)
+
+    key = request.form["search"]
+    search = get_session(key)
+    if search is None:
+        return search_expired_stream()
+
+    # Keep the fetched train details in the session for the seats page, which may be served by another worker process
+    def keep_details(index: int, details: dict) -> None:
+        search.train_details[index] = details
+        save_session(key, search)
+
+    def generate():
+        for event in stream_seat_counts(search.trains, search.stations, keep_details):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), content_type="application/x-ndjson; charset=utf-8")
+
+
+# Fields of the trains and seat results of the JSON API, the layouts (templates of the carriage seat maps) are only sent on request
+API_TRAIN_FIELDS = ("train_name", "train_number", "train_category", "travel_time", "departure_datetime", "arrival_datetime")
+API_SEAT_FIELDS = ("train_name", "train_number", "train_category", "departure_datetime", "arrival_datetime", "status", "seat_count", "stations", "available_seats", "carrige_svgs", "links", "layouts")
+API_SEAT_DEFAULT_FIELDS = tuple(field for field in API_SEAT_FIELDS if field != "layouts")
+
+# Keys of the seat stream events which are always sent, the other keys are filtered by the requested fields
+API_EVENT_KEYS = {"type", "index", "carriage_number", "status", "message", "count", "departure_station", "arrival_station", "link"}
+
+
+# Encode a value of the JSON API, without whitespace and with the seats encoded as dictionaries
+def api_dumps(value: object) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=encode_json)
+
+
+# JSON response of the API
+def api_response(value: object, status: int = 200) -> Response:
+    return Response(api_dumps(value), status=status, content_type="application/json; charset=utf-8")
+
+
+# Newline-delimited JSON response of the API streaming the events as they are produced
+def api_stream(events: Iterator[dict]) -> Response:
+    return Response(stream_with_context(api_dumps(event) + "\n" for event in events), content_type="application/x-ndjson; charset=utf-8")
+
+
+# Fields requested with the comma-separated "fields" parameter, the default fields when it is not given
+def api_fields(allowed: tuple[str, ...], default: tuple[str, ...]) -> tuple[str, ...]:
+    if not request.args.get("fields"):
+        return default
+    fields = tuple(field.strip() for field in request.args["fields"].split(",") if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Nieznane pola: {', '.join(unknown)}. Dostępne pola: {', '.join(allowed)}")
+    return fields
+
+
+# Number of available seats of a seat result, a list with the count of every leg for seat transfers.
+# A result which timed out while checking the direct connection holds its carriages like a result with the same seat.
+def result_seat_count(data: dict) -> int | list[int]:
+    if data["status"] == "no_seats":
+        return 0
+    if isinstance(data["available_seats"], dict):
+        return count_seats(data["available_seats"])
+    return [count_seats(seats) for seats in data["available_seats"]]
+
+
+# Templates of the carriage layouts used by a seat result, keyed by the layout id
+def result_layouts(data: dict) -> dict[str, str]:
+    layout_maps = data["carrige_svgs"] if isinstance(data["carrige_svgs"], list) else [data["carrige_svgs"]]
+    layout_ids = {layout_id for layout_map in layout_maps for layout_id in layout_map.values()}
+    return {layout_id: template for layout_id in sorted(layout_ids) if (template := layout_store.get(layout_id)) is not None}
+
+
+# Route for the trains between two stations as JSON: from, to, date and optionally time, date_to, time_to and fields.
+# With stream=1 the trains are streamed as newline-delimited JSON events as the days of the search are fetched.
+@app.route('/api/trains', methods=['GET'])
+def api_trains():
+    args = request.args
+    if not all(args.get(key) for key in ("from", "to", "date")):
+        return api_response({"error": "Podaj stację początkową (from), stację końcową (to) i datę (date)"}, 400)
+    try:
+        fields = api_fields(API_TRAIN_FIELDS, API_TRAIN_FIELDS)
+    except ValueError as e:
+        return api_response({"error": str(e)}, 400)
+
+    if args.get("stream") == "1":
+        try:
+            stations = resolve_stations(args["from"], args["to"])
+        except Exception as e:
+            print(e)
+            return api_response({"error": str(e)}, 502)
+        if "error" in stations:
+            return api_response(stations, 400)
+
+        key = create_session(stations, [])
+        search = get_session(key)
+        trains = iter_trains_range(stations, args["date"], args.get("time") or "00:00", args.get("date_to") or args["date"], args.get("time_to") or "23:59")
+
+        def events() -> Iterator[dict]:
+            yield {"type": "search", "search": key, "stations": stations}
+            try:
+                for train in trains:
+                    search.trains.append(train)
+                    save_session(key, search)
+                    yield {"type": "train", "index": len(search.trains) - 1, "train": {field: getattr(train, field) for field in fields}}
+                yield {"type": "done", "count": len(search.trains)}
+            except Exception as e:
+                print(e)
+                yield {"type": "error", "message": str(e)}
+
+        return api_stream(events())
+
+    try:
+        with deadline_scope():
+            data, stations = get_trains(args["from"], args["to"], args["date"], args.get("time") or "00:00", args.get("date_to"), args.get("time_to"))
+    except Exception as e:
+        print(e)
+        return api_response({"error": str(e)}, 502)
+    if isinstance(data, dict):
+        # Unknown stations leave the stations empty, a search without trains returns them
+        return api_response(data, 404 if stations else 400)
+
+    key = create_session(stations, data)
+    return api_response({"search": key, "stations": stations, "trains": [{"index": index, **{field: getattr(train, field) for field in fields}} for index, train in enumerate(data)]})
+
+
+# Route for the seats of a train of a search as JSON: search, index and optionally fields, e.g. fields=status,seat_count for counts only.
+# With stream=1 the carriages and seat transfer legs are streamed as newline-delimited JSON events as they are found.
+@app.route('/api/seats', methods=['GET'])
+def api_seats():
+    if not request.args.get("search") or not request.args.get("index"):
+        return api_response({"error": "Podaj klucz wyszukiwania (search) i numer pociągu na liście (index)"}, 400)
+    try:
+        fields = api_fields(API_SEAT_FIELDS, API_SEAT_DEFAULT_FIELDS)
+    except ValueError as e:
+        return api_response({"error": str(e)}, 400)
+
+    selected = selected_train(request.args)
+    if selected is None:
+        return api_response({"error": SEARCH_EXPIRED}, 410)
+    search, index, train = selected
+
+    if request.args.get("stream") == "1":
+        def events() -> Iterator[dict]:
+            for event in stream_seat_availability(train, search.stations, app.config["TRANSFER_MODE"], search.train_details.get(index)):
+                if "available_seats" in event and "seat_count" in fields:
+                    event["seat_count"] = len(event["available_seats"]) if event["type"] == "carriage" else count_seats(event["available_seats"])
+                if event["type"] == "carriage":
+                    event["carrige_svgs"] = event.pop("svg")
+                yield {key: value for key, value in event.items() if key in API_EVENT_KEYS or key in fields}
+
+        return api_stream(events())
+
+    try:
+        with deadline_scope():
+            data = get_seat_availability(train, search.stations, app.config["TRANSFER_MODE"], train_info=search.train_details.get(index))
+    except Exception as e:
+        print(e)
+        return api_response({"error": str(e)}, 502)
+    if "seat_count" in fields:
+        data["seat_count"] = result_seat_count(data)
+    if "layouts" in fields:
+        data["layouts"] = result_layouts(data)
+    return api_response({field: data.get(field) for field in fields})
+
+
+# Seconds between keep-alive comments of the watch event streams
+WATCH_KEEPALIVE = 15
+
+# Number of worker processes serving the application, set by serve.py
+WORKER_PROCESSES = int(os.environ.get("TRICKYTRAIN_WORKER_PROCESSES", "1"))
+WATCHES_UNAVAILABLE = "Obserwowanie miejsc jest dostępne tylko na serwerze z jednym procesem (--workers 1)"
+app.jinja_env.globals["watches_enabled"] = WORKER_PROCESSES == 1
+
+
+# Route registering a watch of the seats of a train from the search results, the changes are sent to the webhook or the event stream of the watch
+@app.route('/watches', methods=['POST'])
+def create_watch():
+    if "search" not in request.form or "index" not in request.form:
+        return Response(status=400)
+
+    selected = selected_train(request.form)
+    if selected is None:
+        return Response(json.dumps({"error": SEARCH_EXPIRED}, ensure_ascii=False), status=410, content_type="application/json; charset=utf-8")
+    search, index, train = selected
+
+    # Watches are kept in the memory of the worker process, the polls and event streams of a watch need the same process
+    if WORKER_PROCESSES > 1:
+        return Response(json.dumps({"error": WATCHES_UNAVAILABLE}, ensure_ascii=False), status=503, content_type="application/json; charset=utf-8")
+
+    webhook = request.form.get("webhook") or None
+    try:
+        watch = watch_scheduler.add(train, search.stations, parse_seat_types(request.form.get("seat_types")), webhook, request.remote_addr or "")
+    except ValueError as e:
+        return Response(json.dumps({"error": str(e)}, ensure_ascii=False), status=400, content_type="application/json; charset=utf-8")
+
+    body = {"watch": watch.id, "events": url_for("watch_events", watch_id=watch.id)}
+    return Response(json.dumps(body), status=201, content_type="application/json; charset=utf-8")
+
+
+# Route stopping a watch
+@app.route('/watches/<watch_id>', methods=['DELETE'])
+def delete_watch(watch_id: str):
+    return Response(status=204 if watch_scheduler.remove(watch_id) else 404)
+
+
+# Route streaming the changes of the seats of a watch as server-sent events
+@app.route('/watches/<watch_id>/events', methods=['GET'])
+def watch_events(watch_id: str):
+    subscriber = watch_scheduler.subscribe(watch_id)
+    if subscriber is None:
+        return Response(status=404)
+
+    def generate():
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=WATCH_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                if event["type"] == "closed":
+                    return
+        finally:
+            watch_scheduler.unsubscribe(watch_id, subscriber)
+
+    return Response(generate(), content_type="text/event-stream; charset=utf-8", headers={"Cache-Control": "no-cache"})
+
+
+# Route for the number of watches and the upstream calls of their polls
+@app.route('/stats/watches', methods=['GET'])
+def stats_watches():
+    return Response(json.dumps(watch_scheduler.stats()), content_type="application/json; charset=utf-8")
+
+
+# Route for the template of a carriage layout, addressed by the hash of its content.
+# The page loads the layouts of the carriages when the seat maps are shown and marks the available seats on them.
+@app.route('/layouts/<layout_id>.svg', methods=['GET'])
+def layout(layout_id: str):
+    if request.if_none_match.contains(layout_id) or request.if_none_match.contains(f"{layout_id}-gzip"):
+        response = Response(status=304)
+        response.set_etag(layout_id)
+    else:
+        template = layout_store.get(layout_id)
+        if template is None:
+            return Response(status=404)
+        response = Response(template, content_type="image/svg+xml; charset=utf-8")
+        response.set_etag(layout_id)
+    response.headers["Cache-Control"] = f"public, max-age={LAYOUT_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 # Route for the list of stations
 @app.route('/stations', methods=['GET'])
 def stations():
@@ -106,6 +558,37 @@ def stations():
     return Response(response_json, content_type="application/json; charset=utf-8")
 
 
+# Route for the hit and miss counters of the API caches
+@app.route('/stats/cache', methods=['GET'])
+def stats_cache():
+    return Response(json.dumps(cache_stats()), content_type="application/json; charset=utf-8")
+
+
+# Route for the current limit and queue depth of the upstream limiter
+@app.route('/stats/limiter', methods=['GET'])
+def stats_limiter():
+    return Response(json.dumps(upstream_limiter.stats()), content_type="application/json; charset=utf-8")
+
+
+# Route for the counters of the prefetching of the first trains of searches
+@app.route('/stats/prefetch', methods=['GET'])
+def stats_prefetch():
+    return Response(json.dumps(prefetcher.stats()), content_type="application/json; charset=utf-8")
+
+
+# Route for the state of the circuit breakers of the upstream endpoints
+@app.route('/stats/circuits', methods=['GET'])
+def stats_circuits():
+    return Response(json.dumps(circuit_stats()), content_type="application/json; charset=utf-8")
+
+
+
+# Route for the metrics of the upstream calls, pipeline stages, caches and limiter in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 if __name__ == "__main__":
     threading.Timer(1.5, open_browser).start()
     app.run(debug=False)
\ No newline at end of file
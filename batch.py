@@ -0,0 +1,122 @@
+import argparse
+import concurrent.futures
+import contextlib
+import contextvars
+import json
+import sys
+import time
+
+
+# Check the seats of the trains of one query, returns the result line for it.
+# The train search and the seat check of every train each get the timeout, a train which does not finish in time is reported as timed out.
+def run_query(query: dict, transfer_mode: str, max_trains: int, timeout: float) -> dict:
+    from utils import get_trains, get_seat_availability
+    from utils.deadline import deadline_scope
+    from utils.seatmap import count_seats
+
+    started = time.perf_counter()
+    missing = [key for key in ("from", "to", "date") if not query.get(key)]
+    if missing:
+        return {"query": query, "error": f"Brak pól zapytania: {', '.join(missing)}"}
+
+    try:
+        with deadline_scope(timeout):
+            trains, stations = get_trains(query["from"], query["to"], query["date"], query.get("time") or "00:00", query.get("date_to"), query.get("time_to"))
+    except Exception as e:
+        return {"query": query, "error": str(e), "seconds": round(time.perf_counter() - started, 3)}
+    if isinstance(trains, dict):
+        return {"query": query, "error": trains.get("error"), "seconds": round(time.perf_counter() - started, 3)}
+
+    if query.get("train"):
+        trains = [train for train in trains if str(train.train_number) == str(query["train"])]
+    if max_trains:
+        trains = trains[:max_trains]
+
+    results = []
+    for train in trains:
+        try:
+            with deadline_scope(timeout):
+                data = get_seat_availability(train, stations, transfer_mode)
+        except Exception as e:
+            results.append({**train.to_dict(), "status": "error", "error": str(e)})
+            continue
+        data.pop("carrige_svgs", None)
+        if data["status"] == "same_seat":
+            data["seat_count"] = count_seats(data["available_seats"])
+        results.append(data)
+
+    return {"query": query, "trains": results, "seconds": round(time.perf_counter() - started, 3)}
+
+
+# Read the queries, one JSON object per line, empty lines and lines starting with # are skipped
+def read_queries(lines: list[str]) -> list[dict]:
+    queries = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            query = json.loads(line)
+        except ValueError as e:
+            query = {"line": number, "invalid": str(e)}
+        queries.append(query if isinstance(query, dict) else {"line": number, "invalid": "Zapytanie nie jest obiektem JSON"})
+    return queries
+
+
+# Headless batch mode: checks the seats of many station pairs concurrently with one shared client and cache,
+# writing one JSON result per line as soon as each query finishes and a summary to stderr at the end
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check the seats of many TrickyTrain queries and write the results as JSON lines")
+    parser.add_argument("input", nargs="?", default="-", help="file with one JSON query per line, e.g. {\"from\": \"Gdynia Główna\", \"to\": \"Kraków Główny\", \"date\": \"2025-06-01\", \"time\": \"08:00\"}; - for stdin")
+    parser.add_argument("--output", default="-", help="file for the results, - for stdout")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of queries checked at once")
+    parser.add_argument("--transfer-mode", choices=("binary", "segments"), default="binary", help="search for seat transfers by bisecting the route or checking every segment")
+    parser.add_argument("--trains", type=int, default=0, help="maximum number of trains checked per query, 0 for all")
+    parser.add_argument("--timeout", type=float, help="seconds for the train search and for the seat check of each train, TRICKYTRAIN_REQUEST_TIMEOUT by default")
+    args = parser.parse_args()
+
+    from utils import cache_stats, current_user, upstream_limiter
+    from utils.deadline import REQUEST_TIMEOUT
+    from utils.metrics import UPSTREAM_REQUEST_SECONDS
+    from utils.models import encode_json
+    timeout = args.timeout or REQUEST_TIMEOUT
+
+    with (sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")) as source:
+        queries = read_queries(source.readlines())
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+
+    # Every query is a separate user of the limiter, so a query with many trains does not hold back the others
+    def submit(executor: concurrent.futures.Executor, index: int, query: dict) -> concurrent.futures.Future:
+        context = contextvars.copy_context()
+        context.run(current_user.set, f"batch-{index}")
+        if "invalid" in query:
+            return executor.submit(lambda: {"query": query, "error": f"Niepoprawne zapytanie w linii {query['line']}: {query['invalid']}"})
+        return executor.submit(context.run, run_query, query, args.transfer_mode, args.trains, timeout)
+
+    started = time.perf_counter()
+    # Every request sent to the API is observed with its status, also the failed and cancelled ones
+    calls_before = UPSTREAM_REQUEST_SECONDS.count()
+    overloads_before = upstream_limiter.stats()["overloads"]
+    trains = errors = 0
+    # The search prints its diagnostics, keep them out of the results while the queries run
+    with contextlib.redirect_stdout(sys.stderr), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        futures = [submit(executor, index, query) for index, query in enumerate(queries)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            trains += len(result.get("trains", []))
+            errors += "error" in result
+            output.write(json.dumps(result, ensure_ascii=False, default=encode_json) + "\n")
+            output.flush()
+    if args.output != "-":
+        output.close()
+
+    seconds = time.perf_counter() - started
+    calls = UPSTREAM_REQUEST_SECONDS.count() - calls_before
+    overloads = upstream_limiter.stats()["overloads"] - overloads_before
+    hits = sum(stats["hits"] + stats["shared_hits"] for stats in cache_stats().values())
+    print(f"{len(queries)} zapytań ({errors} błędów), {trains} pociągów w {seconds:.1f} s ({len(queries) / max(seconds, 1e-9):.2f} zapytań/s), "
+          f"{calls} zapytań do API PKP Intercity ({overloads} przeciążeń), {hits} trafień w cache", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_intercity import FIXTURE_PATH, MockIntercity, MockServer
+
+
+# Scenarios over the trains of the fixture timetable: name, departure station, arrival station and train number
+SCENARIOS = [
+    ("direct_seat", "Gdynia Główna", "Kraków Główny", "1001"),
+    ("short_transfer", "Gdynia Główna", "Kraków Główny", "2002"),
+    ("long_transfer", "Gdynia Główna", "Kraków Główny", "3003"),
+    ("no_seats", "Gdynia Główna", "Kraków Główny", "4004"),
+]
+
+
+# Value at the given percentile of the samples, nearest rank
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+# Search the train and its seats like the application does after the user picks it from the trains list
+def run_scenario(departure: str, arrival: str, train_number: str, transfer_mode: str) -> str:
+    from utils import get_trains, get_seat_availability
+
+    trains, stations = get_trains(departure, arrival, (date.today() + timedelta(days=1)).isoformat(), "00:00")
+    if isinstance(trains, dict):
+        raise ValueError(trains["error"])
+    train = next(train for train in trains if train.train_number == train_number)
+    return get_seat_availability(train, stations, transfer_mode)["status"]
+
+
+# Run every scenario against the mock server and print wall times and upstream calls
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the seat search against the offline mock of the PKP Intercity APIs")
+    parser.add_argument("--fixture", default=FIXTURE_PATH, help="JSON file with the stations and trains")
+    parser.add_argument("--runs", type=int, default=5, help="runs per scenario")
+    parser.add_argument("--transfer-mode", choices=["binary", "segments"], default="binary")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response time of the mock in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses with error 500")
+    parser.add_argument("--access-denied-rate", type=float, default=0.0, help="fraction of ACCESS DENIED responses")
+    parser.add_argument("--warm", action="store_true", help="keep the caches and the station index between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockIntercity(args.fixture, args.latency, args.error_rate, args.access_denied_rate, args.seed)
+    server = MockServer(mock).start()
+
+    # The API URLs are read on import, so utils is imported only after the mock server is up
+    os.environ["TRICKYTRAIN_API_BASE_URL"] = server.url
+    os.environ["TRICKYTRAIN_STATION_SEARCH_URL"] = f"{server.url}/station/get/"
+    from utils import station_index
+    from utils.cache import caches
+
+    print(f"{'scenario':<16} {'status':<16} {'runs':>5} {'errors':>6} {'mean s':>8} {'p50 s':>8} {'p95 s':>8} {'calls':>7} {'svg':>6}")
+    try:
+        for name, departure, arrival, train_number in SCENARIOS:
+            times, calls, svg_calls, statuses, errors = [], [], [], set(), 0
+            for _ in range(args.runs):
+                if not args.warm:
+                    for cache in caches.values():
+                        cache.clear()
+                    station_index.clear()
+                mock.reset()
+
+                started = time.perf_counter()
+                try:
+                    # Silence the progress printed by the transfer search
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        statuses.add(run_scenario(departure, arrival, train_number, args.transfer_mode))
+                except Exception as e:
+                    errors += 1
+                    statuses.add(type(e).__name__)
+                times.append(time.perf_counter() - started)
+
+                stats = mock.stats()
+                calls.append(stats["total"])
+                svg_calls.append(stats.get("wagon_svg", 0))
+
+            print(f"{name:<16} {','.join(sorted(statuses)):<16} {args.runs:>5} {errors:>6} {statistics.mean(times):>8.3f} {percentile(times, 0.5):>8.3f} {percentile(times, 0.95):>8.3f} {statistics.mean(calls):>7.1f} {statistics.mean(svg_calls):>6.1f}")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "intercity.json")
+
+ROUTE_DATETIME_FORMAT = "%a %b %d %H:%M:%S CET %Y"
+ACCESS_DENIED_PAGE = "<HTML><HEAD><TITLE>Access Denied</TITLE></HEAD><BODY><H1>Access Denied</H1></BODY></HTML>"
+
+
+# Offline replacement of the PKP Intercity APIs answering from the fixture timetable.
+# Seats are free on a span of the route only if one of the free windows of the fixture covers the whole span.
+# Latency, errors 500 and "ACCESS DENIED" pages are injected at random to reproduce the behaviour of the real API under load.
+class MockIntercity:
+    def __init__(self, fixture_path: str = FIXTURE_PATH, latency: float = 0.0, error_rate: float = 0.0, access_denied_rate: float = 0.0, seed: int | None = None) -> None:
+        with open(fixture_path, encoding="utf-8") as f:
+            fixture = json.load(f)
+
+        self.stations = fixture["stations"]
+        self.trains = {train["number"]: train for train in fixture["trains"]}
+        self.by_id1 = {station["h"]: station["n"] for station in self.stations}
+        self.by_id2 = {station["e"]: station["n"] for station in self.stations}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.access_denied_rate = access_denied_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.webhooks = []
+
+    # Forget the counted calls
+    def reset(self) -> None:
+        with self.lock:
+            self.calls.clear()
+
+    # Number of calls per endpoint and in total
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.calls, total=sum(self.calls.values()))
+
+    # Replace the free seat windows of a train, so seats can be freed or taken while the application is running
+    def set_free(self, train_number: str, free: list[list]) -> bool:
+        with self.lock:
+            train = self.trains.get(train_number)
+            if train is None:
+                return False
+            train["free"] = [list(window) for window in free]
+            return True
+
+    # Keep an event posted to the webhook stub
+    def record_webhook(self, event: dict) -> None:
+        with self.lock:
+            self.webhooks.append(event)
+
+    # Count the call, sleep for the latency (+-50%) and draw an injected failure, returns the failure response or None
+    def before_call(self, endpoint: str) -> Response | None:
+        with self.lock:
+            self.calls[endpoint] += 1
+            jitter = self.random.uniform(0.5, 1.5)
+            failure = self.random.random()
+
+        if self.latency:
+            time.sleep(self.latency * jitter)
+        if failure < self.error_rate:
+            return Response("Internal Server Error", status=500)
+        if failure < self.error_rate + self.access_denied_rate:
+            return Response(ACCESS_DENIED_PAGE, status=403, mimetype="text/html")
+        return None
+
+    # Position of the station on the route of the train, None if the train does not stop there
+    @staticmethod
+    def stop_index(train: dict, station_name: str | None) -> int | None:
+        for i, (name, _, _) in enumerate(train["stops"]):
+            if name == station_name:
+                return i
+        return None
+
+    # Datetime of the first departure of the train running through the given stop at the given time
+    @staticmethod
+    def train_start(train: dict, stop: int, stop_datetime: datetime) -> datetime:
+        return stop_datetime - timedelta(minutes=train["stops"][stop][2])
+
+    # Datetime of the first departure of the train on the given date
+    @staticmethod
+    def train_start_on(train: dict, date: str) -> datetime:
+        return datetime.strptime(f"{date} {train['departure_time']}", "%Y-%m-%d %H:%M")
+
+    # The train and the first and last stop of the span given by the station ids, None if the train does not run between them
+    def span(self, train_number: str, departure_station_id2: str, arrival_station_id2: str) -> tuple[dict, int, int] | None:
+        train = self.trains.get(train_number)
+        if train is None:
+            return None
+        first = self.stop_index(train, self.by_id2.get(departure_station_id2))
+        last = self.stop_index(train, self.by_id2.get(arrival_station_id2))
+        if first is None or last is None or first >= last:
+            return None
+        return train, first, last
+
+    # Body of the connection search: the trains running from the departure station to the arrival station on the date
+    def connections(self, payload: dict) -> dict:
+        date = payload["dataWyjazdu"].split(" ")[0]
+        departure, arrival = self.by_id1.get(payload["stacjaWyjazdu"]), self.by_id1.get(payload["stacjaPrzyjazdu"])
+
+        connections = []
+        for train in self.trains.values():
+            first, last = self.stop_index(train, departure), self.stop_index(train, arrival)
+            if first is None or last is None or first >= last:
+                continue
+            start = self.train_start_on(train, date)
+            departure_datetime = start + timedelta(minutes=train["stops"][first][2])
+            arrival_datetime = start + timedelta(minutes=train["stops"][last][1])
+            connections.append({
+                "dataWyjazdu": departure_datetime.strftime("%Y-%m-%d %H:%M:%S"),
+                "dataPrzyjazdu": arrival_datetime.strftime("%Y-%m-%d %H:%M:%S"),
+                "pociagi": [{
+                    "nazwaPociagu": train["name"],
+                    "nrPociagu": train["number"],
+                    "kategoriaPociagu": train["category"],
+                    "czasJazdy": int((arrival_datetime - departure_datetime).total_seconds() // 60)
+                }]
+            })
+
+        connections.sort(key=lambda connection: connection["dataWyjazdu"])
+        return {"polaczenia": connections}
+
+    # Body of the route request: the stops of the train between the departure and arrival stations
+    def route(self, payload: dict) -> dict:
+        train = self.trains.get(payload["numerPociagu"])
+        if train is None:
+            return {"trasePrzejezdu": {"trasaPrzejazdu": []}}
+        first = self.stop_index(train, self.by_id1.get(payload["stacjaWyjazdu"]))
+        last = self.stop_index(train, self.by_id1.get(payload["stacjaPrzyjazdu"]))
+        if first is None or last is None or first >= last:
+            return {"trasePrzejezdu": {"trasaPrzejazdu": []}}
+
+        start = self.train_start(train, first, datetime.fromisoformat(payload["dataWyjazdu"]))
+        route = []
+        for number, (name, arrival_offset, departure_offset) in enumerate(train["stops"][first:last + 1], start=first + 1):
+            stop = {"nazwaStacji": name, "numerStacji": number}
+            if arrival_offset is not None:
+                stop["dataPrzyjazdu"] = (start + timedelta(minutes=arrival_offset)).strftime(ROUTE_DATETIME_FORMAT)
+            if departure_offset is not None:
+                stop["dataWyjazdu"] = (start + timedelta(minutes=departure_offset)).strftime(ROUTE_DATETIME_FORMAT)
+            route.append(stop)
+
+        return {"trasePrzejezdu": {"trasaPrzejazdu": route}}
+
+    # Body of the train details request: the carriages of the train, or 404 if it does not run between the stations
+    def composition(self, train_number: str, departure_station_id2: str, arrival_station_id2: str) -> dict:
+        span = self.span(train_number, departure_station_id2, arrival_station_id2)
+        if span is None:
+            return {"statusCode": 404}
+        train = span[0]
+        return {"klasa2": [int(carriage) for carriage in train["second_class"]], "wagonySchemat": train["carriages"]}
+
+    # SVG seat map of a carriage with the seats free on the whole span marked as available
+    def seat_map(self, train_number: str, carriage_number: str, departure_station_id2: str, arrival_station_id2: str) -> str | None:
+        span = self.span(train_number, departure_station_id2, arrival_station_id2)
+        if span is None or carriage_number not in span[0]["carriages"]:
+            return None
+        train, first, last = span
+
+        free = {seat for carriage, seat, free_from, free_to in train["free"] if carriage == carriage_number and free_from <= first and last <= free_to}
+        seats = []
+        for i in range(train["seats_per_carriage"]):
+            seat = 11 + i
+            special = '<eic:special ref="1"/>' if i < 4 else '<eic:special ref="7"/>' if i >= train["seats_per_carriage"] - 8 else ""
+            seats.append(
+                f'<g data-class="second class" id="m{seat}" transform="translate({40 + i // 4 * 44} {30 + i % 4 * 44})" onclick="selectSeat(this)">'
+                f'<rect width="36" height="34" rx="6" ry="6" fill="#f1f1f1"/>'
+                f'<image xlink:href="#seat-{"free" if seat in free else "taken"}" width="32" height="30" x="2" y="2" status="{1 if seat in free else 0}"/>'
+                f'<text x="18" y="22" text-anchor="middle" font-size="12">{seat}</text>{special}</g>'
+            )
+
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:eic="http://www.intercity.pl/eic" '
+            f'version="1.1" width="{80 + (train["seats_per_carriage"] + 3) // 4 * 44}" height="236">\n'
+            '<defs><symbol id="seat-free" viewBox="0 0 32 30"><path d="M4 2h24v20H4z" fill="#28a745"/></symbol>'
+            '<symbol id="seat-taken" viewBox="0 0 32 30"><path d="M4 2h24v20H4z" fill="#9e9e9e"/></symbol></defs>\n'
+            f'<script type="text/javascript"><![CDATA[ function selectSeat(seat) {{ parent.postMessage({{ seat: seat.id, wagon: "{carriage_number}" }}, "*"); }} ]]></script>\n'
+            f'<g id="seats">{"".join(seats)}</g>\n'
+            '</svg>\n'
+        )
+
+    # Body of the station search: stations with a word of the name starting with the query
+    def search_stations(self, query: str) -> list[dict]:
+        # Imported here, the benchmarks import utils only after pointing the API URLs at the mock
+        from utils.stations import normalize_station_name
+
+        query = normalize_station_name(query)
+        if not query:
+            return []
+        matches = []
+        for station in self.stations:
+            words = normalize_station_name(station["n"]).split(" ")
+            if any(" ".join(words[i:]).startswith(query) for i in range(len(words))):
+                matches.append(station)
+        return matches
+
+
+# Flask application serving the endpoints of the PKP Intercity APIs used by TrickyTrain from the mock
+def create_app(mock: MockIntercity) -> Flask:
+    app = Flask(__name__)
+
+    @app.route("/server/public/endpoint/Pociagi", methods=["POST"])
+    def passenger_api():
+        payload = json.loads(request.get_data())
+        failure = mock.before_call(payload.get("metoda", "unknown"))
+        if failure is not None:
+            return failure
+        if payload.get("metoda") == "wyszukajPolaczenia":
+            return mock.connections(payload)
+        if payload.get("metoda") == "pobierzTrasePrzejazdu":
+            return mock.route(payload)
+        return {"statusCode": 400}, 400
+
+    @app.route("/grm/sklad/wbnet/<category>/<number>/<departure_datetime>/<departure_station_id2>/<arrival_datetime>/<arrival_station_id2>")
+    def train_details(category, number, departure_datetime, departure_station_id2, arrival_datetime, arrival_station_id2):
+        failure = mock.before_call("sklad")
+        if failure is not None:
+            return failure
+        return mock.composition(number, departure_station_id2, arrival_station_id2)
+
+    @app.route("/grm/wagon/svg/wbnet/<category>/<number>/<carriage_number>/<carriage_type>/<departure_datetime>/<arrival_datetime>/<departure_station_id2>/<arrival_station_id2>")
+    def carriage_seat_map(category, number, carriage_number, carriage_type, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2):
+        failure = mock.before_call("wagon_svg")
+        if failure is not None:
+            return failure
+        svg = mock.seat_map(number, carriage_number, departure_station_id2, arrival_station_id2)
+        if svg is None:
+            return Response("Not Found", status=404)
+        return Response(svg, mimetype="image/svg+xml")
+
+    @app.route("/station/get/")
+    def station_search():
+        failure = mock.before_call("station_get")
+        if failure is not None:
+            return failure
+        return Response(json.dumps(mock.search_stations(request.args.get("q", "")), ensure_ascii=False), mimetype="application/json")
+
+    @app.route("/_mock/stats")
+    def stats():
+        return mock.stats()
+
+    @app.route("/_mock/trains/<number>/free", methods=["PUT"])
+    def set_free(number):
+        if not mock.set_free(number, request.get_json()):
+            return Response("Not Found", status=404)
+        return {"number": number, "free": request.get_json()}
+
+    # Stub of a webhook receiving the events of seat watches, GET lists the received events
+    @app.route("/_mock/webhook", methods=["GET", "POST"])
+    def webhook():
+        if request.method == "POST":
+            mock.record_webhook(request.get_json())
+            return {"received": True}
+        with mock.lock:
+            return Response(json.dumps(mock.webhooks, ensure_ascii=False), mimetype="application/json")
+
+    @app.route("/_mock/reset", methods=["POST"])
+    def reset():
+        mock.reset()
+        return mock.stats()
+
+    return app
+
+
+# Mock server running in a background thread, for benchmarks starting it in-process
+class MockServer:
+    def __init__(self, mock: MockIntercity, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.mock = mock
+        self.server = make_server(host, port, create_app(mock), threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-intercity", daemon=True)
+
+    # Base URL of the running server
+    @property
+    def url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}"
+
+    def start(self) -> "MockServer":
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.thread.join()
+
+
+# Run the mock server in the foreground, point the application at it with TRICKYTRAIN_API_BASE_URL and TRICKYTRAIN_STATION_SEARCH_URL
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline mock of the PKP Intercity APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--fixture", default=FIXTURE_PATH, help="JSON file with the stations and trains")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses with error 500")
+    parser.add_argument("--access-denied-rate", type=float, default=0.0, help="fraction of ACCESS DENIED responses")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = MockServer(MockIntercity(args.fixture, args.latency, args.error_rate, args.access_denied_rate, args.seed), args.host, args.port)
+    print(f"TRICKYTRAIN_API_BASE_URL={server.url} TRICKYTRAIN_STATION_SEARCH_URL={server.url}/station/get/")
+    server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.svg_parser import build_layout_template, parse_available_seats, parse_seat_map
+import re
+import xml.etree.ElementTree as ET
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "svg")
+NAMESPACE = {"svg": "http://www.w3.org/2000/svg"}
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+
+# Remove the script tags, as the seat maps were cleaned before the single pass parser
+def clean_svg(svg_text: str) -> str:
+    return re.sub(r"<script.*?</script>", "", svg_text, flags=re.DOTALL)
+
+
+# Previous implementation: element tree parse plus a separate regex pass removing the scripts
+def parse_with_element_tree(svg_text: str) -> tuple[str, dict[str, str]]:
+    return clean_svg(svg_text), parse_available_seats(svg_text)
+
+
+# Mark the available seats on the layout template of a seat map like the client does and compare the seat images with the seat map,
+# returns the first difference or None
+def check_template(cleaned: str, available_seats: dict[str, str]) -> str | None:
+    template, _ = build_layout_template(cleaned)
+    original = {}
+    for seat in ET.fromstring(cleaned.split("?>", 1)[-1]).iterfind(".//svg:g[@data-class]", NAMESPACE):
+        if seat.get("data-class"):
+            image = seat.find(".//svg:image", NAMESPACE)
+            original[seat.find(".//svg:text", NAMESPACE).text.strip()] = (image.get("status"), image.get(XLINK_HREF))
+
+    root = ET.fromstring(template.split("?>", 1)[-1])
+    images = {"1": root.get("data-seat-free"), "0": root.get("data-seat-taken")}
+    for status, name in (("1", "free"), ("0", "occupied")):
+        if images[status] is None and any(seat_status == status for seat_status, _ in original.values()):
+            return f"the template does not keep the image of the {name} seats"
+    for seat in root.iterfind(".//svg:g[@data-seat]", NAMESPACE):
+        number = seat.get("data-seat")
+        image = seat.find(".//svg:image", NAMESPACE)
+        if image.get("status") != "0" or (images["0"] is not None and image.get(XLINK_HREF) != images["0"]):
+            return f"seat {number} is not reset to an occupied seat"
+        status = "1" if number in available_seats else "0"
+        # Free first class seats are not offered and are shown as occupied
+        if (status == "1" or original[number][0] == "0") and images[status] is not None and images[status] != original[number][1]:
+            return f"seat {number} is shown with {images[status]} instead of {original[number][1]}"
+    return None
+
+
+# Time a parser on a fixture, returns the best time of a single call in milliseconds
+def measure(parser, svg_text: str, repeat: int, number: int) -> float:
+    return min(timeit.repeat(lambda: parser(svg_text), repeat=repeat, number=number)) / number * 1000
+
+
+# Compare the single pass parser with the element tree implementation on all SVG fixtures
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the SVG seat map parsers")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="directory with recorded SVG seat maps")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    fixtures = sorted(f for f in os.listdir(args.fixtures) if f.endswith(".svg"))
+    if not fixtures:
+        sys.exit(f"No SVG fixtures in {args.fixtures}")
+
+    print(f"{'fixture':<36} {'size':>8} {'seats':>6} {'etree ms':>9} {'scan ms':>8} {'speedup':>8} {'output':>8}")
+    total_etree = total_scan = 0.0
+    for fixture in fixtures:
+        with open(os.path.join(args.fixtures, fixture), encoding="utf-8") as f:
+            svg_text = f.read()
+
+        cleaned, seats = parse_seat_map(svg_text)
+        if seats.to_dict() != parse_available_seats(svg_text):
+            sys.exit(f"{fixture}: parsers found different seats")
+        if (problem := check_template(cleaned, seats.to_dict())) is not None:
+            sys.exit(f"{fixture}: layout template differs from the seat map, {problem}")
+
+        etree_ms = measure(parse_with_element_tree, svg_text, args.repeat, args.number)
+        scan_ms = measure(parse_seat_map, svg_text, args.repeat, args.number)
+        total_etree += etree_ms
+        total_scan += scan_ms
+
+        print(f"{fixture:<36} {len(svg_text):>8} {len(seats):>6} {etree_ms:>9.3f} {scan_ms:>8.3f} {etree_ms / scan_ms:>7.2f}x {len(cleaned) / len(clean_svg(svg_text)):>7.0%}")
+
+    print(f"{'total':<36} {'':>8} {'':>6} {total_etree:>9.3f} {total_scan:>8.3f} {total_etree / total_scan:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
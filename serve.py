@@ -0,0 +1,91 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import tempfile
+
+
+# Serve the application on the listening socket with a pool of threads
+def serve_worker(sock: socket.socket, threads: int, channel_timeout: int, connection_limit: int) -> None:
+    from waitress import serve
+    from app import app
+
+    serve(app, sockets=[sock], threads=threads, channel_timeout=channel_timeout, connection_limit=connection_limit, ident="TrickyTrain")
+
+
+# Run the worker processes on the shared socket and restart the ones which exit, until the server is stopped
+def supervise(sock: socket.socket, workers: int, threads: int, channel_timeout: int, connection_limit: int) -> None:
+    children = set()
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve_worker(sock, threads, channel_timeout, connection_limit)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum: int, frame: object) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Proces {pid} zakończył się z kodem {os.waitstatus_to_exitcode(status)}, uruchamianie ponownie")
+            spawn()
+
+
+# Production entry point: no browser, several worker processes with threads sharing one listening socket and one cache.
+# The search sessions and carriage layouts are kept in the shared cache, the watches, metrics, limiter and circuit breaker are per process.
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run TrickyTrain with the waitress WSGI server")
+    parser.add_argument("--host", default=os.environ.get("TRICKYTRAIN_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("TRICKYTRAIN_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("TRICKYTRAIN_WORKERS", "1")), help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("TRICKYTRAIN_THREADS", "16")), help="number of request threads of each worker")
+    parser.add_argument("--channel-timeout", type=int, default=int(os.environ.get("TRICKYTRAIN_CHANNEL_TIMEOUT", "300")), help="seconds after which an inactive connection is closed")
+    parser.add_argument("--connection-limit", type=int, default=int(os.environ.get("TRICKYTRAIN_CONNECTION_LIMIT", "1000")), help="maximum number of open connections of each worker")
+    args = parser.parse_args()
+
+    if args.workers > 1 and not hasattr(os, "fork"):
+        sys.exit("Wiele procesów wymaga systemu z funkcją fork, uruchom serwer z --workers 1 i większą liczbą wątków")
+
+    # All workers share the cache of stations, train details, routes and connections, the API modules read the path on import
+    os.environ.setdefault("TRICKYTRAIN_SHARED_CACHE", os.path.join(tempfile.gettempdir(), "trickytrain-cache.sqlite3"))
+    # Search sessions and layouts are shared through the cache too, watches are per process and are refused with several workers
+    os.environ["TRICKYTRAIN_WORKER_PROCESSES"] = str(args.workers)
+
+    sock = socket.create_server((args.host, args.port), backlog=2048)
+    print(f"TrickyTrain: http://{args.host}:{args.port} ({args.workers} x {args.threads} wątków, cache {os.environ['TRICKYTRAIN_SHARED_CACHE']})")
+
+    if args.workers == 1:
+        serve_worker(sock, args.threads, args.channel_timeout, args.connection_limit)
+    else:
+        supervise(sock, args.workers, args.threads, args.channel_timeout, args.connection_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ document.addEventListener("DOMContentLoaded", function () {
     // Set the minimum date for the date input field to today
     let today = new Date().toISOString().split('T')[0];
     document.getElementById("date").setAttribute("min", today);
+    document.getElementById("date_to").setAttribute("min", today);
 
     // Function to set up autocomplete dropdown for station inputs
     function setupAutocomplete(inputId, dropdownId) {
@@ -1,7 +1,32 @@
-// Toggles the visibility of the SVG section
+const seatNames = {
+    "normal_seat": "Normalne",
+    "bike_seat": "Rowerowe",
+    "quiet_zone_seat": "W strefie ciszy"
+};
+
+const seatClasses = {
+    "normal_seat": "seat-normal",
+    "bike_seat": "seat-bike",
+    "quiet_zone_seat": "seat-quiet"
+};
+
+const XLINK_NAMESPACE = "http://www.w3.org/1999/xlink";
+
+// Escapes a value received from the server for the HTML built from it, station names and seat numbers come from PKP Intercity
+function escapeHtml(value) {
+    return String(value).replace(/[&<>"']/g, character => `&#${character.charCodeAt(0)};`);
+}
+
+// Escapes a link for a href attribute, links other than http(s) are replaced with "#"
+function escapeLink(url) {
+    return /^https?:\/\//i.test(String(url)) ? escapeHtml(url) : "#";
+}
+
+// Toggles the visibility of the SVG section, the seat maps are loaded when it is shown
 function toggleSVG() {
     var section = document.getElementById("svgSection");
     section.classList.toggle("show");
+    loadSeatMaps();
 }
 
 // Toggles the visibility of the seat list associated with the clicked element
@@ -10,105 +35,357 @@ function toggleSeatList(element) {
     seatList.classList.toggle("show");
 }
 
-document.addEventListener("DOMContentLoaded", function () {
-    let selectedRow = null;
+// Creates a card with the seats of a carriage grouped by seat type
+function createSeatCard(carriageNr, seats) {
+    const seatCard = document.createElement("div");
+    seatCard.classList.add("seat-card");
+
+    // Group seats by type
+    let seatTypes = {};
+    for (const [seatNr, seatType] of Object.entries(seats)) {
+        if (!seatTypes[seatType]) seatTypes[seatType] = [];
+        seatTypes[seatType].push(seatNr);
+    }
+
+    // Create a card with seats information
+    seatCard.innerHTML = `
+        <div class="seat-header">Wagon ${escapeHtml(carriageNr)}</div>
+        ${Object.entries(seatTypes).map(([type, numbers]) => `
+            <div class="seat-badge ${seatClasses[type] || 'bg-secondary'}" onclick="toggleSeatList(this)">
+                ${seatNames[type] || escapeHtml(type)}: ${numbers.length}
+            </div>
+            <div class="seat-list fw-bold">${escapeHtml(numbers.join(", "))}</div>
+        `).join("")}
+    `;
+    return seatCard;
+}
+
+// Divides carriages into columns of seat cards
+function createSeatColumns(carriages) {
+    const numColumns = 4;
+    let columns = Array.from({ length: numColumns }, () => []);
+    carriages.forEach(({ carriageNr, seats }, i) => {
+        columns[i % numColumns].push({ carriageNr, seats });
+    });
+
+    const rowDiv = document.createElement("div");
+    rowDiv.classList.add("row");
+
+    // Create columns with seat cards
+    columns.forEach(col => {
+        const colDiv = document.createElement("div");
+        colDiv.classList.add("col-12", "col-md-3");
+        col.forEach(({ carriageNr, seats }) => colDiv.appendChild(createSeatCard(carriageNr, seats)));
+        rowDiv.appendChild(colDiv);
+    });
+
+    return rowDiv;
+}
+
+// Requests of the carriage layouts by their ids, every layout is fetched once and kept by the browser cache
+const layoutRequests = {};
+function fetchLayout(layoutId) {
+    if (!layoutRequests[layoutId]) {
+        layoutRequests[layoutId] = fetch(`/layouts/${encodeURIComponent(layoutId)}.svg`)
+            .then(response => response.ok ? response.text() : "")
+            .catch(() => "");
+    }
+    return layoutRequests[layoutId];
+}
+
+// Prepares an element for the seat map of a carriage, the map is drawn when the SVG section is shown
+function fillSvgElement(svgElement, carriageNr, layoutId, seats) {
+    svgElement.classList.add("mt-5");
+    svgElement.dataset.carriage = carriageNr;
+    svgElement.dataset.layout = layoutId;
+    svgElement.seats = seats;
+    svgElement.innerHTML = `<h3 class="text-center fw-bold">Wagon ${escapeHtml(carriageNr)}</h3>`;
+    return svgElement;
+}
+
+// Creates an element for the seat map of a carriage
+function createSvgElement(carriageNr, layoutId, seats) {
+    return fillSvgElement(document.createElement("div"), carriageNr, layoutId, seats);
+}
+
+// Draws the seat maps of the visible SVG section from their layouts, marking the available seats as free and all other seats as occupied
+function loadSeatMaps() {
+    const section = document.getElementById("svgSection");
+    if (!section || !section.classList.contains("show")) return;
+
+    section.querySelectorAll("[data-layout]:not([data-loaded])").forEach(svgElement => {
+        svgElement.dataset.loaded = "1";
+        fetchLayout(svgElement.dataset.layout).then(layout => {
+            svgElement.insertAdjacentHTML("beforeend", layout);
+            // Images of the free and occupied seats kept by the template, an image missing from the template is shown faded
+            const svg = svgElement.querySelector("svg");
+            const images = {
+                "1": svg ? svg.getAttribute("data-seat-free") : null,
+                "0": svg ? svg.getAttribute("data-seat-taken") : null,
+            };
+            svgElement.querySelectorAll("g[data-seat]").forEach(seat => {
+                const image = seat.querySelector("image");
+                if (!image) return;
+                const status = svgElement.seats && svgElement.seats[seat.dataset.seat] ? "1" : "0";
+                image.setAttribute("status", status);
+                if (images[status]) {
+                    image.setAttributeNS(XLINK_NAMESPACE, "xlink:href", images[status]);
+                    if (image.hasAttribute("href")) image.setAttribute("href", images[status]);
+                    image.removeAttribute("opacity");
+                } else {
+                    image.setAttribute("opacity", "0.4");
+                }
+            });
+        });
+    });
+}
+
+// Selects a row of the seat transfer table and displays its available seats and the SVG section, or deselects it
+let selectedRow = null;
+function selectTransferRow(row) {
+    const index = row.getAttribute("data-index");
     const toggleButton = document.getElementById("toggleButton");
+    const availableSeatsContainer = document.getElementById("available-seats");
+    const svgContainer = document.getElementById("svgSection");
 
-    // For each row in the table, add an event listener to display the available seats and the SVG section
-    document.querySelectorAll(".selectable-row").forEach(row => {
-        row.addEventListener("click", function () {
-            const index = this.getAttribute("data-index");
-
-            if (selectedRow === this) {
-                // Deselect the row if it is already selected
-                this.classList.remove("table-primary");
-                selectedRow = null;
-                document.getElementById("available-seats").innerHTML = "";
-                document.getElementById("svgSection").innerHTML = "";
-                toggleButton.style.display = "none";
-            } else {
-                // Select the row and display the available seats and the SVG section
-                if (selectedRow) {
-                    selectedRow.classList.remove("table-primary");
+    availableSeatsContainer.innerHTML = "";
+    svgContainer.innerHTML = "";
+
+    if (selectedRow === row) {
+        // Deselect the row if it is already selected
+        row.classList.remove("table-primary");
+        selectedRow = null;
+        toggleButton.style.display = "none";
+        return;
+    }
+
+    // Select the row and display the available seats and the SVG section
+    if (selectedRow) {
+        selectedRow.classList.remove("table-primary");
+    }
+    row.classList.add("table-primary");
+    selectedRow = row;
+
+    // Divide non-empty carriages into columns
+    let carriages = Object.entries(seatsData[index] || {})
+        .filter(([_, seats]) => seats && Object.keys(seats).length > 0)
+        .map(([carriageNr, seats]) => ({ carriageNr, seats }));
+    availableSeatsContainer.appendChild(createSeatColumns(carriages));
+
+    // Display SVGs for selected row
+    for (const [carriageNr, layoutId] of Object.entries(svgData[index] || {})) {
+        const carriage = carriages.find(item => item.carriageNr === carriageNr);
+        if (carriage) {
+            svgContainer.appendChild(createSvgElement(carriageNr, layoutId, carriage.seats));
+        }
+    }
+    loadSeatMaps();
+
+    toggleButton.style.display = "block";
+}
+
+// Formats "YYYY-MM-DD HH:MM:SS" as "HH:MM" or "HH:MM DD.MM.YYYY"
+function formatDatetime(value, withDate) {
+    if (!value) return "";
+    const [date, time] = value.split(" ");
+    const [year, month, day] = date.split("-");
+    const hours = time.slice(0, 5);
+    return withDate ? `${hours} ${day}.${month}.${year}` : hours;
+}
+
+// Formats the duration between two "YYYY-MM-DD HH:MM:SS" timestamps as "H:MM" or "M"
+function formatDuration(departure, arrival) {
+    if (!departure || !arrival) return "-";
+    const minutes = Math.floor((new Date(arrival.replace(" ", "T")) - new Date(departure.replace(" ", "T"))) / 60000);
+    if (minutes < 60) return `${minutes}`;
+    return `${Math.floor(minutes / 60)}:${String(minutes % 60).padStart(2, "0")}`;
+}
+
+// Appends a confirmed seat transfer leg to the table
+function appendTransferRow(event) {
+    const table = document.getElementById("transfer-table");
+    const withDate = table.dataset.sameDate !== "1";
+    const seatCount = Object.values(event.available_seats).reduce((total, seats) => total + Object.keys(seats).length, 0);
+
+    seatsData[event.index] = event.available_seats;
+    svgData[event.index] = event.carrige_svgs;
+
+    const row = document.createElement("tr");
+    row.classList.add("selectable-row");
+    row.setAttribute("data-index", event.index);
+    row.innerHTML = `
+        <td>${event.index + 1}</td>
+        <td>${escapeHtml(event.departure_station.station_name)}</td>
+        <td>${formatDatetime(event.departure_station.departure_datatime, withDate)}</td>
+        <td>${escapeHtml(event.arrival_station.station_name)}</td>
+        <td>${formatDatetime(event.arrival_station.arrival_datatime, withDate)}</td>
+        <td>${formatDuration(event.departure_station.departure_datatime, event.arrival_station.arrival_datatime)}</td>
+        <td>${seatCount}</td>
+        <td class="text-center">
+            <a type="button" class="btn btn-primary" href="${escapeLink(event.link)}" target="_blank">
+                <i class="bi bi-arrow-up-right-circle"></i>
+            </a>
+        </td>
+    `;
+    row.addEventListener("click", () => selectTransferRow(row));
+    table.querySelector("tbody").appendChild(row);
+    table.classList.remove("d-none");
+}
+
+// Renders the seats streamed by the server as newline-delimited JSON events
+function streamSeats(form) {
+    const statusText = document.getElementById("stream-status-text");
+    const directSeats = document.getElementById("direct-seats");
+    const svgContainer = document.getElementById("svgSection");
+    const toggleButton = document.getElementById("toggleButton");
+    let directCarriages = [];
+
+    function showAlert(message, level = "danger") {
+        const alert = document.getElementById("stream-alert");
+        alert.textContent = message;
+        alert.classList.replace("alert-danger", `alert-${level}`);
+        alert.classList.remove("d-none");
+    }
+
+    function handleEvent(event) {
+        if (event.type === "carriage") {
+            if (!event.available_seats || Object.keys(event.available_seats).length === 0) return;
+
+            // Keep the carriages ordered by number
+            directCarriages.push({ carriageNr: event.carriage_number, seats: event.available_seats });
+            directCarriages.sort((a, b) => Number(a.carriageNr) - Number(b.carriageNr));
+            directSeats.innerHTML = "";
+            directSeats.appendChild(createSeatColumns(directCarriages));
+
+            if (event.svg) {
+                const next = Array.from(svgContainer.children).find(item => Number(item.dataset.carriage) > Number(event.carriage_number));
+                svgContainer.insertBefore(createSvgElement(event.carriage_number, event.svg, event.available_seats), next || null);
+                toggleButton.style.display = "block";
+                loadSeatMaps();
+            }
+        } else if (event.type === "transfer_search") {
+            statusText.textContent = "Brak miejsca na całą trasę, szukanie przesiadek...";
+            directCarriages = [];
+            directSeats.innerHTML = "";
+            svgContainer.innerHTML = "";
+            toggleButton.style.display = "none";
+        } else if (event.type === "leg") {
+            appendTransferRow(event);
+        } else if (event.type === "done") {
+            document.getElementById("stream-status").classList.add("d-none");
+            if (event.status === "no_seats") {
+                showAlert("Brak dostępnych miejsc");
+                const watchForm = document.getElementById("watch-form");
+                if (watchForm) {
+                    watchForm.classList.remove("d-none");
                 }
-                this.classList.add("table-primary");
-                selectedRow = this;
-
-                const availableSeatsContainer = document.getElementById("available-seats");
-                availableSeatsContainer.innerHTML = "";
-                const svgContainer = document.getElementById("svgSection");
-                svgContainer.innerHTML = "";
-
-                // Divide non-empty carriages into columns
-                let carriages = Object.entries(seatsData[index] || {}).filter(([_, seats]) => seats && Object.keys(seats).length > 0);
-                const numColumns = 4;
-                let columns = Array.from({ length: numColumns }, () => []);
-                carriages.forEach(([carriageNr, seats], i) => {
-                    columns[i % numColumns].push({ carriageNr, seats });
-                });
-
-                const rowDiv = document.createElement("div");
-                rowDiv.classList.add("row");
-                
-                // Create columns with seat cards
-                columns.forEach(col => {
-                    const colDiv = document.createElement("div");
-                    colDiv.classList.add("col-12", "col-md-3");
-                    col.forEach(({ carriageNr, seats }) => {
-                        const seatCard = document.createElement("div");
-                        seatCard.classList.add("seat-card");
-
-                        // Group seats by type
-                        let seatTypes = {};
-                        for (const [seatNr, seatType] of Object.entries(seats)) {
-                            if (!seatTypes[seatType]) seatTypes[seatType] = [];
-                            seatTypes[seatType].push(seatNr);
-                        }
-
-                        const seatNames = {
-                            "normal_seat": "Normalne",
-                            "bike_seat": "Rowerowe",
-                            "quiet_zone_seat": "W strefie ciszy"
-                        };
-
-                        const seatClasses = {
-                            "normal_seat": "seat-normal",
-                            "bike_seat": "seat-bike",
-                            "quiet_zone_seat": "seat-quiet"
-                        };
-
-                        // Create a card with seats information
-                        seatCard.innerHTML = `
-                            <div class="seat-header">Wagon ${carriageNr}</div>
-                            ${Object.entries(seatTypes).map(([type, numbers]) => `
-                                <div class="seat-badge ${seatClasses[type] || 'bg-secondary'}" onclick="toggleSeatList(this)">
-                                    ${seatNames[type] || type}: ${numbers.length}
-                                </div>
-                                <div class="seat-list fw-bold">${numbers.join(", ")}</div>
-                            `).join("")}
-                        `;
-                        colDiv.appendChild(seatCard);
-                    });
-                    rowDiv.appendChild(colDiv);
-                });
-
-                availableSeatsContainer.appendChild(rowDiv);
-
-                // Display SVGs for selected row
-                for (const [carriageNr, svg] of Object.entries(svgData[index] || {})) {
-                    if (carriages.some(item => item.carriageNr === carriageNr || item[0] === carriageNr)) {
-                        const svgElement = document.createElement("div");
-                        svgElement.classList.add("mt-5");
-                        svgElement.innerHTML = `
-                            <h3 class="text-center fw-bold">Wagon ${carriageNr}</h3>
-                            ${svg}
-                        `;
-                        svgContainer.appendChild(svgElement);
-                    }
+            } else if (event.status === "partial_transfer") {
+                showAlert("Przerwano wyszukiwanie przesiadek po przekroczeniu limitu zapytań do PKP Intercity. Pokazano miejsca na części trasy.", "warning");
+            } else if (event.status === "timed_out") {
+                showAlert("Przekroczono czas wyszukiwania miejsc. Pokazano miejsca znalezione do tej pory.", "warning");
+                // Stopped while checking the carriages, the seats found can be booked on the whole route
+                if (directCarriages.length > 0) {
+                    const buyButton = document.getElementById("buy-button");
+                    buyButton.href = event.links[0];
+                    buyButton.classList.remove("d-none");
                 }
+            } else if (event.status === "same_seat") {
+                const buyButton = document.getElementById("buy-button");
+                buyButton.href = event.links[0];
+                buyButton.classList.remove("d-none");
+            }
+        } else if (event.type === "error") {
+            document.getElementById("stream-status").classList.add("d-none");
+            showAlert(event.message);
+        }
+    }
 
-                toggleButton.style.display = "block";
+    fetch("/seats/stream", { method: "POST", body: new FormData(form) })
+        .then(async response => {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                // Handle every complete line, keep the rest for the next chunk
+                let lines = buffer.split("\n");
+                buffer = lines.pop();
+                lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
             }
+        })
+        .catch(error => {
+            document.getElementById("stream-status").classList.add("d-none");
+            showAlert(`Sprawdź połączenie z Internetem i spróbuj ponownie: ${error}`);
+        });
+}
+
+// Registers a watch of the train and shows the seats freed later, received as server-sent events
+function watchSeats(form) {
+    const watchAlert = document.getElementById("watch-alert");
+
+    // The HTML is built from escaped values only
+    function showWatchAlert(html, level) {
+        watchAlert.innerHTML = html;
+        watchAlert.className = `alert alert-${level} text-center mt-4`;
+    }
+
+    form.querySelector("button").disabled = true;
+    fetch("/watches", { method: "POST", body: new FormData(form) })
+        .then(async response => {
+            const body = await response.json();
+            if (!response.ok) throw body.error;
+
+            form.classList.add("d-none");
+            showWatchAlert("Obserwowanie pociągu, powiadomimy Cię o zwolnionych miejscach na tej stronie.", "info");
+
+            const events = new EventSource(body.events);
+            events.addEventListener("seats", message => {
+                const event = JSON.parse(message.data);
+                if (event.seat_count > 0) {
+                    const seats = Object.entries(event.added).map(([carriageNr, seats]) => `Wagon ${escapeHtml(carriageNr)}: ${escapeHtml(Object.keys(seats).join(", "))}`).join("<br>");
+                    showWatchAlert(`Wolne miejsca: ${event.seat_count}${seats ? `<br>${seats}` : ""}<br><a href="${escapeLink(event.link)}" target="_blank" class="fw-bold">Kup bilet</a>`, "success");
+                } else if (!event.initial) {
+                    showWatchAlert("Zwolnione miejsca zostały już zajęte, obserwowanie trwa.", "info");
+                }
+            });
+            events.addEventListener("closed", () => {
+                events.close();
+                showWatchAlert("Zakończono obserwowanie pociągu.", "secondary");
+            });
+        })
+        .catch(error => {
+            form.querySelector("button").disabled = false;
+            showWatchAlert(`Nie udało się obserwować pociągu: ${escapeHtml(error)}`, "danger");
         });
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+    // For each row in the table, add an event listener to display the available seats and the SVG section
+    document.querySelectorAll(".selectable-row").forEach(row => {
+        row.addEventListener("click", () => selectTransferRow(row));
     });
-});
\ No newline at end of file
+
+    // Prepare the seat maps of the connection without seat transfer, they are drawn when the SVG section is shown
+    document.querySelectorAll(".seat-map").forEach(element => {
+        fillSvgElement(element, element.dataset.carriage, element.dataset.layout, seatsData[element.dataset.carriage]);
+    });
+
+    // Watch the train for freed seats when there are none
+    const watchForm = document.getElementById("watch-form");
+    if (watchForm) {
+        watchForm.addEventListener("submit", event => {
+            event.preventDefault();
+            watchSeats(watchForm);
+        });
+    }
+
+    // Start streaming the seats if the page was rendered without them
+    const streamForm = document.getElementById("stream-form");
+    if (streamForm) {
+        streamSeats(streamForm);
+    }
+});
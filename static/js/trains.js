@@ -37,6 +37,59 @@ document.addEventListener("DOMContentLoaded", function() {
         }
     }
 
+    // Count the direct seats of all trains at once and fill them in as they are counted
+    const seatCountsButton = document.getElementById("seat-counts-button");
+    if (seatCountsButton) {
+        seatCountsButton.addEventListener("click", function () {
+            const cells = document.querySelectorAll(".seat-count");
+            const body = new FormData();
+            body.append("search", document.querySelector("input[name='search']").value);
+
+            seatCountsButton.disabled = true;
+            cells.forEach(cell => cell.textContent = "...");
+
+            function handleEvent(event) {
+                // The whole search failed, e.g. the search results expired on the server
+                if (event.type === "error") {
+                    cells.forEach(cell => {
+                        cell.textContent = "?";
+                        cell.title = event.message;
+                    });
+                    return;
+                }
+                if (event.type !== "seat_count") return;
+                const cell = cells[event.index];
+                if (event.seat_count === null) {
+                    cell.textContent = "?";
+                    cell.title = event.error;
+                } else {
+                    cell.textContent = event.seat_count;
+                    cell.classList.add("fw-bold", event.seat_count > 0 ? "text-success" : "text-danger");
+                }
+            }
+
+            fetch("/trains/seat_counts", { method: "POST", body: body })
+                .then(async response => {
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = "";
+
+                    while (true) {
+                        const { done, value } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+
+                        // Handle every complete line, keep the rest for the next chunk
+                        let lines = buffer.split("\n");
+                        buffer = lines.pop();
+                        lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+                    }
+                })
+                .catch(error => console.error("Błąd pobierania liczby miejsc:", error))
+                .finally(() => seatCountsButton.disabled = false);
+        });
+    }
+
     // Get the loading screen and all forms on the page
     const forms = document.querySelectorAll("form");
     const loadingScreen = document.getElementById("loading-screen");
@@ -1,2 +1,6 @@
-from .api import fetch_train_connections, fetch_train_details, fetch_carriage_seat_map, fetch_train_route, fetch_station_ids, fetch_stations
-from .data_precessor import get_trains, get_seat_availability
\ No newline at end of file
+from .api import fetch_train_connections, fetch_train_details, fetch_carriage_seat_map, fetch_train_route, fetch_station_ids, fetch_stations, search_stations, station_index
+from .api import fetch_train_connections_async, fetch_train_details_async, fetch_carriage_seat_map_async, fetch_train_route_async, fetch_station_ids_async, search_stations_async
+from .cache import cache_stats
+from .limiter import current_user, current_priority, upstream_limiter
+from .resilience import CircuitOpenError, circuit_stats
+from .data_precessor import get_trains, get_journeys, iter_trains_range, resolve_stations, get_seat_availability, stream_seat_availability, stream_seat_counts
\ No newline at end of file
@@ -1,9 +1,20 @@
 from curl_cffi import requests
+from typing import Any
+from . import client
+from .cache import caches
+from .deadline import DeadlineExceeded, sleep
+from .metrics import UPSTREAM_RETRIES, timed
+from .resilience import CircuitOpenError
+from .stations import StationIndex
+import asyncio
 import json
-import time
-    
+import os
 
-API_BASE_URL = "https://api-gateway.intercity.pl" 
+
+# Base URLs of the PKP Intercity APIs, can be pointed at the mock server in benchmarks/mock_intercity.py
+API_BASE_URL = os.environ.get("TRICKYTRAIN_API_BASE_URL", "https://api-gateway.intercity.pl").rstrip("/")
+PASSENGER_API_URL = f"{API_BASE_URL}/server/public/endpoint/Pociagi"
+STATION_SEARCH_URL = os.environ.get("TRICKYTRAIN_STATION_SEARCH_URL", "https://www.intercity.pl/station/get/")
 HEADERS = {
     "accept": "application/json, text/plain, */*",
     "content-type": "application/json",
@@ -11,11 +22,26 @@ HEADERS = {
 }
 
 
-# Fetch train connections between two stations on a given date
-def fetch_train_connections(date: str, departure_station_id1: str, arrival_station_id1: str) -> dict:
-    url = f"{API_BASE_URL}/server/public/endpoint/Pociagi"
+# Check the status code of the API response, optionally also the access denied page
+def check_response(response: requests.Response, function_name: str, check_access: bool = False) -> None:
+    if response.status_code != 200:
+        raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w {function_name}")
+
+    if check_access and "ACCESS DENIED" in response.text.upper():
+        raise ConnectionError(f"Odmowa dostępu do API PKP Intercity w {function_name}")
+
+
+# Decode the JSON body of the API response
+def decode_json(response: requests.Response, function_name: str) -> Any:
+    try:
+        return response.json()
+    except json.JSONDecodeError:
+        raise ValueError(f"Nieprawidłowa odpowiedź JSON z {function_name}")
+
 
-    payload = json.dumps({
+# Build the request body for searching train connections between two stations on a given date
+def train_connections_payload(date: str, departure_station_id1: str, arrival_station_id1: str) -> str:
+    return json.dumps({
         "urzadzenieNr": "956",
         "metoda": "wyszukajPolaczenia",
         "dataWyjazdu": f"{date} 00:00:00",
@@ -36,65 +62,97 @@ def fetch_train_connections(date: str, departure_station_id1: str, arrival_stati
         "czasNaPrzesiadkeMin": 3
     })
 
-    response = requests.post(url, headers=HEADERS, data=payload, impersonate="chrome")
 
-    if response.status_code != 200:
-        raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_train_connections")
+# Build the request body for fetching the route of a specific train
+def train_route_payload(departure_datetime: str, departure_station_id1: str, arrival_station_id1: str, train_number: str) -> str:
+    return json.dumps({
+        "dataWyjazdu": departure_datetime,
+        "stacjaWyjazdu": departure_station_id1,
+        "stacjaPrzyjazdu": arrival_station_id1,
+        "numerPociagu": train_number,
+        "urzadzenieNr": "956",
+        "metoda": "pobierzTrasePrzejazdu"
+    })
 
-    if "ACCESS DENIED" in response.text.upper():
-        raise ConnectionError("Odmowa dostępu do API PKP Intercity w fetch_train_connections")
 
-    try:
-        return response.json()
-    except json.JSONDecodeError:
-        raise ValueError("Nieprawidłowa odpowiedź JSON z fetch_train_connections")
+# Build the URL of the details of a specific train
+def train_details_url(train_category: str, train_number: str, departure_datetime: str, departure_station_id2: str, arrival_datetime: str, arrival_station_id2: str) -> str:
+    return f"{API_BASE_URL}/grm/sklad/wbnet/{train_category}/{train_number}/{departure_datetime}/{departure_station_id2}/{arrival_datetime}/{arrival_station_id2}"
+
+
+# Build the URL of the seat map of a specific carriage on a train
+def carriage_seat_map_url(train_category: str, train_number: str, carriage_number: str, carriage_type: str, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str) -> str:
+    return f"{API_BASE_URL}/grm/wagon/svg/wbnet/{train_category}/{train_number}/{carriage_number}/{carriage_type}/{departure_datetime}/{arrival_datetime}/{departure_station_id2}/{arrival_station_id2}"
+
+
+# Exponential backoff between seat map retries: 0.5s, 1s, 2s
+def seat_map_retry_delay(attempt: int) -> float:
+    return (2 ** attempt) * 0.5
+
+
+# Fetch train connections between two stations on a given date
+@timed("fetch_train_connections")
+def fetch_train_connections(date: str, departure_station_id1: str, arrival_station_id1: str) -> dict:
+    payload = train_connections_payload(date, departure_station_id1, arrival_station_id1)
+
+    def load() -> dict:
+        response = client.request("POST", PASSENGER_API_URL, headers=HEADERS, data=payload)
+        check_response(response, "fetch_train_connections", check_access=True)
+        return decode_json(response, "fetch_train_connections")
+
+    return caches["train_connections"].get_or_load(payload, load)
 
 
 # Fetch details of a specific train
+@timed("fetch_train_details")
 def fetch_train_details(train_category: str, train_number: str, departure_datetime: str, departure_station_id2: str, arrival_datetime: str, arrival_station_id2: str) -> dict:
-    url = f"{API_BASE_URL}/grm/sklad/wbnet/{train_category}/{train_number}/{departure_datetime}/{departure_station_id2}/{arrival_datetime}/{arrival_station_id2}"
-    payload = {}
+    url = train_details_url(train_category, train_number, departure_datetime, departure_station_id2, arrival_datetime, arrival_station_id2)
 
-    response = requests.get(url, headers=HEADERS, data=payload, impersonate="chrome")
+    def load() -> dict:
+        response = client.request("GET", url, headers=HEADERS)
+        check_response(response, "fetch_train_details")
+        return decode_json(response, "fetch_train_details")
 
-    if response.status_code != 200:
-        raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_train_details")
-    
-    try:
-        return response.json()
-    except json.JSONDecodeError:
-        raise ValueError("Nieprawidłowa odpowiedź JSON z fetch_train_details")
+    return caches["train_details"].get_or_load(url, load)
 
 
 # Fetch the seat map of a specific carriage on a train as svg
+@timed("fetch_carriage_seat_map")
 def fetch_carriage_seat_map(train_category: str, train_number: str, carriage_number: str, carriage_type: str, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str, max_retries: int = 3) -> requests.Response:
-    url = f"{API_BASE_URL}/grm/wagon/svg/wbnet/{train_category}/{train_number}/{carriage_number}/{carriage_type}/{departure_datetime}/{arrival_datetime}/{departure_station_id2}/{arrival_station_id2}"
-    payload = {}
+    url = carriage_seat_map_url(train_category, train_number, carriage_number, carriage_type, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2)
+    return caches["carriage_seat_map"].get_or_load(url, lambda: load_carriage_seat_map(url, max_retries))
+
 
+# Fetch the seat map from the given URL, retrying on 500 errors
+def load_carriage_seat_map(url: str, max_retries: int) -> requests.Response:
     last_exception = None
 
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, headers=HEADERS, data=payload, impersonate="chrome")
+            response = client.request("GET", url, headers=HEADERS)
 
             if response.status_code == 200:
                 return response
 
             # Retry on 500 errors
             if response.status_code == 500 and attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 0.5  # Exponential backoff: 0.5s, 1s, 2s
-                time.sleep(wait_time)
+                UPSTREAM_RETRIES.inc("carriage_seat_map", "500")
+                sleep(seat_map_retry_delay(attempt))
                 continue
 
             # Other status codes - raise immediately
             if response.status_code != 500:
                 raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_carriage_seat_map")
 
+        except (CircuitOpenError, DeadlineExceeded):
+            # Retrying cannot help while the endpoint keeps failing or after the deadline of the request
+            raise
+
         except Exception as e:
             last_exception = e
             if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 0.5
-                time.sleep(wait_time)
+                UPSTREAM_RETRIES.inc("carriage_seat_map", type(e).__name__)
+                sleep(seat_map_retry_delay(attempt))
                 continue
             raise
 
@@ -105,66 +163,158 @@ def fetch_carriage_seat_map(train_category: str, train_number: str, carriage_num
 
 
 # Fetch the route of a specific train
+@timed("fetch_train_route")
 def fetch_train_route(departure_datetime: str, departure_station_id1: str, arrival_station_id1: str, train_number: str) -> dict:
-    url = f"{API_BASE_URL}/server/public/endpoint/Pociagi"
+    payload = train_route_payload(departure_datetime, departure_station_id1, arrival_station_id1, train_number)
 
-    payload = json.dumps({
-        "dataWyjazdu": departure_datetime,
-        "stacjaWyjazdu": departure_station_id1,
-        "stacjaPrzyjazdu": arrival_station_id1,
-        "numerPociagu": train_number,
-        "urzadzenieNr": "956",
-        "metoda": "pobierzTrasePrzejazdu"
-    })
+    def load() -> dict:
+        response = client.request("POST", PASSENGER_API_URL, headers=HEADERS, data=payload)
+        check_response(response, "fetch_train_route", check_access=True)
+        return decode_json(response, "fetch_train_route")
 
-    response = requests.post(url, headers=HEADERS, data=payload, impersonate="chrome")
+    return caches["train_route"].get_or_load(payload, load)
 
-    if response.status_code != 200:
-        raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_train_route")
 
-    if "ACCESS DENIED" in response.text.upper():
-        raise ConnectionError("Odmowa dostępu do API PKP Intercity w fetch_train_route")
+# Async version of fetch_train_connections
+@timed("fetch_train_connections")
+async def fetch_train_connections_async(date: str, departure_station_id1: str, arrival_station_id1: str) -> dict:
+    payload = train_connections_payload(date, departure_station_id1, arrival_station_id1)
+
+    async def load() -> dict:
+        response = await client.request_async("POST", PASSENGER_API_URL, headers=HEADERS, data=payload)
+        check_response(response, "fetch_train_connections", check_access=True)
+        return decode_json(response, "fetch_train_connections")
+
+    return await caches["train_connections"].get_or_load_async(payload, load)
+
+
+# Async version of fetch_train_details
+@timed("fetch_train_details")
+async def fetch_train_details_async(train_category: str, train_number: str, departure_datetime: str, departure_station_id2: str, arrival_datetime: str, arrival_station_id2: str) -> dict:
+    url = train_details_url(train_category, train_number, departure_datetime, departure_station_id2, arrival_datetime, arrival_station_id2)
+
+    async def load() -> dict:
+        response = await client.request_async("GET", url, headers=HEADERS)
+        check_response(response, "fetch_train_details")
+        return decode_json(response, "fetch_train_details")
+
+    return await caches["train_details"].get_or_load_async(url, load)
 
-    try:
-        return response.json()
-    except json.JSONDecodeError:
-        raise ValueError("Nieprawidłowa odpowiedź JSON z fetch_train_route")
+
+# Async version of fetch_carriage_seat_map
+@timed("fetch_carriage_seat_map")
+async def fetch_carriage_seat_map_async(train_category: str, train_number: str, carriage_number: str, carriage_type: str, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str, max_retries: int = 3) -> requests.Response:
+    url = carriage_seat_map_url(train_category, train_number, carriage_number, carriage_type, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2)
+    return await caches["carriage_seat_map"].get_or_load_async(url, lambda: load_carriage_seat_map_async(url, max_retries))
+
+
+# Async version of load_carriage_seat_map
+async def load_carriage_seat_map_async(url: str, max_retries: int) -> requests.Response:
+    last_exception = None
+
+    for attempt in range(max_retries):
+        try:
+            response = await client.request_async("GET", url, headers=HEADERS)
+
+            if response.status_code == 200:
+                return response
+
+            # Retry on 500 errors
+            if response.status_code == 500 and attempt < max_retries - 1:
+                UPSTREAM_RETRIES.inc("carriage_seat_map", "500")
+                await asyncio.sleep(seat_map_retry_delay(attempt))
+                continue
+
+            # Other status codes - raise immediately
+            if response.status_code != 500:
+                raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_carriage_seat_map")
+
+        except (CircuitOpenError, DeadlineExceeded):
+            # Retrying cannot help while the endpoint keeps failing or after the deadline of the request
+            raise
+
+        except Exception as e:
+            last_exception = e
+            if attempt < max_retries - 1:
+                UPSTREAM_RETRIES.inc("carriage_seat_map", type(e).__name__)
+                await asyncio.sleep(seat_map_retry_delay(attempt))
+                continue
+            raise
+
+    # If we exhausted all retries
+    if last_exception:
+        raise last_exception
+    raise ConnectionError(f"Żądanie API zakończone kodem 500 w fetch_carriage_seat_map po {max_retries} próbach")
+
+
+# Async version of fetch_train_route
+@timed("fetch_train_route")
+async def fetch_train_route_async(departure_datetime: str, departure_station_id1: str, arrival_station_id1: str, train_number: str) -> dict:
+    payload = train_route_payload(departure_datetime, departure_station_id1, arrival_station_id1, train_number)
+
+    async def load() -> dict:
+        response = await client.request_async("POST", PASSENGER_API_URL, headers=HEADERS, data=payload)
+        check_response(response, "fetch_train_route", check_access=True)
+        return decode_json(response, "fetch_train_route")
+
+    return await caches["train_route"].get_or_load_async(payload, load)
+
+
+# Search stations by name in the API, returns the raw list of matching stations
+@timed("search_stations")
+def search_stations(query: str) -> list[dict]:
+    def load() -> list[dict]:
+        response = client.request("GET", STATION_SEARCH_URL, headers=HEADERS, params={"q": query})
+        check_response(response, "search_stations")
+        return decode_json(response, "search_stations")
+
+    return caches["station_search"].get_or_load(query, load)
+
+
+# Async version of search_stations
+@timed("search_stations")
+async def search_stations_async(query: str) -> list[dict]:
+    async def load() -> list[dict]:
+        response = await client.request_async("GET", STATION_SEARCH_URL, headers=HEADERS, params={"q": query})
+        check_response(response, "search_stations")
+        return decode_json(response, "search_stations")
+
+    return await caches["station_search"].get_or_load_async(query, load)
+
+
+# Local index of stations, filled from the search results and refreshed in the background
+station_index = StationIndex(search_stations)
 
 
 # Fetch station ids
+@timed("fetch_station_ids")
 def fetch_station_ids(station_name: str) -> tuple[str, str]:
-    url = f"https://www.intercity.pl/station/get/?q={station_name}"
-    payload = {}
-
-    response = requests.get(url, headers=HEADERS, data=payload, impersonate="chrome")
+    station_ids = station_index.lookup(station_name)
+    if station_ids is None:
+        station_index.merge(station_name, search_stations(station_name))
+        station_ids = station_index.lookup(station_name)
 
-    if response.status_code != 200:
-        raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_station_ids")
-    
-    try:
-        for station in response.json():
-            if station["n"].lower() == station_name.lower():
-                return (station["h"], station["e"])
+    if station_ids is None:
         raise ValueError(f"Nie znaleziono stacji {station_name} w fetch_station_ids")
-    except json.JSONDecodeError:
-        raise ValueError("Nieprawidłowa odpowiedź JSON z fetch_station_ids")
-    
+    return station_ids
 
-# Fetch stations
-def fetch_stations(station_name: str) -> list[str]:
-    url = f"https://www.intercity.pl/station/get/?q={station_name}"
-    payload = {}
 
-    response = requests.get(url, headers=HEADERS, data=payload, impersonate="chrome")
+# Async version of fetch_station_ids
+@timed("fetch_station_ids")
+async def fetch_station_ids_async(station_name: str) -> tuple[str, str]:
+    station_ids = station_index.lookup(station_name)
+    if station_ids is None:
+        station_index.merge(station_name, await search_stations_async(station_name))
+        station_ids = station_index.lookup(station_name)
 
-    if response.status_code != 200:
-        raise ConnectionError(f"Żądanie API zakończone kodem {response.status_code} w fetch_stations")
-    
-    try:
-        stations = response.json()
-        station_names = [station["n"] for station in stations if "dowolna" not in station["n"].lower()]
-        station_names.sort(key=lambda s: (not s.lower().startswith(station_name.lower()), s))
-        return station_names
+    if station_ids is None:
+        raise ValueError(f"Nie znaleziono stacji {station_name} w fetch_station_ids")
+    return station_ids
 
-    except json.JSONDecodeError:
-        raise ValueError("Nieprawidłowa odpowiedź JSON z fetch_stations")
\ No newline at end of file
+
+# Fetch stations
+def fetch_stations(station_name: str) -> list[str]:
+    station_name = station_name or ""
+    if not station_index.covers(station_name):
+        station_index.merge(station_name, search_stations(station_name))
+    return station_index.search(station_name)
\ No newline at end of file
@@ -0,0 +1,218 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Hashable
+from .deadline import DeadlineExceeded, check_deadline, current_deadline, remaining_time
+from .shared_cache import SharedStore
+import asyncio
+import os
+import threading
+import time
+
+
+# Time to live (in seconds) and maximum number of entries of each kind of cached API data
+CACHE_SETTINGS = {
+    "carriage_seat_map": (float(os.environ.get("TRICKYTRAIN_CACHE_TTL_SEAT_MAP", "30")), 2000),
+    "train_details": (float(os.environ.get("TRICKYTRAIN_CACHE_TTL_TRAIN_DETAILS", "900")), 1000),
+    "train_route": (float(os.environ.get("TRICKYTRAIN_CACHE_TTL_TRAIN_ROUTE", "3600")), 500),
+    "train_connections": (float(os.environ.get("TRICKYTRAIN_CACHE_TTL_TRAIN_CONNECTIONS", "120")), 500),
+    "station_search": (float(os.environ.get("TRICKYTRAIN_CACHE_TTL_STATION_SEARCH", "3600")), 1000)
+}
+
+# SQLite file of the cache shared by all worker processes, no shared cache if empty
+SHARED_CACHE_PATH = os.environ.get("TRICKYTRAIN_SHARED_CACHE", "")
+
+# Kinds of API data kept in the shared cache, seat maps change too often and are not JSON
+SHARED_KINDS = ("train_details", "train_route", "train_connections", "station_search")
+
+# Errors of loads given up by the caller which started them, the other callers waiting for the key load it themselves
+ABANDONED = (asyncio.CancelledError, DeadlineExceeded)
+
+
+# Size-bounded LRU cache with expiring entries, concurrent loads of the same key share a single call.
+# Loads are coalesced across threads and event loops, failed loads are not cached.
+# With a shared store, values missing locally are looked up there before loading and loaded values are written to it.
+class TTLCache:
+    def __init__(self, name: str, ttl: float, max_entries: int, shared: SharedStore | None = None) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._in_flight = {}  # key -> Future shared by all callers waiting for the key
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    # Get a cached value, returns a tuple of (found, value)
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        with self._lock:
+            return self._get(key)
+
+    # Store a value in the cache, evicting the least recently used entries over the limit
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._set(key, value)
+
+    # Remove all entries from the cache, also from the shared store
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.shared is not None:
+            self.shared.clear(self.name)
+
+    # Get the value from the cache or load it, concurrent callers of the same key wait for one load
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        while True:
+            future, owner = self._claim(key)
+            if owner:
+                return self._run(key, future, loader)
+            try:
+                return future.result(timeout=remaining_time())
+            except ABANDONED:
+                check_deadline()
+            except TimeoutError:
+                if future.done():
+                    raise
+                raise current_deadline.get().error()
+
+    # Async version of get_or_load, the loader returns an awaitable.
+    # The shared store is read and written in a worker thread, a slow or locked store must not stall the other fetches on the event loop.
+    async def get_or_load_async(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            future, owner = self._claim(key)
+            if owner:
+                break
+            # Shielded, a cancelled caller must not cancel the load the other callers wait for.
+            # The failure of the load is marked as retrieved, the cancelled caller no longer awaits it.
+            waiter = asyncio.wrap_future(future)
+            waiter.add_done_callback(lambda waiter: waiter.cancelled() or waiter.exception())
+            try:
+                return await asyncio.shield(waiter)
+            except ABANDONED:
+                # Raised by the load of the other caller, not by the cancellation of this one
+                if not future.done() or future.cancelled() or not isinstance(future.exception(), ABANDONED):
+                    raise
+                check_deadline()
+
+        shared = self.shared is not None and self.ttl > 0
+        try:
+            found, value = await asyncio.to_thread(self._get_shared, key) if shared else (False, None)
+            if not found:
+                value = await loader()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, value=value)
+        if shared and not found:
+            await asyncio.to_thread(self._set_shared, key, value)
+        return value
+
+    # Counters of the cache
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ttl": self.ttl,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "shared_hits": self.shared_hits
+            }
+
+    # Return a resolved future on hit, the in-flight future of another caller, or a new future owned by the caller
+    def _claim(self, key: Hashable) -> tuple[Future, bool]:
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                future = Future()
+                future.set_result(value)
+                return future, False
+
+            if key in self._in_flight:
+                self.coalesced += 1
+                return self._in_flight[key], False
+
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _run(self, key: Hashable, future: Future, loader: Callable[[], Any]) -> Any:
+        try:
+            found, value = self._get_shared(key)
+            if not found:
+                value = loader()
+                self._set_shared(key, value)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, value=value)
+        return value
+
+    def _finish(self, key: Hashable, future: Future, value: Any = None, exception: BaseException | None = None) -> None:
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if exception is None:
+                self._set(key, value)
+
+        if exception is None:
+            future.set_result(value)
+        else:
+            future.set_exception(exception)
+
+    # Look the key up in the shared store, errors of the store count as a miss
+    def _get_shared(self, key: Hashable) -> tuple[bool, Any]:
+        if self.shared is None or self.ttl <= 0:
+            return False, None
+        try:
+            found, value = self.shared.get(self.name, str(key))
+        except Exception as e:
+            print(e)
+            return False, None
+        if found:
+            with self._lock:
+                self.shared_hits += 1
+        return found, value
+
+    def _set_shared(self, key: Hashable, value: Any) -> None:
+        if self.shared is None or self.ttl <= 0:
+            return
+        try:
+            self.shared.set(self.name, str(key), value, self.ttl)
+        except Exception as e:
+            print(e)
+
+    def _get(self, key: Hashable) -> tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def _set(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+shared_store = SharedStore(SHARED_CACHE_PATH) if SHARED_CACHE_PATH else None
+
+caches = {name: TTLCache(name, ttl, max_entries, shared_store if name in SHARED_KINDS else None) for name, (ttl, max_entries) in CACHE_SETTINGS.items()}
+
+
+# Counters of all API caches
+def cache_stats() -> dict[str, dict]:
+    return {name: cache.stats() for name, cache in caches.items()}
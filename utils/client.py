@@ -0,0 +1,312 @@
+from curl_cffi import requests
+from curl_cffi.requests import AsyncSession
+from contextlib import contextmanager
+from typing import Any, Coroutine, Iterator
+from urllib.parse import urlsplit
+from .deadline import check_deadline, current_deadline
+from .limiter import PRIORITY_BACKGROUND, upstream_limiter
+from .metrics import UPSTREAM_HEDGES, UPSTREAM_REJECTED, observe_upstream
+from .resilience import HEDGE_REQUESTS, CLOSED, CircuitBreaker, CircuitOpenError, get_breaker, get_hedge_policy
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import queue
+import re
+import threading
+import time
+
+
+# Maximum number of open connections kept per upstream host
+POOL_SIZE = int(os.environ.get("TRICKYTRAIN_POOL_SIZE", "10"))
+
+IMPERSONATE = "chrome"
+
+# Timeout (in seconds) of a single upstream request, the default of the sessions
+UPSTREAM_TIMEOUT = 30
+
+_ACCESS_DENIED = re.compile("access denied", re.IGNORECASE)
+
+# Metric names of the upstream endpoints by a fragment of their URL
+_ENDPOINTS = (
+    ("/grm/sklad/", "train_details"),
+    ("/grm/wagon/svg/", "carriage_seat_map"),
+    ("/endpoint/Pociagi", "passenger_api"),
+    ("/station/get", "station_search")
+)
+
+
+# Check if the API signals that it is overloaded
+def is_overloaded(response: requests.Response) -> bool:
+    return response.status_code == 500 or _ACCESS_DENIED.search(response.text) is not None
+
+
+# Check if a request failed because the API is overloaded: it timed out. Other errors (DNS, refused connections, local bugs)
+# say nothing about the load of the API and leave the limit of concurrent requests unchanged.
+def is_overload_error(error: BaseException) -> bool:
+    return isinstance(error, requests.exceptions.Timeout)
+
+
+# Check if the response counts as a failure of the endpoint for its circuit breaker
+def is_failure(response: requests.Response) -> bool:
+    return response.status_code >= 500 or _ACCESS_DENIED.search(response.text) is not None
+
+
+# Name of the upstream endpoint of the URL used in the metrics
+def endpoint_name(url: str) -> str:
+    for fragment, name in _ENDPOINTS:
+        if fragment in url:
+            return name
+    return "other"
+
+
+# Status label of the response in the metrics, "access_denied" for the access denied page
+def status_label(response: requests.Response) -> str:
+    if response.status_code != 500 and _ACCESS_DENIED.search(response.text) is not None:
+        return "access_denied"
+    return str(response.status_code)
+
+
+# Thread-safe pool of long-lived sessions to a single host, sessions keep their connections alive between requests
+class SessionPool:
+    def __init__(self, size: int = POOL_SIZE) -> None:
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    # Borrow a session from the pool, waits if all sessions are in use
+    @contextmanager
+    def session(self) -> Iterator[requests.Session]:
+        session = self._acquire()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def _acquire(self) -> requests.Session:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                return requests.Session(impersonate=IMPERSONATE)
+
+        return self._idle.get()
+
+
+_pools = {}
+_async_sessions = {}
+_pools_lock = threading.Lock()
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# Get the session pool of the host of the given URL
+def get_pool(url: str) -> SessionPool:
+    host = urlsplit(url).netloc
+    with _pools_lock:
+        if host not in _pools:
+            _pools[host] = SessionPool()
+        return _pools[host]
+
+
+# Get the circuit breaker of the endpoint, raises CircuitOpenError when the endpoint is failing and requests are not sent
+def check_circuit(endpoint: str) -> CircuitBreaker:
+    breaker = get_breaker(endpoint)
+    if not breaker.allow():
+        UPSTREAM_REJECTED.inc(endpoint)
+        raise CircuitOpenError(f"API PKP Intercity ({endpoint}) zwraca błędy, spróbuj ponownie za {breaker.retry_after():.0f} s")
+    return breaker
+
+
+# Delay after which a request to the endpoint is sent a second time, None if it should not be hedged.
+# Requests are not hedged while the circuit is not closed or calls are queued at the limiter, a hedge would only delay them.
+def hedge_delay(endpoint: str, breaker: CircuitBreaker) -> float | None:
+    if not HEDGE_REQUESTS or breaker.state != CLOSED or upstream_limiter.waiting(PRIORITY_BACKGROUND) > 0:
+        return None
+    return get_hedge_policy(endpoint).delay()
+
+
+# Limit the timeout of a request to the time left until the deadline of the request of the user
+def with_deadline(kwargs: dict) -> dict:
+    deadline = current_deadline.get()
+    if deadline is None:
+        return kwargs
+    deadline.check()
+    return {**kwargs, "timeout": min(kwargs.get("timeout", UPSTREAM_TIMEOUT), deadline.remaining())}
+
+
+# Send a request through the shared session pool of the URL's host, waiting for a slot of the upstream limiter.
+# Requests slower than usual are hedged on the shared event loop, where the slower copy can be cancelled.
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    check_deadline()
+    endpoint = endpoint_name(url)
+    breaker = check_circuit(endpoint)
+    delay = hedge_delay(endpoint, breaker)
+    if delay is not None:
+        return run_async(request_hedged_async(endpoint, breaker, delay, method, url, **kwargs))
+
+    queued = time.perf_counter()
+    with upstream_limiter.slot() as outcome:
+        started = time.perf_counter()
+        status = "error"
+        failed = True
+        try:
+            with get_pool(url).session() as session:
+                response = session.request(method, url, **with_deadline(kwargs))
+            status = status_label(response)
+            failed = is_failure(response)
+        except Exception as e:
+            # The request was cut off by the deadline of the user's request, it says nothing about the API
+            deadline = current_deadline.get()
+            if deadline is not None and deadline.expired():
+                status = "cancelled"
+                failed = None
+                raise deadline.error() from e
+            if is_overload_error(e):
+                outcome[0] = False
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            observe_upstream(endpoint, status, started - queued, seconds)
+            breaker.record(None if failed is None else not failed)
+        get_hedge_policy(endpoint).observe(seconds)
+        outcome[0] = not is_overloaded(response)
+        return response
+
+
+# Get the async session of the host of the given URL. The sessions are bound to the shared event loop, which runs for the life of the process,
+# so there is one session per host; async requests from any other loop would use sessions of a loop that is not running them.
+def get_async_session(url: str) -> AsyncSession:
+    if asyncio.get_running_loop() is not _loop:
+        raise RuntimeError("Asynchroniczne zapytania do API PKP Intercity muszą działać we wspólnej pętli zdarzeń, użyj run_async")
+    host = urlsplit(url).netloc
+    with _pools_lock:
+        if host not in _async_sessions:
+            _async_sessions[host] = AsyncSession(impersonate=IMPERSONATE, max_clients=POOL_SIZE)
+        return _async_sessions[host]
+
+
+# Send a request through the async session of the URL's host, waiting for a slot of the upstream limiter
+async def request_async(method: str, url: str, **kwargs) -> requests.Response:
+    check_deadline()
+    endpoint = endpoint_name(url)
+    breaker = check_circuit(endpoint)
+    delay = hedge_delay(endpoint, breaker)
+    if delay is not None:
+        return await request_hedged_async(endpoint, breaker, delay, method, url, **kwargs)
+    return await send_async(endpoint, breaker, method, url, **kwargs)
+
+
+# Send a single request allowed by the circuit breaker and record its outcome
+async def send_async(endpoint: str, breaker: CircuitBreaker, method: str, url: str, **kwargs) -> requests.Response:
+    queued = time.perf_counter()
+    async with upstream_limiter.slot_async() as outcome:
+        started = time.perf_counter()
+        status = "error"
+        failed = True
+        try:
+            response = await get_async_session(url).request(method, url, **kwargs)
+            status = status_label(response)
+            failed = is_failure(response)
+        except asyncio.CancelledError:
+            # The other copy of a hedged request won, the cancelled one says nothing about the API
+            status = "cancelled"
+            failed = None
+            raise
+        except Exception as e:
+            if is_overload_error(e):
+                outcome[0] = False
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            observe_upstream(endpoint, status, started - queued, seconds)
+            breaker.record(None if failed is None else not failed)
+        get_hedge_policy(endpoint).observe(seconds)
+        outcome[0] = not is_overloaded(response)
+        return response
+
+
+# Check if a finished copy of a hedged request returned a usable response
+def succeeded(task: asyncio.Task) -> bool:
+    return task.exception() is None and not is_failure(task.result())
+
+
+# Send a request and, if it has not finished after the delay, send it a second time.
+# The first usable response is returned and the other copy is cancelled.
+async def request_hedged_async(endpoint: str, breaker: CircuitBreaker, delay: float, method: str, url: str, **kwargs) -> requests.Response:
+    primary = asyncio.ensure_future(send_async(endpoint, breaker, method, url, **kwargs))
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done or not get_hedge_policy(endpoint).spend():
+            return await primary
+
+        UPSTREAM_HEDGES.inc(endpoint, "sent")
+        hedge = asyncio.ensure_future(send_async(endpoint, breaker, method, url, **kwargs))
+        pending = {primary, hedge}
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            usable = [task for task in done if succeeded(task)]
+            if usable or not pending:
+                task = usable[0] if usable else done.pop()
+                UPSTREAM_HEDGES.inc(endpoint, "hedge_won" if task is hedge else "primary_won")
+                return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Get the shared event loop running in a background thread, starts it on first use
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="upstream-event-loop", daemon=True).start()
+        return _loop
+
+
+# Run a coroutine on the shared event loop and wait for its result, must not be called from the loop itself.
+# The coroutine runs with a copy of the caller's context, so the user and priority of the calls are preserved.
+# When the deadline of the request passes or the request is cancelled, the coroutine is cancelled with all its queued and in-flight calls.
+def run_async(coroutine: Coroutine[Any, Any, Any]) -> Any:
+    loop = get_event_loop()
+    context = contextvars.copy_context()
+    future = concurrent.futures.Future()
+    tasks = []
+
+    def copy_result(task: asyncio.Task) -> None:
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start() -> None:
+        task = context.run(loop.create_task, coroutine)
+        task.add_done_callback(copy_result)
+        tasks.append(task)
+
+    def cancel() -> None:
+        for task in tasks:
+            task.cancel()
+
+    loop.call_soon_threadsafe(start)
+    deadline = current_deadline.get()
+    if deadline is None:
+        return future.result()
+
+    with deadline.on_cancel(lambda: loop.call_soon_threadsafe(cancel)):
+        done, _ = concurrent.futures.wait([future], timeout=deadline.remaining())
+    if not done:
+        loop.call_soon_threadsafe(cancel)
+        raise deadline.error()
+    if future.cancelled():
+        raise deadline.error()
+    return future.result()
@@ -1,18 +1,34 @@
-from utils import fetch_station_ids, fetch_train_connections, fetch_train_details, fetch_carriage_seat_map, fetch_train_route
-import xml.etree.ElementTree as ET
-from collections import deque
-from datetime import datetime
+from utils import fetch_station_ids, fetch_station_ids_async, fetch_train_connections, fetch_train_connections_async, fetch_train_details, fetch_train_details_async, fetch_carriage_seat_map_async, fetch_train_route
+from utils.client import run_async
+from utils.deadline import Deadline, DeadlineExceeded, current_deadline
+from utils.metrics import TIMETABLE_SEARCHES, TRANSFER_SEARCH_STOPS, span, timed
+from typing import Callable, Iterator
+from utils.transfers import ProbeMemo, SearchBudget, count_binary_search_calls, plan_fewest_seat_changes
+from utils.seatmap import CarriageSeats, count_seats, intersect_segments
+from utils.svg_parser import parse_seat_map
+from utils.layouts import layout_store
+from utils.models import Segment, SeatMap, Stop, Train, seat_result
+from utils.timetable import MAX_JOURNEYS, TRANSFER_HUBS, find_journeys, timetable
+from datetime import datetime, timedelta
+import asyncio
 import concurrent.futures
-import re
-import time
+import contextvars
+import queue
+import threading
 
 
-# Format datetime string into a compact format (YYYYMMDDHHMM)
-def format_datetime_compact(datetime_str: str) -> str:
-    try:
-        return datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M")
-    except ValueError:
-        raise ValueError(f"Invalid datetime format: {datetime_str}")
+# Number of route segments fetched concurrently in the segment transfer mode
+SEGMENT_WORKERS = 3
+
+# Number of trains whose seats are counted concurrently in the batch seat count
+BATCH_TRAIN_WORKERS = 3
+
+# Number of connection searches run concurrently when the timetable is filled for a journey search
+TIMETABLE_WORKERS = 3
+
+# Maximum number of days of a range search and the number of days searched concurrently
+MAX_RANGE_DAYS = 14
+RANGE_DAY_WORKERS = 4
 
 
 # Extract carriage type from the train details, return a dictionary of carriage numbers with their types
@@ -31,64 +47,29 @@ def get_intercity_link(date: str, departure_station_id1: str, arrival_station_id
     return f"https://ebilet.intercity.pl/wyszukiwanie?dwyj={date}&swyj={departure_station_id1}&sprzy={arrival_station_id1}&polbez=1&time={time}&ticket100={ticket}"
 
 
-# Parse the available seats from an SVG carriage seat map, return a dictionary of available seats with their types
-def parse_available_seats(carriage_seats: str) -> dict[str, str]:
-    root = ET.fromstring(carriage_seats)
-
-    namespace = {
-        "svg": "http://www.w3.org/2000/svg",
-        "eic": "http://www.intercity.pl/eic"
-    }
-
-    seats = root.findall(".//svg:g", namespace) # Find all seats
+# Booking link of a leg between two stops of the train route
+def leg_link(start: Stop, end: Stop) -> str:
+    return get_intercity_link(start.departure_datatime[:10], fetch_station_ids(start.station_name)[0], fetch_station_ids(end.station_name)[0], start.departure_datatime[11:])
 
-    available_seats = {}
-    for seat in seats:
-        seat_class = seat.get("data-class") # Get the seat class
-        if seat_class == "" or seat_class is None:
-            continue
-        seat_number = seat.find(".//svg:text", namespace).text.strip() # Get the seat number
-        seat_status = seat.find(".//svg:image", namespace).get("status") # Get the seat status (0 - occupied, 1 - available)
-        is_special = seat.find(".//eic:special", namespace) # Check if the seat is special (bike, quiet zone)
 
-        if seat_class == "first class":
-            continue
-
-        if is_special is not None:
-            is_special = is_special.get("ref")
-
-        if seat_status == "1" and (is_special in [None, "1", "7"]):
-            available_seats[seat_number] = "normal_seat"
-            if is_special == "1":
-                available_seats[seat_number] = "bike_seat"
-            if is_special == "7":
-                available_seats[seat_number] = "quiet_zone_seat"
-
-    return available_seats
-
-
-# Retrieves train connections between the specified departure and arrival stations for a given date and time
-def get_trains(departure_station: str, arrival_station: str, input_date: str, input_time: str) -> tuple:
-    # Validate input date and time
+# Start of a search: the given date and time, or now if they are in the past
+def search_start(input_date: str, input_time: str) -> datetime:
     input_datetime = datetime.strptime(f"{input_date} {input_time}", "%Y-%m-%d %H:%M")
-    current_datetime = datetime.now()
-    if input_datetime < current_datetime:
-        input_datetime = current_datetime
-    input_date = input_datetime.strftime("%Y-%m-%d")
-    input_time = input_datetime.strftime("%H:%M")
+    return max(input_datetime, datetime.now())
 
-    # Get station IDs for the departure and arrival stations
+
+# Resolve the IDs of the departure and arrival stations, returns the station data or a dictionary with the error
+def resolve_stations(departure_station: str, arrival_station: str) -> dict:
     departure_station_data = fetch_station_ids(departure_station)
     if departure_station_data is None:
-        return {"error": "Nie znaleziono stacji odjadu w bazie danych"}, {}
+        return {"error": "Nie znaleziono stacji odjadu w bazie danych"}
     departure_station_id1, departure_station_id2 = departure_station_data
     arrival_station_data = fetch_station_ids(arrival_station)
     if arrival_station_data is None:
-        return {"error": "Nie znaleziono stacji przyjazdu w bazie danych"}, {}
+        return {"error": "Nie znaleziono stacji przyjazdu w bazie danych"}
     arrival_station_id1, arrival_station_id2 = arrival_station_data
 
-    # Store the station data in a dictionary
-    stations = {
+    return {
         "departure_station": departure_station,
         "departure_station_id1": departure_station_id1,
         "departure_station_id2": departure_station_id2,
@@ -97,83 +78,149 @@ def get_trains(departure_station: str, arrival_station: str, input_date: str, in
         "arrival_station_id2": arrival_station_id2
     }
 
-    # Fetch train connections between the departure and arrival stations and filter out trains that depart on or after the specified input time
-    trains = fetch_train_connections(input_date, departure_station_id1, arrival_station_id1).get("polaczenia")
-    trains = [t for t in trains if datetime.strptime(t["dataWyjazdu"], "%Y-%m-%d %H:%M:%S").time() >= datetime.strptime(input_time, "%H:%M").time()]
-    if trains == []:
-        return {"error": "Nie znaleziono bezpośrednich połączeń"}, stations
-
-    result = []
-
-    # Extract train details
-    for train in trains:
-        train_name = train.get("pociagi")[0].get("nazwaPociagu")
-        train_number = train.get("pociagi")[0].get("nrPociagu")
-        train_category = train.get("pociagi")[0].get("kategoriaPociagu")
-        travel_time = train.get("pociagi")[0].get("czasJazdy")
-        departure_datetime = train.get("dataWyjazdu")
-        arrival_datetime = train.get("dataPrzyjazdu")
-
-        result.append({
-            "train_name": train_name,
-            "train_number": train_number,
-            "train_category": train_category,
-            "travel_time": travel_time,
-            "departure_datetime": departure_datetime,
-            "arrival_datetime": arrival_datetime
-        })
-
-    return result, stations
 
+# Retrieves train connections between the specified departure and arrival stations for a given date and time.
+# With an end date, searches every day of the range and keeps the trains departing between the start and end time of each day.
+@timed()
+def get_trains(departure_station: str, arrival_station: str, input_date: str, input_time: str, end_date: str | None = None, end_time: str | None = None) -> tuple:
+    window = (input_date, input_time, end_date, end_time or "23:59")
 
-# Clean the SVG text by removing any script tags
-def clean_svg(svg_text: str) -> str:
-    svg_text = re.sub(r"<script.*?</script>", "", svg_text, flags=re.DOTALL)
-    return svg_text
-
-
-# Fetch and parse the seat map of a specific carriage on a train, returns the carriage number, SVG seat map of carriage, and a dictionary of available seats with their types
-def fetch_and_parse_seat_map(carriage_number: str, carriage_type: str, train_category: str, train_number: str, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str, delay: float = 0) -> tuple:
-    # Add small delay to avoid overwhelming the API
-    if delay > 0:
-        time.sleep(delay)
-
-    response = fetch_carriage_seat_map(train_category, train_number, carriage_number, carriage_type, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2)
-
-    svg_text = response.text
-    available_seats = parse_available_seats(svg_text)
+    # Validate input date and time
+    input_datetime = search_start(input_date, input_time)
+    input_date = input_datetime.strftime("%Y-%m-%d")
+    input_time = input_datetime.strftime("%H:%M")
 
-    return carriage_number, svg_text, available_seats
+    # Get station IDs for the departure and arrival stations
+    stations = resolve_stations(departure_station, arrival_station)
+    if "error" in stations:
+        return stations, {}
+
+    if end_date:
+        try:
+            result = list(iter_trains_range(stations, *window))
+        except ValueError as e:
+            return {"error": str(e)}, stations
+        if result == []:
+            return {"error": "Nie znaleziono bezpośrednich połączeń w wybranym okresie"}, stations
+        return result, stations
 
+    # Fetch train connections between the departure and arrival stations and filter out trains that depart on or after the specified input time
+    trains = [Train.from_connection(connection) for connection in fetch_train_connections(input_date, stations["departure_station_id1"], stations["arrival_station_id1"]).get("polaczenia")]
+    add_connections(input_date, departure_station, arrival_station, trains)
+    start_time = input_datetime.time()
+    trains = [train for train in trains if train.departure.time() >= start_time]
+    if trains == []:
+        return {"error": "Nie znaleziono bezpośrednich połączeń"}, stations
 
-# Process the train data by fetching and parsing the seat maps of all carriages on the train, returns a dictionary of carriage numbers with their SVG seat maps, a dictionary of carriage numbers with their dictionary of available seats, and the total number of available seats
-def process_train_data(train_category: str, train_number: str, carriages_types: dict, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str) -> tuple:
+    return trains, stations
+
+
+# Yields the trains between the resolved stations departing in the time window of every day from the start to the end date, in chronological order.
+# All days are fetched concurrently, the trains of a day are yielded as soon as the day and all days before it are fetched.
+# A window ending before it starts (e.g. 22:00 - 02:00) spans midnight. Connections found on two days are yielded once.
+def iter_trains_range(stations: dict, start_date: str, start_time: str, end_date: str, end_time: str) -> Iterator[Train]:
+    start = search_start(start_date, start_time)
+    first_day = start.date()
+    last_day = datetime.strptime(end_date, "%Y-%m-%d").date()
+    window_start, window_end = datetime.strptime(start_time, "%H:%M").strftime("%H:%M"), datetime.strptime(end_time, "%H:%M").strftime("%H:%M")
+    if last_day < first_day:
+        raise ValueError("Data końcowa nie może być wcześniejsza niż data początkowa")
+    if (last_day - first_day).days + 1 > MAX_RANGE_DAYS:
+        raise ValueError(f"Można wyszukać połączenia z najwyżej {MAX_RANGE_DAYS} dni")
+    days = [(first_day + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range((last_day - first_day).days + 1)]
+
+    # Keep the trains of each day departing in the window and not before the start of the search
+    def in_window(train: Train) -> bool:
+        departure = train.departure_time
+        if train.departure < start.replace(second=0, microsecond=0):
+            return False
+        if window_start <= window_end:
+            return window_start <= departure <= window_end
+        return departure >= window_start or departure <= window_end
+
+    async def fetch_all(emit: Callable[[dict], None]) -> None:
+        semaphore = asyncio.Semaphore(RANGE_DAY_WORKERS)
+
+        async def fetch(date: str) -> None:
+            async with semaphore:
+                connections = (await fetch_train_connections_async(date, stations["departure_station_id1"], stations["arrival_station_id1"])).get("polaczenia") or []
+            trains = [Train.from_connection(connection) for connection in connections]
+            add_connections(date, stations["departure_station"], stations["arrival_station"], trains)
+            emit({"type": "day", "date": date, "trains": trains})
+
+        await asyncio.gather(*(fetch(date) for date in days))
+
+    def run(emit: Callable[[dict], None]) -> None:
+        try:
+            run_async(fetch_all(emit))
+            emit({"type": "done"})
+        except Exception as e:
+            print(e)
+            emit({"type": "error", "message": str(e)})
+
+    # Hold the days fetched early until the days before them are fetched
+    fetched = {}
+    seen = set()
+    next_day = 0
+    for event in iterate_events(run):
+        if event["type"] == "error":
+            raise ValueError(event["message"])
+        if event["type"] == "done":
+            return
+        fetched[event["date"]] = event["trains"]
+        while next_day < len(days) and days[next_day] in fetched:
+            trains = sorted(fetched.pop(days[next_day]), key=lambda train: train.departure)
+            next_day += 1
+            for train in trains:
+                key = (train.train_number, train.departure)
+                if key in seen or not in_window(train):
+                    continue
+                seen.add(key)
+                yield train
+
+
+# Fetch and parse the seat map of a specific carriage on a train, returns the carriage number, the id of the carriage layout template, and the available seats of the carriage
+async def fetch_and_parse_seat_map(carriage_number: str, carriage_type: str, train_category: str, train_number: str, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str) -> SeatMap:
+    response = await fetch_carriage_seat_map_async(train_category, train_number, carriage_number, carriage_type, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2)
+
+    # Parse the seats and strip the scripts in one go, the geometry of the carriage is stored once per layout
+    with span("parse_seat_map"):
+        svg_text, available_seats = parse_seat_map(response.text)
+        layout_id = layout_store.register(carriage_type, available_seats.index, svg_text)
+
+    return SeatMap(carriage_number, layout_id, available_seats)
+
+
+# Async version of process_train_data, fetches the seat maps of all carriages concurrently on the running event loop.
+# The pace of the requests is set by the shared upstream limiter.
+# Each parsed carriage is passed to on_carriage as soon as it arrives.
+# When one fetch fails or the search is cancelled, the fetches of the other carriages are cancelled too.
+@timed("process_train_data")
+async def process_train_data_async(train_category: str, train_number: str, carriages_types: dict, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str, on_carriage: Callable[[str, str, CarriageSeats], None] | None = None) -> tuple:
     carrige_svgs = {}
     all_available_seats = {}
 
-    num_carriages = len(carriages_types)
+    tasks = [
+        asyncio.ensure_future(fetch_and_parse_seat_map(carriage_number, carriage_type, train_category, train_number, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2))
+        for carriage_number, carriage_type in carriages_types.items()
+    ]
 
-    # Fetch and parse the seat maps of all carriages concurrently
-    with concurrent.futures.ThreadPoolExecutor(max_workers=min(num_carriages, 5)) as executor:
-        future_to_carriage = {}
-        for i, (carriage_number, carriage_type) in enumerate(carriages_types.items()):
-            # Stagger requests with 0.1s delay between each
-            delay = i * 0.1
-            future = executor.submit(fetch_and_parse_seat_map, carriage_number, carriage_type,
-                                   train_category, train_number, departure_datetime, arrival_datetime,
-                                   departure_station_id2, arrival_station_id2, delay)
-            future_to_carriage[future] = carriage_number
+    # Process the results
+    try:
+        for task in asyncio.as_completed(tasks):
+            seat_map = await task
 
-        # Process the results
-        for future in concurrent.futures.as_completed(future_to_carriage):
-            carriage_number, svg_text, available_seats = future.result()
+            if seat_map.layout_id:
+                carrige_svgs[seat_map.carriage_number] = seat_map.layout_id
+            all_available_seats[seat_map.carriage_number] = seat_map.seats
 
-            if svg_text:
-                cleaned_svg = clean_svg(svg_text)
-                carrige_svgs[carriage_number] = cleaned_svg
-            all_available_seats[carriage_number] = available_seats
+            if on_carriage is not None:
+                on_carriage(seat_map.carriage_number, seat_map.layout_id or None, seat_map.seats)
+    finally:
+        for task in tasks:
+            task.cancel()
 
-    seat_count = sum(len(seats) for seats in all_available_seats.values())
+    seat_count = count_seats(all_available_seats)
 
     # Sort the dictionaries by carriage number
     all_available_seats = dict(sorted(all_available_seats.items(), key=lambda x: int(x[0])))
@@ -182,210 +229,517 @@ def process_train_data(train_category: str, train_number: str, carriages_types:
     return carrige_svgs, all_available_seats, seat_count
 
 
-# Searches for seat transfers on a specific train route using binary search, returns the train data with available seats, svg seat maps, and booking links
-def get_seat_transfers(stations, train_category, train_number, train_name, departure_datetime, arrival_datetime):
-    start, end = stations[0], stations[-1]
-    path, available_seats, svgs, links = [start], [], [], []
-    
-    current_station = start
+# Process the train data by fetching and parsing the seat maps of all carriages on the train, returns a dictionary of carriage numbers with the ids of their layout templates, a dictionary of carriage numbers with their available seats, and the total number of available seats
+def process_train_data(train_category: str, train_number: str, carriages_types: dict, departure_datetime: str, arrival_datetime: str, departure_station_id2: str, arrival_station_id2: str, on_carriage: Callable[[str, str, CarriageSeats], None] | None = None) -> tuple:
+    return run_async(process_train_data_async(train_category, train_number, carriages_types, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2, on_carriage))
+
+
+# Build the event sent to the on_event callback when a seat transfer leg is confirmed
+def leg_event(index: int, start: Stop, end: Stop, available_seats: dict[str, CarriageSeats], carrige_svgs: dict, link: str) -> dict:
+    return {
+        "type": "leg",
+        "index": index,
+        "departure_station": start,
+        "arrival_station": end,
+        "available_seats": available_seats,
+        "carrige_svgs": carrige_svgs,
+        "link": link
+    }
+
+
+# Searches for seat transfers on a specific train route using binary search, returns the train data with available seats, carriage layout ids, and booking links.
+# Probe results are memoized per span of the route and spans whose result is implied by earlier probes are not fetched, spans already checked by the caller can be passed in known_spans.
+# When the budget of upstream calls or time runs out, the legs found so far are returned with the "partial_transfer" status,
+# when the deadline of the request passes, with the "timed_out" status.
+def get_seat_transfers(stations: list[Stop], train: Train, on_event: Callable[[dict], None] | None = None, known_spans: dict | None = None, budget: SearchBudget | None = None) -> dict:
+    memo = ProbeMemo(known_spans)
+    budget = budget or SearchBudget()
+    path, available_seats, svgs, links = [stations[0]], [], [], []
+    last_index = len(stations) - 1
+    exhausted = False
+    timed_out = False
+
+    # Fetch the seats of a span and remember them, returns False if the budget or the deadline does not allow it
+    def probe(key: tuple[int, int]) -> bool:
+        nonlocal timed_out
+        if budget.exhausted():
+            return False
+        try:
+            with span("transfer_probe"):
+                carrige_svgs, all_available_seats, calls = fetch_segment_seats(Segment(stations[key[0]], stations[key[1]]), train)
+        except DeadlineExceeded as e:
+            print(e)
+            timed_out = True
+            return False
+        budget.charge(calls)
+        memo.add(key, None if all_available_seats is None else (carrige_svgs, all_available_seats, count_seats(all_available_seats)))
+        return True
+
     current_index = 0
-    
-    while current_station != end:
-        left, right = current_index + 1, len(stations) - 1
+    while current_index != last_index and not exhausted:
+        left, right = current_index + 1, last_index
         best_next = None
-        best_available_seats = None
-        best_carriage_svgs = None
-        best_link = None
 
         # Perform binary search to find the next best station with available seats
         while left <= right:
             mid = (left + right) // 2
-            middle_station = stations[mid]
-
-            current_station_name = current_station["station_name"]
-            middle_station_name = middle_station["station_name"]
-            current_station_data = fetch_station_ids(current_station_name)
-            middle_station_data = fetch_station_ids(middle_station_name)
-            if current_station_data is None or middle_station_data is None:
-                raise ValueError(f"Nie znaleziono stacji {current_station_name} lub {middle_station_name}")
-
-            current_station_id2 = current_station_data[1]
-            middle_station_id2 = middle_station_data[1]
-            
-            current_departure_datetime = current_station["departure_datatime"]
-            current_departure_datetime_compact = format_datetime_compact(current_departure_datetime)
-            middle_arrival_datetime_compact = format_datetime_compact(middle_station["arrival_datatime"])
-
-            train_info = fetch_train_details(train_category, train_number, current_departure_datetime_compact, current_station_id2, middle_arrival_datetime_compact, middle_station_id2)
-            
-            # If the connection is not found, continue searching in the left half
-            if "statusCode" in train_info and train_info["statusCode"] == 404:
-                right = mid - 1
-                continue
-            
-            carriages_types = extract_carriage_type(train_info)
-            carrige_svgs, all_available_seats, seat_count = process_train_data(train_category, train_number, carriages_types, current_departure_datetime_compact, middle_arrival_datetime_compact, current_station_id2, middle_station_id2)
-            
-            print(f"{current_station_name} -> {middle_station_name} ({seat_count})")
-
-            # If seats are available, update the best next station and continue searching in the right half
-            if seat_count > 0:
+            key = (current_index, mid)
+
+            if key in memo:
+                result = memo.get(key)
+                has_seats = result is not None and result[2] > 0
+            elif (implied := memo.implied(key)) is not None:
+                has_seats = implied
+            elif probe(key):
+                result = memo.get(key)
+                has_seats = result is not None and result[2] > 0
+            else:
+                exhausted = True
+                break
+
+            # If seats are available, update the best next station and continue searching in the right half, otherwise in the left half
+            if has_seats:
                 best_next = mid
-                best_available_seats = all_available_seats
-                best_carriage_svgs = carrige_svgs
-                best_link = get_intercity_link(current_departure_datetime.split(" ")[0], current_station_data[0], middle_station_data[0], current_departure_datetime.split(" ")[1])
                 left = mid + 1
             else:
-                # If seats are not available, continue searching in the left half
                 right = mid - 1
 
         if best_next is None:
             break
 
+        # The seats of the best span may be only implied, fetch them to show the seat maps
+        key = (current_index, best_next)
+        if key not in memo and not probe(key):
+            exhausted = True
+            break
+        if memo.get(key) is None or memo.get(key)[2] == 0:
+            break
+        carrige_svgs, all_available_seats, _ = memo.get(key)
+
         # Update informations and move to the next station
-        next_station = stations[best_next]
+        current_station, next_station = stations[current_index], stations[best_next]
+        link = leg_link(current_station, next_station)
         path.append(next_station)
-        available_seats.append(best_available_seats)
-        svgs.append(best_carriage_svgs)
-        links.append(best_link)
-        
-        current_station = next_station
+        available_seats.append(all_available_seats)
+        svgs.append(carrige_svgs)
+        links.append(link)
+
+        if on_event is not None:
+            on_event(leg_event(len(links) - 1, current_station, next_station, all_available_seats, carrige_svgs, link))
+
         current_index = best_next
 
+    if exhausted:
+        TRANSFER_SEARCH_STOPS.inc("binary", "deadline" if timed_out else "budget")
+
     # Check if departure station is in the the path
-    success = end in path
+    success = current_index == last_index
+    status = "seat_transfer" if success else "timed_out" if timed_out else "partial_transfer" if exhausted and links else "no_seats"
+    keep = status != "no_seats" and len(links) > 0
+
+    if not keep:
+        return seat_result(train, status, upstream_calls=budget.calls)
+    return seat_result(train, status, path, available_seats, svgs, links, upstream_calls=budget.calls)
 
-    return {
-        "train_name": train_name,
-        "train_number": train_number,
-        "train_category": train_category,
-        "departure_datetime": departure_datetime,
-        "arrival_datetime": arrival_datetime,
-        "status": "seat_transfer" if success else "no_seats",
-        "stations": path if success else [],
-        "available_seats": available_seats if success else [],
-        "carrige_svgs": svgs if success else [],
-        "links": links if success else []
-    }
 
+# Fetch the seat availability between two stations of the route, returns the carriage layout ids, the available seats and the number of upstream calls made
+@timed()
+def fetch_segment_seats(segment: Segment, train: Train) -> tuple:
+    start_station_id2 = fetch_station_ids(segment.start.station_name)[1]
+    end_station_id2 = fetch_station_ids(segment.end.station_name)[1]
 
-# Retrieve the seat availability for a specific train, returns the train data with available seats, svg seat maps, and booking links
-def get_seat_availability(train: dict, stations: dict) -> dict:
-    # Extract train details
-    train_category = train.get("train_category")
-    train_number = train.get("train_number")
-    train_name = train.get("train_name")
-    departure_datetime = train.get("departure_datetime")
-    departure_datetime_compact =  format_datetime_compact(departure_datetime)
-    arrival_datetime = train.get("arrival_datetime")
-    arrival_datetime_compact =  format_datetime_compact(arrival_datetime)
+    train_info = fetch_train_details(train.train_category, train.train_number, segment.departure_compact, start_station_id2, segment.arrival_compact, end_station_id2)
 
+    # If the train does not run between the stations, the segment has no seats at all
+    if "statusCode" in train_info and train_info["statusCode"] == 404:
+        return None, None, 1
+
+    carriages_types = extract_carriage_type(train_info)
+    carrige_svgs, all_available_seats, _ = process_train_data(train.train_category, train.train_number, carriages_types, segment.departure_compact, segment.arrival_compact, start_station_id2, end_station_id2)
+
+    return carrige_svgs, all_available_seats, 1 + len(carriages_types)
+
+
+# Searches for seat transfers on a specific train route by fetching every pair of adjacent stations once and planning the seat changes locally,
+# returns the train data with available seats, carriage layout ids, booking links, the number of upstream calls made and the number of
+# upstream calls saved compared to the binary search over the same segments, negative when the binary search would make fewer calls.
+# All segments are fetched in one concurrent wave, so the search takes about as long as the slowest segment, but it usually makes
+# more upstream calls than the binary search, which skips the spans implied by its earlier probes.
+# When the deadline of the request passes, the seat changes over the segments fetched from the start of the route are returned with the "timed_out" status.
+def get_seat_transfers_by_segments(stations: list[Stop], train: Train, known_segments: dict | None = None, on_event: Callable[[dict], None] | None = None) -> dict:
+    known_segments = known_segments or {}
+    segment_svgs = [None] * (len(stations) - 1)
+    segment_seats = [None] * (len(stations) - 1)
+    fetched = set(known_segments)
+    upstream_calls = 0
+    timed_out = False
+
+    for i, (carrige_svgs, all_available_seats) in known_segments.items():
+        segment_svgs[i], segment_seats[i] = carrige_svgs, all_available_seats
+
+    # Fetch all missing segments in one concurrent wave, each in a copy of the caller's context so the calls keep the user, timings and deadline of the request
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SEGMENT_WORKERS) as executor:
+        future_to_segment = {
+            executor.submit(contextvars.copy_context().run, fetch_segment_seats, Segment(stations[i], stations[i + 1]), train): i
+            for i in range(len(stations) - 1) if i not in known_segments
+        }
+        try:
+            for future in concurrent.futures.as_completed(future_to_segment):
+                i = future_to_segment[future]
+                segment_svgs[i], segment_seats[i], calls = future.result()
+                upstream_calls += calls
+                fetched.add(i)
+        except DeadlineExceeded as e:
+            print(e)
+            timed_out = True
+        finally:
+            # Segments not started yet are not needed after a failure
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if timed_out:
+        # A fetched segment without seats still rules out the seat transfers, otherwise the legs cover the segments fetched from the start
+        blocked = any(segment_seats[i] is None or count_seats(segment_seats[i]) == 0 for i in fetched)
+        known_prefix = next((i for i in range(len(stations) - 1) if i not in fetched), len(stations) - 1)
+        legs = None if blocked else plan_fewest_seat_changes(segment_seats[:known_prefix])
+        result = seat_result(train, "no_seats" if blocked else "timed_out", upstream_calls=upstream_calls)
+        TRANSFER_SEARCH_STOPS.inc("segments", "deadline")
+    else:
+        legs = plan_fewest_seat_changes(segment_seats)
+        # The binary search starts from the direct span, checked before the transfer search, and the segments known here
+        known_spans = [(0, len(stations) - 1)] + [(i, i + 1) for i in known_segments]
+        binary_search_calls = count_binary_search_calls(segment_seats, known_spans)
+        result = seat_result(train, "seat_transfer" if legs else "no_seats", upstream_calls=upstream_calls, upstream_calls_saved=binary_search_calls - upstream_calls)
+        print(f"Segment search: {upstream_calls} upstream calls, {binary_search_calls - upstream_calls} saved compared to the binary search")
+
+    if not legs:
+        return result
+
+    result["stations"].append(stations[0])
+    for first, last in legs:
+        start, end = stations[first], stations[last]
+        leg_seats = intersect_segments(segment_seats[first:last])
+
+        # The layouts of the first segment show only the seats free on the whole leg
+        leg_svgs = segment_svgs[first]
+
+        link = leg_link(start, end)
+        result["stations"].append(end)
+        result["available_seats"].append(leg_seats)
+        result["carrige_svgs"].append(leg_svgs)
+        result["links"].append(link)
+
+        if on_event is not None:
+            on_event(leg_event(len(result["links"]) - 1, start, end, leg_seats, leg_svgs, link))
+
+    return result
+
+
+# Result of a seat search stopped by the deadline of the request, with the free seats of the carriages of the direct connection checked before it
+def timed_out_result(train: Train, carriages: dict[str, tuple], link: str) -> dict:
+    available_seats = {carriage_number: seats for carriage_number, (_, seats) in sorted(carriages.items(), key=lambda x: int(x[0])) if seats.available}
+    if not available_seats:
+        return seat_result(train, "timed_out")
+    carrige_svgs = {carriage_number: carriages[carriage_number][0] for carriage_number in available_seats if carriages[carriage_number][0]}
+    return seat_result(train, "timed_out", available_seats=available_seats, carrige_svgs=carrige_svgs, links=[link])
+
+
+# Retrieve the seat availability for a specific train, returns the train data with available seats, carriage layout ids, and booking links.
+# Progress is reported to on_event: carriages of the direct connection as they arrive, the start of the transfer search and each confirmed transfer leg.
+# Details of the train on the whole journey can be passed in train_info when they are already fetched.
+# When the deadline of the request passes, the seats found so far are returned with the "timed_out" status.
+@timed()
+def get_seat_availability(train: Train, stations: dict, transfer_mode: str = "binary", on_event: Callable[[dict], None] | None = None, train_info: dict | None = None) -> dict:
     # Extract departure and arrival station IDs
     departure_station_id1 = stations.get("departure_station_id1")
     departure_station_id2 = stations.get("departure_station_id2")
     arrival_station_id1 = stations.get("arrival_station_id1")
     arrival_station_id2 = stations.get("arrival_station_id2")
+    direct_link = get_intercity_link(train.departure_date, departure_station_id1, arrival_station_id1, train.departure_time)
+
+    # Carriages of the direct connection checked so far, kept for the result when the deadline passes
+    direct_carriages = {}
+
+    def on_carriage(carriage_number: str, svg: str, seats: CarriageSeats) -> None:
+        direct_carriages[carriage_number] = (svg, seats)
+        if on_event is not None:
+            on_event({"type": "carriage", "carriage_number": carriage_number, "available_seats": seats, "svg": svg})
+
+    try:
+        # Fetch train details, unless the caller already has them
+        if train_info is None:
+            train_info = fetch_train_details(train.train_category, train.train_number, train.departure_compact, departure_station_id2, train.arrival_compact, arrival_station_id2)
+
+        # If the train is not found, return information about the train with no seats available
+        if "statusCode" in train_info and train_info["statusCode"] == 404:
+            return seat_result(train, "no_seats")
+
+        # Extract carriage types and process the train data
+        carriages_types = extract_carriage_type(train_info)
+        carrige_svgs, all_available_seats, seat_count = process_train_data(train.train_category, train.train_number, carriages_types, train.departure_compact, train.arrival_compact, departure_station_id2, arrival_station_id2, on_carriage)
+        direct = (carrige_svgs, all_available_seats, seat_count)
+
+        # If seats are available return the train data with available seats 
+        if seat_count != 0:
+            return seat_result(train, "same_seat", available_seats=all_available_seats, carrige_svgs=carrige_svgs, links=[direct_link])
+
+        route_info = fetch_train_route(train.departure.isoformat(), departure_station_id1, arrival_station_id1, train.train_number)
+
+        # Extract the route information
+        route = route_info.get("trasePrzejezdu").get("trasaPrzejazdu")
+        if not route or len(route) == 0:
+            raise ValueError(f"Brak dostępnych miejsc na przejazd ze stacji {stations['departure_station']} do stacji {stations['arrival_station']} bez zmiany miejsca. PKP Intercity nie udostępnia informacji o trasie tego pociągu.")
+
+        stations = [Stop.from_route(station) for station in route]
+        timetable.add_route(train.departure_date, (train.train_category, train.train_number, train.train_name, train.departure_date), stations)
+
+        # Check if it is possible to depart from the departure station
+        carrige_svgs, all_available_seats, _ = fetch_segment_seats(Segment(stations[0], stations[1]), train)
+        seat_count = None if all_available_seats is None else count_seats(all_available_seats)
+    except DeadlineExceeded as e:
+        print(e)
+        return timed_out_result(train, direct_carriages, direct_link)
+
+    if seat_count == 0:
+        return seat_result(train, "no_seats")
+
+    # Try to find a seat transfers, the searches return the legs found before the deadline themselves
+    if on_event is not None:
+        on_event({"type": "transfer_search"})
+    if transfer_mode == "segments":
+        return get_seat_transfers_by_segments(stations, train, {0: (carrige_svgs, all_available_seats)} if seat_count else None, on_event)
 
-    # Fetch train details
-    train_info = fetch_train_details(train_category, train_number, departure_datetime_compact, departure_station_id2, arrival_datetime_compact, arrival_station_id2)
+    # The direct span and the first segment are already checked, the binary search starts from their results
+    known_spans = {(0, len(stations) - 1): direct, (0, 1): (carrige_svgs, all_available_seats, seat_count) if seat_count is not None else None}
+    return get_seat_transfers(stations, train, on_event, known_spans)
 
-    # If the train is not found, return information about the train with no seats available
+
+# Run a function reporting events through the callback it gets in a background thread, yields the events until a "done" or "error" event.
+# The function runs with the deadline of the caller or a new one, which is cancelled when the events stop being read before the end,
+# e.g. when the client of a stream disconnects, so its upstream calls are cancelled too.
+def iterate_events(run: Callable[[Callable[[dict], None]], None]) -> Iterator[dict]:
+    events = queue.Queue()
+    deadline = current_deadline.get() or Deadline()
+
+    # Run in the caller's context, so upstream calls keep the user of the request
+    context = contextvars.copy_context()
+    context.run(current_deadline.set, deadline)
+    threading.Thread(target=context.run, args=(run, events.put), daemon=True).start()
+
+    finished = False
+    try:
+        while True:
+            event = events.get()
+            if event["type"] in ("done", "error"):
+                finished = True
+            yield event
+            if finished:
+                return
+    finally:
+        if not finished:
+            deadline.cancel()
+
+
+# Stream the progress of get_seat_availability as events, ends with a "done" event holding the status and booking links or an "error" event
+def stream_seat_availability(train: Train, stations: dict, transfer_mode: str = "binary", train_info: dict | None = None) -> Iterator[dict]:
+    def run(emit: Callable[[dict], None]) -> None:
+        try:
+            result = get_seat_availability(train, stations, transfer_mode, on_event=emit, train_info=train_info)
+            emit({"type": "done", "status": result["status"], "links": result["links"]})
+        except Exception as e:
+            print(e)
+            emit({"type": "error", "message": str(e)})
+
+    return iterate_events(run)
+
+
+# Count the seats available on the whole journey of a train without seat transfers, returns the seat count and the train details
+async def count_direct_seats_async(train: Train, stations: dict) -> tuple[int, dict]:
+    departure_station_id2 = stations.get("departure_station_id2")
+    arrival_station_id2 = stations.get("arrival_station_id2")
+
+    train_info = await fetch_train_details_async(train.train_category, train.train_number, train.departure_compact, departure_station_id2, train.arrival_compact, arrival_station_id2)
     if "statusCode" in train_info and train_info["statusCode"] == 404:
-        return {
-            "train_name": train_name,
-            "train_number": train_number,
-            "train_category": train_category,
-            "departure_datetime": departure_datetime,
-            "arrival_datetime": arrival_datetime,
-            "status": "no_seats",
-            "stations": [],
-            "available_seats": [],
-            "carrige_svgs": [],
-            "links": []
-        }
+        return 0, train_info
 
-    # Extract carriage types and process the train data
     carriages_types = extract_carriage_type(train_info)
-    carrige_svgs, all_available_seats, seat_count = process_train_data(train_category, train_number, carriages_types, departure_datetime_compact, arrival_datetime_compact, departure_station_id2, arrival_station_id2)
-
-
-    # If seats are available return the train data with available seats 
-    if seat_count != 0:
-        return {
-            "train_name": train_name,
-            "train_number": train_number,
-            "train_category": train_category,
-            "departure_datetime": departure_datetime,
-            "arrival_datetime": arrival_datetime,
-            "status": "same_seat",
-            "available_seats": all_available_seats,
-            "carrige_svgs": carrige_svgs,
-            "links": [get_intercity_link(datetime.strptime(departure_datetime, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d"), departure_station_id1, arrival_station_id1, datetime.strptime(departure_datetime, "%Y-%m-%d %H:%M:%S").strftime("%H:%M"))]
-        }
+    _, _, seat_count = await process_train_data_async(train.train_category, train.train_number, carriages_types, train.departure_compact, train.arrival_compact, departure_station_id2, arrival_station_id2)
+    return seat_count, train_info
+
+
+# Count the direct seats of all trains concurrently, yields a "seat_count" event for each train as soon as it is counted and a final "done" event.
+# The fetched details of each train are passed to on_details with the index of the train, so the seats page can reuse them.
+def stream_seat_counts(trains: list[Train], stations: dict, on_details: Callable[[int, dict], None] | None = None) -> Iterator[dict]:
+    counted = set()
+
+    async def count_all(emit: Callable[[dict], None]) -> None:
+        semaphore = asyncio.Semaphore(BATCH_TRAIN_WORKERS)
+
+        async def count(index: int, train: Train) -> None:
+            async with semaphore:
+                try:
+                    seat_count, train_info = await count_direct_seats_async(train, stations)
+                    if on_details is not None:
+                        on_details(index, train_info)
+                    emit({"type": "seat_count", "index": index, "seat_count": seat_count})
+                except Exception as e:
+                    print(e)
+                    emit({"type": "seat_count", "index": index, "seat_count": None, "error": str(e)})
+                counted.add(index)
+
+        await asyncio.gather(*(count(index, train) for index, train in enumerate(trains)))
+
+    def run(emit: Callable[[dict], None]) -> None:
+        try:
+            run_async(count_all(emit))
+        except DeadlineExceeded as e:
+            # The trains not counted before the deadline stay unknown
+            print(e)
+            for index in range(len(trains)):
+                if index not in counted:
+                    emit({"type": "seat_count", "index": index, "seat_count": None, "error": str(e)})
+        emit({"type": "done"})
+
+    return iterate_events(run)
+
+
+# Add the trains of a connection search to the timetable index
+def add_connections(date: str, departure_station: str, arrival_station: str, trains: list[Train]) -> None:
+    for train in trains:
+        trip = (train.train_category, train.train_number, train.train_name, date)
+        timetable.add(date, trip, departure_station, arrival_station, train.departure, train.arrival)
+
+
+# Fill the timetable index with the trains of the connection searches, given as (from station, to station, date).
+# Searches done recently for the same stations and date are not repeated, the outcomes are counted in the metrics.
+async def fill_timetable_async(searches: list[tuple[str, str, str]]) -> None:
+    semaphore = asyncio.Semaphore(TIMETABLE_WORKERS)
+
+    async def search(from_station: str, to_station: str, date: str) -> None:
+        async with semaphore:
+            try:
+                from_station_id1 = (await fetch_station_ids_async(from_station))[0]
+                to_station_id1 = (await fetch_station_ids_async(to_station))[0]
+            except ValueError:
+                TIMETABLE_SEARCHES.inc("unknown_station")
+                return
+            if not timetable.claim_search(from_station_id1, to_station_id1, date):
+                TIMETABLE_SEARCHES.inc("cached")
+                return
+            try:
+                connections = (await fetch_train_connections_async(date, from_station_id1, to_station_id1)).get("polaczenia") or []
+            except DeadlineExceeded:
+                timetable.release_search(from_station_id1, to_station_id1, date)
+                raise
+            except Exception:
+                TIMETABLE_SEARCHES.inc("failed")
+                timetable.release_search(from_station_id1, to_station_id1, date)
+                return
+            TIMETABLE_SEARCHES.inc("searched")
+            add_connections(date, from_station, to_station, [Train.from_connection(connection) for connection in connections])
+
+    await asyncio.gather(*(search(from_station, to_station, date) for from_station, to_station, date in searches))
+
+
+# Connection searches of a journey search, in the order they are made until enough journeys are found: the direct trains of the date,
+# then the transfer hubs a few at a time, and last the trains of the next date from the stations searched, for journeys past midnight
+def timetable_searches(departure_station: str, arrival_station: str, date: str) -> Iterator[list[tuple[str, str, str]]]:
+    next_date = (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    yield [(departure_station, arrival_station, date)]
+
+    hubs = [hub for hub in TRANSFER_HUBS if hub not in (departure_station, arrival_station)]
+    for i in range(0, len(hubs), TIMETABLE_WORKERS):
+        yield [search for hub in hubs[i:i + TIMETABLE_WORKERS] for search in ((departure_station, hub, date), (hub, arrival_station, date))]
+
+    yield [(departure_station, arrival_station, next_date)] + [(hub, arrival_station, next_date) for hub in hubs]
+
+
+# Count the seats on the whole leg of a journey, None if they could not be checked
+async def count_leg_seats_async(leg: dict) -> int | None:
+    try:
+        departure_station_id2 = (await fetch_station_ids_async(leg["departure_station"]))[1]
+        arrival_station_id2 = (await fetch_station_ids_async(leg["arrival_station"]))[1]
+        seat_count, _ = await count_direct_seats_async(leg["train"], {"departure_station_id2": departure_station_id2, "arrival_station_id2": arrival_station_id2})
+        return seat_count
+    except Exception as e:
+        print(e)
+        return None
+
+
+# Searches for journeys with changes of trains between the stations, computed locally on the timetable index by the Connection Scan Algorithm.
+# The connections between the stations are searched upstream first, the transfer hubs only while fewer journeys than needed are found,
+# together with the routes already seen in seat searches. Journeys may continue with the trains of the next day.
+# When the deadline of the request passes, the journeys found in the connections searched so far are returned.
+# The seats are checked only for the legs of the journeys found, returns the journeys with the earliest arrival and the station data.
+@timed()
+def get_journeys(departure_station: str, arrival_station: str, input_date: str, input_time: str) -> tuple:
+    input_datetime = search_start(input_date, input_time)
+    input_date = input_datetime.strftime("%Y-%m-%d")
+    next_date = (input_datetime + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    stations = resolve_stations(departure_station, arrival_station)
+    if "error" in stations:
+        return stations, {}
 
-    departure_datetime_iso = datetime.strptime(departure_datetime, "%Y-%m-%d %H:%M:%S").isoformat()
-    route_info = fetch_train_route(departure_datetime_iso, departure_station_id1, arrival_station_id1, train_number)
+    timetable.expire(datetime.now().strftime("%Y-%m-%d"))
+    found = []
+    try:
+        for searches in timetable_searches(stations["departure_station"], stations["arrival_station"], input_date):
+            run_async(fill_timetable_async(searches))
+            with span("connection_scan"):
+                found = find_journeys(timetable.connections(input_date, next_date), departure_station, arrival_station, input_datetime)
+            if len(found) >= MAX_JOURNEYS:
+                break
+    except DeadlineExceeded as e:
+        print(e)
+        with span("connection_scan"):
+            found = find_journeys(timetable.connections(input_date, next_date), departure_station, arrival_station, input_datetime)
+    if not found:
+        return {"error": "Nie znaleziono połączeń z przesiadkami"}, stations
+
+    journeys = []
+    for journey in found:
+        legs = []
+        for first, last in journey:
+            category, number, name, _ = first.trip
+            legs.append({
+                "train": Train(category, number, name, None, first.departure, last.arrival),
+                "departure_station": timetable.name(first.from_station),
+                "arrival_station": timetable.name(last.to_station),
+                "seat_count": None
+            })
+        journeys.append({
+            "departure": legs[0]["train"].departure,
+            "arrival": legs[-1]["train"].arrival,
+            "travel_time": int((journey[-1][1].arrival - journey[0][0].departure) / timedelta(minutes=1)),
+            "transfers": len(legs) - 1,
+            "legs": legs
+        })
 
-    # Extract the route information
-    route = route_info.get("trasePrzejezdu").get("trasaPrzejazdu")
-    if not route or len(route) == 0:
-        raise ValueError(f"Brak dostępnych miejsc na przejazd ze stacji {stations['departure_station']} do stacji {stations['arrival_station']} bez zmiany miejsca. PKP Intercity nie udostępnia informacji o trasie tego pociągu.")
+    # Check the seats of every distinct leg once
+    unique_legs = {}
+    for journey in journeys:
+        for leg in journey["legs"]:
+            unique_legs.setdefault((leg["train"].train_number, leg["departure_station"], leg["arrival_station"], leg["train"].departure), []).append(leg)
 
-    stations = [
-        {
-            "station_name": station["nazwaStacji"],
-            "station_number": station["numerStacji"],
-            "arrival_datatime": (datetime.strptime(station["dataPrzyjazdu"], "%a %b %d %H:%M:%S CET %Y").strftime("%Y-%m-%d %H:%M:%S") if station.get("dataPrzyjazdu") else None),
-            "departure_datatime": (datetime.strptime(station["dataWyjazdu"], "%a %b %d %H:%M:%S CET %Y").strftime("%Y-%m-%d %H:%M:%S") if station.get("dataWyjazdu") else None)
-        }
-        for station in route
-    ]
-    
-    all_available_seats = []
-    carrige_svgs = {}
+    async def count_all() -> list:
+        semaphore = asyncio.Semaphore(BATCH_TRAIN_WORKERS)
 
-    # Check if it is possible to depart from the departure station
-    start, end = stations[0], stations[1]
-    start_station = start["station_name"]
-    end_station = end["station_name"]
-    start_arrival_datetime = start["arrival_datatime"]
-    end_arrival_datetime = end["arrival_datatime"]
-    start_departure_datetime = start["departure_datatime"]
-    end_departure_datetime = end["departure_datatime"]
-    start_station_data = fetch_station_ids(start_station)
-    end_station_data = fetch_station_ids(end_station)
-    if start_station_data is None or end_station_data is None:
-        raise ValueError(f"Nie znaleziono stacji {start_station} lub {end_station}")
-    start_station_id2 = start_station_data[1]
-    end_station_id2 = end_station_data[1]
-    start_arrival_datetime_compact = format_datetime_compact(start_arrival_datetime) if start_arrival_datetime else None
-    start_departure_datetime_compact = format_datetime_compact(start_departure_datetime)
-    end_arrival_datetime_compact = format_datetime_compact(end_arrival_datetime)
-    end_departure_datetime_compact = format_datetime_compact(end_departure_datetime)
-
-    train_info = fetch_train_details(train_category, train_number, start_departure_datetime_compact, start_station_id2, end_arrival_datetime_compact, end_station_id2)
-    
-    if "statusCode" in train_info and train_info["statusCode"] == 404:
-        carrige_svgs = {}
-        all_available_seats = {}
-        seat_count = None 
-    else:
-        carriages_types = extract_carriage_type(train_info)
-        carrige_svgs, all_available_seats, seat_count = process_train_data(train_category, train_number, carriages_types, start_departure_datetime_compact, end_departure_datetime_compact, start_station_id2, end_station_id2)
+        async def count(leg: dict) -> int | None:
+            async with semaphore:
+                return await count_leg_seats_async(leg)
 
-    if seat_count == 0:
-        return {
-            "train_name": train_name,
-            "train_number": train_number,
-            "train_category": train_category,
-            "departure_datetime": departure_datetime,
-            "arrival_datetime": arrival_datetime,
-            "status": "no_seats",
-            "stations": [],
-            "available_seats": [],
-            "carrige_svgs": [],
-            "links": []
-        }
+        return await asyncio.gather(*(count(legs[0]) for legs in unique_legs.values()))
+
+    # Legs not counted before the deadline are shown without the seat count
+    try:
+        seat_counts = run_async(count_all())
+    except DeadlineExceeded as e:
+        print(e)
+        seat_counts = [None] * len(unique_legs)
+
+    for legs, seat_count in zip(unique_legs.values(), seat_counts):
+        for leg in legs:
+            leg["seat_count"] = seat_count
+            leg["link"] = get_intercity_link(leg["train"].departure_date, fetch_station_ids(leg["departure_station"])[0], fetch_station_ids(leg["arrival_station"])[0], leg["train"].departure_time)
 
-    # Try to find a seat transfers
-    return get_seat_transfers(stations, train_category, train_number, train_name, departure_datetime, arrival_datetime)
\ No newline at end of file
+    return journeys, stations
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+import os
+import threading
+import time
+
+
+# Time (in seconds) a request of a user may spend on a search before its upstream work is cancelled and the results found so far are returned
+REQUEST_TIMEOUT = float(os.environ.get("TRICKYTRAIN_REQUEST_TIMEOUT", "60"))
+
+
+# Raised when the deadline of the request passes or its client disconnects, the upstream work of the request is abandoned
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+# Deadline of a request: the time by which its upstream work has to finish, cancelled early when the client disconnects.
+# Waits of the request register a callback with on_cancel, so they wake up as soon as the request is cancelled.
+class Deadline:
+    def __init__(self, seconds: float = REQUEST_TIMEOUT) -> None:
+        self.expires = time.monotonic() + seconds
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    # Seconds left until the deadline, zero when it passed or the request was cancelled
+    def remaining(self) -> float:
+        if self.cancelled:
+            return 0.0
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    # Raise DeadlineExceeded if the deadline passed
+    def check(self) -> None:
+        if self.expired():
+            raise self.error()
+
+    def error(self) -> DeadlineExceeded:
+        if self.cancelled:
+            return DeadlineExceeded("Wyszukiwanie przerwane, połączenie z przeglądarką zostało zamknięte")
+        return DeadlineExceeded("Przekroczono czas wyszukiwania, spróbuj ponownie")
+
+    # Cancel the request, e.g. when its client disconnects, and wake up its waits
+    def cancel(self) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    # Call the callback if the request is cancelled while the block runs
+    @contextmanager
+    def on_cancel(self, callback: Callable[[], None]) -> Iterator[None]:
+        with self._lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self._callbacks.append(callback)
+        if cancelled:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+    # Sleep for the given time unless the deadline passes first, then raise DeadlineExceeded
+    def sleep(self, seconds: float) -> None:
+        woken = threading.Event()
+        with self.on_cancel(woken.set):
+            woken.wait(min(seconds, self.remaining()))
+        self.check()
+
+
+# Deadline of the request on whose behalf the code runs, None for work without a deadline like the watches and the prefetch
+current_deadline = ContextVar("current_deadline", default=None)
+
+
+# Run the block with a new deadline of the request
+@contextmanager
+def deadline_scope(seconds: float = REQUEST_TIMEOUT) -> Iterator[Deadline]:
+    deadline = Deadline(seconds)
+    token = current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        current_deadline.reset(token)
+
+
+# Raise DeadlineExceeded if the deadline of the current request passed
+def check_deadline() -> None:
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check()
+
+
+# Seconds left until the deadline of the current request, None without a deadline
+def remaining_time() -> float | None:
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+# Sleep between retries, cut short by the deadline of the current request
+def sleep(seconds: float) -> None:
+    deadline = current_deadline.get()
+    if deadline is None:
+        time.sleep(seconds)
+    else:
+        deadline.sleep(seconds)
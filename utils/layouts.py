@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from .cache import SharedStore, shared_store
+from .seatmap import SeatIndex
+from .svg_parser import build_layout_template
+import hashlib
+import threading
+
+
+# Maximum number of carriage layout templates kept in memory, and the time (in seconds) they are kept in the shared store
+MAX_LAYOUTS = 2000
+LAYOUT_TTL = 86400
+
+
+# Store of carriage layout templates, keyed by the hash of the template.
+# Seat maps of the same carriage type with the same seat index reuse the stored template without building it again,
+# unless the template was built from a seat map without free or without occupied seats and does not know both seat images.
+# Templates are also written to the shared store, so a page rendered by one worker process can load its layouts from another.
+class LayoutStore:
+    def __init__(self, max_layouts: int = MAX_LAYOUTS, shared: SharedStore | None = shared_store) -> None:
+        self.max_layouts = max_layouts
+        self.shared = shared
+        self._templates = OrderedDict()  # layout id -> template
+        self._ids = {}  # (carriage type, seat index) -> layout id
+        self._partial = set()  # keys whose template does not know both seat images
+        self._lock = threading.Lock()
+
+    # Store the layout of a cleaned seat map, returns the id of its template
+    def register(self, carriage_type: str, index: SeatIndex, cleaned: str) -> str:
+        key = (carriage_type, index)
+        with self._lock:
+            layout_id = self._ids.get(key)
+            if layout_id is not None and layout_id in self._templates and key not in self._partial:
+                self._templates.move_to_end(layout_id)
+                return layout_id
+
+        template, complete = build_layout_template(cleaned)
+        if not complete and layout_id is not None and layout_id in self._templates:
+            # Neither template knows both seat images, keep the one the pages already use
+            return layout_id
+        layout_id = hashlib.sha1(template.encode("utf-8")).hexdigest()[:16]
+
+        self._store(layout_id, template, key, complete)
+        if self.shared is not None:
+            try:
+                self.shared.set("layouts", layout_id, template, LAYOUT_TTL)
+            except Exception as e:
+                print(e)
+        return layout_id
+
+    # Get the template of a layout, None if it is not stored
+    def get(self, layout_id: str) -> str | None:
+        with self._lock:
+            template = self._templates.get(layout_id)
+        if template is not None or self.shared is None:
+            return template
+        try:
+            found, template = self.shared.get("layouts", layout_id)
+        except Exception as e:
+            print(e)
+            return None
+        if not found:
+            return None
+        self._store(layout_id, template)
+        return template
+
+    def _store(self, layout_id: str, template: str, key: tuple | None = None, complete: bool = True) -> None:
+        with self._lock:
+            self._templates[layout_id] = template
+            self._templates.move_to_end(layout_id)
+            if key is not None:
+                self._ids[key] = layout_id
+                if complete:
+                    self._partial.discard(key)
+                else:
+                    self._partial.add(key)
+            while len(self._templates) > self.max_layouts:
+                self._templates.popitem(last=False)
+            if len(self._ids) > 2 * self.max_layouts:
+                self._ids = {key: value for key, value in self._ids.items() if value in self._templates}
+                self._partial &= self._ids.keys()
+
+
+layout_store = LayoutStore()
+
@@ -0,0 +1,203 @@
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator
+from .deadline import current_deadline
+import asyncio
+import os
+import threading
+import time
+
+
+# Key of the user on whose behalf upstream calls are made, queued calls are served round-robin across users
+current_user = ContextVar("current_user", default="")
+
+# Priority of upstream calls made in the current context, lower values are served first
+current_priority = ContextVar("current_priority", default=0)
+
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 10
+
+LIMIT_INITIAL = float(os.environ.get("TRICKYTRAIN_UPSTREAM_LIMIT_INITIAL", "5"))
+LIMIT_MIN = float(os.environ.get("TRICKYTRAIN_UPSTREAM_LIMIT_MIN", "1"))
+LIMIT_MAX = float(os.environ.get("TRICKYTRAIN_UPSTREAM_LIMIT_MAX", "20"))
+
+
+# Caller waiting for a free slot, woken up either through a thread event or an event loop future
+class _Waiter:
+    __slots__ = ("event", "loop", "future", "granted")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None) -> None:
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+        self.granted = False
+
+    def wake(self) -> None:
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+# Concurrency limiter for upstream calls adjusting its limit with AIMD:
+# the limit grows by one per window of successful calls and is cut in half when the API is overloaded
+class AdaptiveLimiter:
+    def __init__(self, initial: float = LIMIT_INITIAL, minimum: float = LIMIT_MIN, maximum: float = LIMIT_MAX, decrease_factor: float = 0.5, decrease_cooldown: float = 1.0) -> None:
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._queues = {}  # priority -> OrderedDict of user -> deque of waiters
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.overloads = 0
+
+    # Wait for a free slot, raises DeadlineExceeded if the deadline of the request passes first
+    def acquire(self) -> None:
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter()
+            self._enqueue(waiter)
+
+        deadline = current_deadline.get()
+        if deadline is None:
+            waiter.event.wait()
+            return
+        with deadline.on_cancel(waiter.event.set):
+            waiter.event.wait(deadline.remaining())
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                raise deadline.error()
+
+    # Async version of acquire
+    async def acquire_async(self) -> None:
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._enqueue(waiter)
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter.granted:
+                    self._remove(waiter)
+                    raise
+            self.release(success=None)
+            raise
+
+    # Release a slot and adjust the limit, success is None if the outcome should not change the limit
+    def release(self, success: bool | None = True) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if success is True:
+                self.successes += 1
+                self.limit = min(self.maximum, self.limit + 1 / max(self.limit, 1))
+            elif success is False:
+                self.overloads += 1
+                now = time.monotonic()
+                # Many calls fail at once when the API is overloaded, cut the limit once per cooldown
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            self._wake_next()
+
+    # Hold a slot for the duration of the block, the block reports the outcome by setting the first item of the yielded list
+    @contextmanager
+    def slot(self) -> Iterator[list]:
+        self.acquire()
+        outcome = [None]
+        try:
+            yield outcome
+        finally:
+            self.release(outcome[0])
+
+    # Async version of slot
+    @asynccontextmanager
+    async def slot_async(self) -> AsyncIterator[list]:
+        await self.acquire_async()
+        outcome = [None]
+        try:
+            yield outcome
+        finally:
+            self.release(outcome[0])
+
+    # Current limit and queue depth of the limiter
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queue_depth": self._queue_depth(),
+                "successes": self.successes,
+                "overloads": self.overloads
+            }
+
+    # Number of calls waiting with the given priority or a more urgent one
+    def waiting(self, priority: int = PRIORITY_USER) -> int:
+        with self._lock:
+            return sum(len(waiters) for p, users in self._queues.items() if p <= priority for waiters in users.values())
+
+    # Number of slots a call would get right away, zero while any call is queued
+    def free_slots(self) -> int:
+        with self._lock:
+            if self._queue_depth() > 0:
+                return 0
+            return max(0, int(self.limit) - self.in_flight)
+
+    def _queue_depth(self) -> int:
+        return sum(len(waiters) for users in self._queues.values() for waiters in users.values())
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < int(self.limit) and self._queue_depth() == 0:
+            self.in_flight += 1
+            return True
+        return False
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        users = self._queues.setdefault(current_priority.get(), OrderedDict())
+        users.setdefault(current_user.get(), deque()).append(waiter)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        for priority, users in list(self._queues.items()):
+            for user, waiters in list(users.items()):
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del users[user]
+                    if not users:
+                        del self._queues[priority]
+                    return
+
+    # Hand free slots to waiters: most urgent priority first, then round-robin across users
+    def _wake_next(self) -> None:
+        while self.in_flight < int(self.limit) and self._queues:
+            priority = min(self._queues)
+            users = self._queues[priority]
+            user, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+
+            # Move the user to the end of the queue so other users go next
+            del users[user]
+            if waiters:
+                users[user] = waiters
+            if not users:
+                del self._queues[priority]
+
+            self.in_flight += 1
+            waiter.wake()
+
+
+upstream_limiter = AdaptiveLimiter()
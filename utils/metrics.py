@@ -0,0 +1,215 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator
+from .cache import cache_stats
+from .limiter import upstream_limiter
+from .resilience import circuit_stats
+import functools
+import inspect
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets, upstream calls take from tens of milliseconds to tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# Escape a label value for the Prometheus text format
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Format the labels of a sample, e.g. {stage="parse_seat_map",outcome="ok"}
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f"{name}=\"{escape_label(value)}\"" for name, value in zip(names, values)) + "}"
+
+
+_metrics = []
+
+
+# Monotonic counter with labels
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    # Lines of the metric in the Prometheus text format
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value:g}"
+
+
+# Histogram of observed durations with labels
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    # Number of observations with any labels
+    def count(self) -> int:
+        with self._lock:
+            return sum(values[-1] for values in self._values.values())
+
+    # Lines of the metric in the Prometheus text format, bucket counts are cumulative
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            names = self.labelnames + ("le",)
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{format_labels(names, labels + (f'{bound:g}',))} {count}"
+            yield f"{self.name}_bucket{format_labels(names, labels + ('+Inf',))} {counts[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {counts[-2]:g}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {counts[-1]}"
+
+
+UPSTREAM_REQUEST_SECONDS = Histogram("trickytrain_upstream_request_seconds", "Duration of requests to the PKP Intercity APIs by endpoint and status code.", ("endpoint", "status"))
+UPSTREAM_QUEUE_SECONDS = Histogram("trickytrain_upstream_queue_seconds", "Time requests to the PKP Intercity APIs waited for a slot of the upstream limiter.", ("endpoint",))
+UPSTREAM_RETRIES = Counter("trickytrain_upstream_retries_total", "Retried requests to the PKP Intercity APIs by endpoint and reason.", ("endpoint", "reason"))
+UPSTREAM_HEDGES = Counter("trickytrain_upstream_hedges_total", "Requests to the PKP Intercity APIs sent a second time because the first was slow, by endpoint and the response used.", ("endpoint", "outcome"))
+UPSTREAM_REJECTED = Counter("trickytrain_upstream_rejected_total", "Requests to the PKP Intercity APIs not sent because the circuit of the endpoint was open.", ("endpoint",))
+STAGE_SECONDS = Histogram("trickytrain_stage_seconds", "Duration of the fetchers and pipeline stages by outcome.", ("stage", "outcome"))
+TRANSFER_SEARCH_STOPS = Counter("trickytrain_transfer_search_stops_total", "Seat transfer searches stopped before covering the route, by transfer mode and reason (budget or deadline).", ("mode", "reason"))
+TIMETABLE_SEARCHES = Counter("trickytrain_timetable_searches_total", "Connection searches of the journey search by outcome, unknown_station counts transfer hubs not found by the station search.", ("outcome",))
+HTTP_REQUEST_SECONDS = Histogram("trickytrain_http_request_seconds", "Duration of the application requests by route and status code.", ("route", "status"))
+
+
+# Time spent in each stage during a single application request, shared by all threads and tasks working on it
+class Timings:
+    def __init__(self) -> None:
+        self._stages = {}  # stage -> [total seconds, count]
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    # Stages with their total time and count, in the order they were first entered
+    def items(self) -> list[tuple[str, float, int]]:
+        with self._lock:
+            return [(stage, totals[0], totals[1]) for stage, totals in self._stages.items()]
+
+    # Value of the Server-Timing header, durations in milliseconds
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f};desc=\"{count}x\"" for stage, seconds, count in self.items())
+
+
+# Timings of the current application request, None when the breakdown is disabled
+current_timings = ContextVar("current_timings", default=None)
+
+
+# Record the duration of a stage in the histogram and in the timings of the current request
+def record(stage: str, seconds: float, outcome: str = "ok") -> None:
+    STAGE_SECONDS.observe(seconds, stage, outcome)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+# Record a request to the PKP Intercity APIs: the time it waited for the limiter and the time it took
+def observe_upstream(endpoint: str, status: str, queued: float, seconds: float) -> None:
+    UPSTREAM_QUEUE_SECONDS.observe(queued, endpoint)
+    UPSTREAM_REQUEST_SECONDS.observe(seconds, endpoint, status)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add("upstream_queue", queued)
+        timings.add(f"upstream_{endpoint}", seconds)
+
+
+# Measure the duration of the block as the given stage
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        record(stage, time.perf_counter() - started, outcome)
+
+
+# Decorator measuring every call of a function or coroutine function as the given stage, the function name by default
+def timed(stage: str | None = None) -> Callable[[Callable], Callable]:
+    def decorator(function: Callable) -> Callable:
+        name = stage or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs) -> Any:
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) -> Any:
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+# Lines of the cache and limiter statistics in the Prometheus text format
+def render_stats() -> Iterator[str]:
+    caches = cache_stats()
+    for counter in ("hits", "misses", "coalesced", "evictions", "shared_hits"):
+        yield f"# TYPE trickytrain_cache_{counter}_total counter"
+        for name, stats in caches.items():
+            yield f"trickytrain_cache_{counter}_total{format_labels(('cache',), (name,))} {stats[counter]}"
+
+    limiter = upstream_limiter.stats()
+    for gauge in ("limit", "in_flight", "queue_depth"):
+        yield f"# TYPE trickytrain_upstream_{gauge} gauge"
+        yield f"trickytrain_upstream_{gauge} {limiter[gauge]:g}"
+    for counter in ("successes", "overloads"):
+        yield f"# TYPE trickytrain_upstream_{counter}_total counter"
+        yield f"trickytrain_upstream_{counter}_total {limiter[counter]}"
+
+    circuits = circuit_stats()
+    yield "# TYPE trickytrain_upstream_circuit_open gauge"
+    for endpoint, circuit in circuits.items():
+        yield f"trickytrain_upstream_circuit_open{format_labels(('endpoint',), (endpoint,))} {0 if circuit['state'] == 'closed' else 1}"
+    yield "# TYPE trickytrain_upstream_circuit_opens_total counter"
+    for endpoint, circuit in circuits.items():
+        yield f"trickytrain_upstream_circuit_opens_total{format_labels(('endpoint',), (endpoint,))} {circuit['opens']}"
+
+
+# All metrics in the Prometheus text format
+def render_metrics() -> str:
+    lines = [line for metric in _metrics for line in metric.render()]
+    lines.extend(render_stats())
+    return "\n".join(lines) + "\n"
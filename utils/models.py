@@ -0,0 +1,145 @@
+from .seatmap import CarriageSeats
+from datetime import datetime
+from typing import Any
+
+# Formats of the timestamps: connection searches, train routes, and the compact form used in the URLs of train details and seat maps
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+ROUTE_DATETIME_FORMAT = "%a %b %d %H:%M:%S CET %Y"
+COMPACT_FORMAT = "%Y%m%d%H%M"
+
+
+# Train of a connection between the stations of a search. The timestamps are parsed once when the connection is read,
+# the string forms used by the API URLs, the templates and the JSON responses are kept next to them.
+class Train:
+    __slots__ = ("train_category", "train_number", "train_name", "travel_time", "departure", "arrival", "departure_datetime", "arrival_datetime", "departure_compact", "arrival_compact")
+
+    def __init__(self, train_category: str, train_number: str, train_name: str, travel_time: int | None, departure: datetime, arrival: datetime) -> None:
+        self.train_category = train_category
+        self.train_number = train_number
+        self.train_name = train_name
+        self.travel_time = travel_time
+        self.departure = departure
+        self.arrival = arrival
+        self.departure_datetime = departure.strftime(DATETIME_FORMAT)
+        self.arrival_datetime = arrival.strftime(DATETIME_FORMAT)
+        self.departure_compact = departure.strftime(COMPACT_FORMAT)
+        self.arrival_compact = arrival.strftime(COMPACT_FORMAT)
+
+    # Build from a connection of the connection search
+    @classmethod
+    def from_connection(cls, connection: dict) -> "Train":
+        train = connection.get("pociagi")[0]
+        departure = datetime.strptime(connection.get("dataWyjazdu"), DATETIME_FORMAT)
+        arrival = datetime.strptime(connection.get("dataPrzyjazdu"), DATETIME_FORMAT)
+        return cls(train.get("kategoriaPociagu"), train.get("nrPociagu"), train.get("nazwaPociagu"), train.get("czasJazdy"), departure, arrival)
+
+    # Build from the fields of the train in JSON, e.g. a search session kept in the shared store
+    @classmethod
+    def from_dict(cls, fields: dict) -> "Train":
+        departure = datetime.strptime(fields["departure_datetime"], DATETIME_FORMAT)
+        arrival = datetime.strptime(fields["arrival_datetime"], DATETIME_FORMAT)
+        return cls(fields["train_category"], fields["train_number"], fields["train_name"], fields["travel_time"], departure, arrival)
+
+    # Date and time of the departure as used in the booking links
+    @property
+    def departure_date(self) -> str:
+        return self.departure_datetime[:10]
+
+    @property
+    def departure_time(self) -> str:
+        return self.departure_datetime[11:16]
+
+    # Fields of the train in JSON responses
+    def to_dict(self) -> dict:
+        return {
+            "train_name": self.train_name,
+            "train_number": self.train_number,
+            "train_category": self.train_category,
+            "travel_time": self.travel_time,
+            "departure_datetime": self.departure_datetime,
+            "arrival_datetime": self.arrival_datetime
+        }
+
+
+# Stop of a train route, the first stop has no arrival and the last one no departure
+class Stop:
+    __slots__ = ("station_name", "station_number", "arrival", "departure", "arrival_datatime", "departure_datatime", "arrival_compact", "departure_compact")
+
+    def __init__(self, station_name: str, station_number: int, arrival: datetime | None, departure: datetime | None) -> None:
+        self.station_name = station_name
+        self.station_number = station_number
+        self.arrival = arrival
+        self.departure = departure
+        self.arrival_datatime = arrival.strftime(DATETIME_FORMAT) if arrival else None
+        self.departure_datatime = departure.strftime(DATETIME_FORMAT) if departure else None
+        self.arrival_compact = arrival.strftime(COMPACT_FORMAT) if arrival else None
+        self.departure_compact = departure.strftime(COMPACT_FORMAT) if departure else None
+
+    # Build from a station of the train route
+    @classmethod
+    def from_route(cls, station: dict) -> "Stop":
+        arrival = datetime.strptime(station["dataPrzyjazdu"], ROUTE_DATETIME_FORMAT) if station.get("dataPrzyjazdu") else None
+        departure = datetime.strptime(station["dataWyjazdu"], ROUTE_DATETIME_FORMAT) if station.get("dataWyjazdu") else None
+        return cls(station["nazwaStacji"], station["numerStacji"], arrival, departure)
+
+    # Fields of the stop in JSON responses and stream events
+    def to_dict(self) -> dict:
+        return {
+            "station_name": self.station_name,
+            "station_number": self.station_number,
+            "arrival_datatime": self.arrival_datatime,
+            "departure_datatime": self.departure_datatime
+        }
+
+
+# Ride of a train between two stops of its route, the unit whose seats are checked in the seat transfer searches
+class Segment:
+    __slots__ = ("start", "end")
+
+    def __init__(self, start: Stop, end: Stop) -> None:
+        self.start = start
+        self.end = end
+
+    @property
+    def departure_compact(self) -> str:
+        return self.start.departure_compact
+
+    @property
+    def arrival_compact(self) -> str:
+        return self.end.arrival_compact
+
+
+# Parsed seat map of one carriage: its number, the id of its layout template and the available seats
+class SeatMap:
+    __slots__ = ("carriage_number", "layout_id", "seats")
+
+    def __init__(self, carriage_number: str, layout_id: str, seats: CarriageSeats) -> None:
+        self.carriage_number = carriage_number
+        self.layout_id = layout_id
+        self.seats = seats
+
+
+# Result of a seat search for a train, built once with the fields of the train and the parts found
+def seat_result(train: Train, status: str, stations: list | None = None, available_seats: Any = None, carrige_svgs: Any = None, links: list | None = None, **extra: Any) -> dict:
+    return {
+        "train_name": train.train_name,
+        "train_number": train.train_number,
+        "train_category": train.train_category,
+        "departure_datetime": train.departure_datetime,
+        "arrival_datetime": train.arrival_datetime,
+        "status": status,
+        "stations": stations if stations is not None else [],
+        "available_seats": available_seats if available_seats is not None else [],
+        "carrige_svgs": carrige_svgs if carrige_svgs is not None else [],
+        "links": links if links is not None else [],
+        **extra
+    }
+
+
+# Encode the records and compact seat availability in JSON, used as the default of json.dumps
+def encode_json(value: object) -> Any:
+    if isinstance(value, CarriageSeats):
+        return value.to_dict()
+    if isinstance(value, (Train, Stop)):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,136 @@
+from .api import fetch_carriage_seat_map_async, fetch_train_details_async
+from .client import run_async
+from .data_precessor import extract_carriage_type
+from .limiter import PRIORITY_BACKGROUND, current_priority, current_user, upstream_limiter
+from .models import Train
+from collections import deque
+import asyncio
+import os
+import threading
+import time
+
+
+# Whether the first trains of every search are fetched in the background before the user picks one
+PREFETCH = os.environ.get("TRICKYTRAIN_PREFETCH", "0") == "1"
+
+# Number of upcoming trains of a search which are prefetched, and the upstream calls one search may use
+PREFETCH_TRAINS = int(os.environ.get("TRICKYTRAIN_PREFETCH_TRAINS", "3"))
+PREFETCH_BUDGET = int(os.environ.get("TRICKYTRAIN_PREFETCH_BUDGET", "40"))
+
+# Time (in seconds) after which a search is not prefetched anymore, seat maps are cached only for a short time
+PREFETCH_MAX_AGE = 20
+
+# Limiter slots left free for the requests of users, and the time to wait before checking again
+PREFETCH_RESERVE = 1
+PREFETCH_BACKOFF = 0.2
+
+# Searches waiting to be prefetched, the oldest are dropped
+PREFETCH_QUEUE_SIZE = 8
+
+
+# Prefetched search: the trains to warm the cache for and the stations of the search
+class PrefetchJob:
+    __slots__ = ("trains", "stations", "submitted")
+
+    def __init__(self, trains: list[Train], stations: dict) -> None:
+        self.trains = trains
+        self.stations = stations
+        self.submitted = time.monotonic()
+
+
+# Background worker warming the caches of train compositions and seat maps for the first trains of the latest searches.
+# A call is started only when the upstream limiter has a free slot beyond the reserve and no call is queued, so users never
+# wait behind the prefetch, not even when their request joins a seat map which is being prefetched. The newest search goes
+# first, and a search is abandoned when it gets old or a newer one is submitted while users keep the limiter busy.
+class Prefetcher:
+    def __init__(self, trains: int = PREFETCH_TRAINS, budget: int = PREFETCH_BUDGET) -> None:
+        self.trains = trains
+        self.budget = budget
+        self.searches = 0
+        self.calls = 0
+        self.abandoned = 0
+        self._jobs = deque(maxlen=PREFETCH_QUEUE_SIZE)
+        self._condition = threading.Condition()
+        self._thread = None
+
+    # Queue the first upcoming trains of a search for prefetching
+    def submit(self, trains: list[Train], stations: dict) -> None:
+        if not trains or self.trains <= 0:
+            return
+        with self._condition:
+            self._jobs.append(PrefetchJob(trains[:self.trains], stations))
+            self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+                self._thread.start()
+
+    # Counters of the prefetcher
+    def stats(self) -> dict:
+        with self._condition:
+            return {"queued": len(self._jobs), "searches": self.searches, "calls": self.calls, "abandoned": self.abandoned}
+
+    def _run(self) -> None:
+        current_user.set("prefetch")
+        current_priority.set(PRIORITY_BACKGROUND)
+
+        while True:
+            with self._condition:
+                while not self._jobs:
+                    self._condition.wait()
+                job = self._jobs.pop()
+                if time.monotonic() - job.submitted > PREFETCH_MAX_AGE:
+                    self.abandoned += 1
+                    continue
+
+            try:
+                run_async(self._prefetch(job))
+            except Exception as e:
+                print(e)
+
+    # Fetch the composition and the seat maps of the direct route of every train of the search, within the call budget
+    async def _prefetch(self, job: PrefetchJob) -> None:
+        departure_station_id2 = job.stations.get("departure_station_id2")
+        arrival_station_id2 = job.stations.get("arrival_station_id2")
+        calls = 0
+        tasks = []
+
+        try:
+            for train in job.trains:
+                if calls >= self.budget or not await self._wait_for_slot(job):
+                    return
+                calls += 1
+                train_info = await fetch_train_details_async(train.train_category, train.train_number, train.departure_compact, departure_station_id2, train.arrival_compact, arrival_station_id2)
+                if "statusCode" in train_info and train_info["statusCode"] == 404:
+                    continue
+
+                for carriage_number, carriage_type in extract_carriage_type(train_info).items():
+                    if calls >= self.budget or not await self._wait_for_slot(job):
+                        return
+                    calls += 1
+                    tasks.append(asyncio.ensure_future(fetch_carriage_seat_map_async(train.train_category, train.train_number, carriage_number, carriage_type, train.departure_compact, train.arrival_compact, departure_station_id2, arrival_station_id2)))
+        finally:
+            # Started fetches are finished, users may already be waiting for them in the cache
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    print(result)
+            with self._condition:
+                self.searches += 1
+                self.calls += calls
+
+    # Wait until a call can start without making users wait, returns False if the search should be abandoned
+    async def _wait_for_slot(self, job: PrefetchJob) -> bool:
+        while True:
+            # Let the fetches started before take their slots first
+            await asyncio.sleep(0)
+            if upstream_limiter.free_slots() > PREFETCH_RESERVE:
+                return True
+            with self._condition:
+                superseded = len(self._jobs) > 0
+            if superseded or time.monotonic() - job.submitted > PREFETCH_MAX_AGE:
+                with self._condition:
+                    self.abandoned += 1
+                return False
+            await asyncio.sleep(PREFETCH_BACKOFF)
+
+
+prefetcher = Prefetcher()
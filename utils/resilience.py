@@ -0,0 +1,150 @@
+from collections import deque
+import os
+import threading
+import time
+
+
+# Whether slow requests to the PKP Intercity APIs are sent a second time
+HEDGE_REQUESTS = os.environ.get("TRICKYTRAIN_HEDGE_REQUESTS", "1") != "0"
+
+# Quantile of the recent latencies of an endpoint after which a request is sent a second time
+HEDGE_QUANTILE = float(os.environ.get("TRICKYTRAIN_HEDGE_QUANTILE", "0.95"))
+
+# Fraction of the requests which may be sent a second time, so hedging cannot multiply the load when the API slows down
+HEDGE_RATIO = float(os.environ.get("TRICKYTRAIN_HEDGE_RATIO", "0.1"))
+
+# Number of recent latencies kept per endpoint, the minimum number needed before hedging and the shortest hedging delay in seconds
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+
+# Hedges which can be sent at once after a quiet period
+HEDGE_BURST = 5.0
+
+# Number of consecutive failed requests to an endpoint which opens its circuit
+BREAKER_FAILURES = int(os.environ.get("TRICKYTRAIN_BREAKER_FAILURES", "5"))
+
+# Time (in seconds) for which an open circuit rejects requests before a single trial request is let through
+BREAKER_COOLDOWN = float(os.environ.get("TRICKYTRAIN_BREAKER_COOLDOWN", "15"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+# Raised instead of sending a request to an endpoint whose circuit is open
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+# Circuit breaker of an upstream endpoint: after a series of failures it rejects requests for a cooldown,
+# then lets one trial request through, which closes the circuit again on success or reopens it on failure
+class CircuitBreaker:
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN) -> None:
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opens = 0
+        self._failed = 0
+        self._opened = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # Check whether a request may be sent now, in the half-open state only one request at a time is allowed
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    # Record the outcome of an allowed request, success is None if the request was cancelled before it finished
+    def record(self, success: bool | None) -> None:
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+            if success is None:
+                return
+            if success:
+                self._failed = 0
+                self.state = CLOSED
+                return
+            self._failed += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failed >= self.failures):
+                self.state = OPEN
+                self._opened = time.monotonic()
+                self.opens += 1
+
+    # Seconds until the open circuit lets a trial request through
+    def retry_after(self) -> float:
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self._opened))
+
+
+# Hedging policy of an upstream endpoint: the delay after which a request is sent a second time is the
+# configured quantile of the recent latencies, and the number of hedges is limited to a fraction of the requests
+class HedgePolicy:
+    def __init__(self, quantile: float = HEDGE_QUANTILE, ratio: float = HEDGE_RATIO) -> None:
+        self.quantile = quantile
+        self.ratio = ratio
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    # Record the latency of a completed request, every request earns a fraction of a hedge
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+            self._tokens = min(HEDGE_BURST, self._tokens + self.ratio)
+
+    # Delay after which a request is hedged, None until enough latencies are known
+    def delay(self) -> float | None:
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return max(HEDGE_MIN_DELAY, latencies[min(len(latencies) - 1, int(self.quantile * len(latencies)))])
+
+    # Take a hedge from the budget, False if the budget is used up
+    def spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+_breakers = {}
+_policies = {}
+_lock = threading.Lock()
+
+
+# Get the circuit breaker of an endpoint
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    with _lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker()
+        return _breakers[endpoint]
+
+
+# Get the hedging policy of an endpoint
+def get_hedge_policy(endpoint: str) -> HedgePolicy:
+    with _lock:
+        if endpoint not in _policies:
+            _policies[endpoint] = HedgePolicy()
+        return _policies[endpoint]
+
+
+# State of the circuits of all endpoints which were called
+def circuit_stats() -> dict:
+    with _lock:
+        breakers = dict(_breakers)
+    return {endpoint: {"state": breaker.state, "opens": breaker.opens, "retry_after": round(breaker.retry_after(), 1)} for endpoint, breaker in breakers.items()}
@@ -0,0 +1,112 @@
+from typing import Any, Iterator
+import threading
+
+
+# Seat types by their code, code 0 marks seats which are never offered (first class, other special seats)
+SEAT_TYPES = (None, "normal_seat", "bike_seat", "quiet_zone_seat")
+SEAT_TYPE_CODES = {seat_type: code for code, seat_type in enumerate(SEAT_TYPES) if seat_type}
+
+# Maximum number of distinct carriage layouts kept in the index cache
+MAX_INDICES = 5000
+
+
+# Seat numbers and types of a carriage layout, shared by all seat maps with the same layout
+class SeatIndex:
+    __slots__ = ("numbers", "types", "positions")
+
+    def __init__(self, numbers: tuple[str, ...], types: bytes) -> None:
+        self.numbers = numbers
+        self.types = types
+        self.positions = {number: position for position, number in enumerate(numbers)}
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+# Get the shared index of the layout with the given seat numbers and types
+def intern_index(numbers: tuple[str, ...], types: bytes) -> SeatIndex:
+    key = (numbers, types)
+    with _indices_lock:
+        index = _indices.get(key)
+        if index is None:
+            if len(_indices) >= MAX_INDICES:
+                _indices.clear()
+            index = _indices[key] = SeatIndex(numbers, types)
+        return index
+
+
+# Available seats of a carriage as a bitmap over the seat index of its layout
+class CarriageSeats:
+    __slots__ = ("index", "available")
+
+    def __init__(self, index: SeatIndex, available: int) -> None:
+        self.index = index
+        self.available = available
+
+    # Build from the dictionary of available seats with their types
+    @classmethod
+    def from_dict(cls, seats: dict[str, str]) -> "CarriageSeats":
+        index = intern_index(tuple(seats), bytes(SEAT_TYPE_CODES[seat_type] for seat_type in seats.values()))
+        return cls(index, (1 << len(seats)) - 1)
+
+    # Number of available seats
+    def __len__(self) -> int:
+        return self.available.bit_count()
+
+    def __contains__(self, seat_number: str) -> bool:
+        position = self.index.positions.get(seat_number)
+        return position is not None and bool(self.available >> position & 1)
+
+    # Seats available in both carriages
+    def __and__(self, other: "CarriageSeats") -> "CarriageSeats":
+        if other.index is self.index:
+            return CarriageSeats(self.index, self.available & other.available)
+        other_seats = other.to_dict()
+        return CarriageSeats.from_dict({number: seat_type for number, seat_type in self.to_dict().items() if number in other_seats})
+
+    # Positions of the available seats in the index
+    def positions(self) -> Iterator[int]:
+        bits = self.available
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    # Dictionary of available seat numbers with their types, the shape used by the templates
+    def to_dict(self) -> dict[str, str]:
+        numbers, types = self.index.numbers, self.index.types
+        return {numbers[position]: SEAT_TYPES[types[position]] for position in self.positions()}
+
+
+# Total number of available seats in the carriages of a segment
+def count_seats(carriages: dict[str, CarriageSeats]) -> int:
+    return sum(len(seats) for seats in carriages.values())
+
+
+# Intersect the available seats of consecutive segments, returns the carriages with seats free on all of them
+def intersect_segments(segments: list[dict[str, CarriageSeats]]) -> dict[str, CarriageSeats]:
+    if not segments:
+        return {}
+
+    result = {}
+    for carriage_number, seats in segments[0].items():
+        for segment in segments[1:]:
+            if not seats.available:
+                break
+            other = segment.get(carriage_number)
+            seats = seats & other if other is not None else CarriageSeats(seats.index, 0)
+        result[carriage_number] = seats
+
+    return result
+
+
+# Convert compact seat availability, also nested in dictionaries and lists, to dictionaries of seat numbers with their types
+def seats_to_dict(value: Any) -> Any:
+    if isinstance(value, CarriageSeats):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return {key: seats_to_dict(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [seats_to_dict(item) for item in value]
+    return value
@@ -0,0 +1,96 @@
+from .cache import TTLCache, shared_store
+from .models import Train
+import os
+import secrets
+
+
+# Time (in seconds) for which the results of a train search can be used to check seats, and the maximum number of kept searches
+SESSION_TTL = float(os.environ.get("TRICKYTRAIN_SESSION_TTL", "1800"))
+MAX_SESSIONS = 10000
+
+
+# Results of a train search kept on the server: the stations with their resolved IDs, the listed trains,
+# and the train details fetched for them so far, keyed by the index of the train in the list.
+# The revision changes with every write to the shared store, a copy with another revision is out of date.
+class SearchSession:
+    __slots__ = ("stations", "trains", "train_details", "revision")
+
+    def __init__(self, stations: dict, trains: list[Train]) -> None:
+        self.stations = stations
+        self.trains = trains
+        self.train_details = {}
+        self.revision = None
+
+    # Get the train at the given index of the list, None if there is no such train
+    def train(self, index: int) -> Train | None:
+        if 0 <= index < len(self.trains):
+            return self.trains[index]
+        return None
+
+    # Fields of the session in the shared store
+    def to_dict(self) -> dict:
+        return {
+            "stations": self.stations,
+            "trains": [train.to_dict() for train in self.trains],
+            "train_details": {str(index): details for index, details in self.train_details.items()},
+            "revision": self.revision
+        }
+
+    @classmethod
+    def from_dict(cls, fields: dict) -> "SearchSession":
+        session = cls(fields["stations"], [Train.from_dict(train) for train in fields["trains"]])
+        session.train_details = {int(index): details for index, details in fields["train_details"].items()}
+        session.revision = fields.get("revision")
+        return session
+
+
+search_sessions = TTLCache("search_sessions", SESSION_TTL, MAX_SESSIONS)
+
+
+# Store the results of a train search, returns the opaque key the pages pass instead of the results
+def create_session(stations: dict, trains: list[Train]) -> str:
+    key = secrets.token_urlsafe(16)
+    session = SearchSession(stations, trains)
+    search_sessions.set(key, session)
+    save_session(key, session)
+    return key
+
+
+# Write the session to the shared store with a new revision, so the other worker processes can use it after it was changed.
+# The revision is also stored alone, the readers compare it with their copy without loading the whole session.
+# Does nothing without a shared store, all requests are then served by one process.
+def save_session(key: str, session: SearchSession) -> None:
+    if shared_store is None:
+        return
+    session.revision = secrets.token_hex(8)
+    try:
+        shared_store.set("search_sessions", key, session.to_dict(), SESSION_TTL)
+        shared_store.set("search_session_revisions", key, session.revision, SESSION_TTL)
+    except Exception as e:
+        print(e)
+
+
+# Get the stored results of a train search, None if the key is unknown or expired.
+# A session created by another worker process, or changed there since it was read, is loaded from the shared store.
+def get_session(key: str | None, index: int | None = None) -> SearchSession | None:
+    if not key:
+        return None
+    found, session = search_sessions.get(key)
+    if shared_store is None:
+        return session if found else None
+
+    try:
+        if found and (index is None or session.train(index) is not None):
+            # The local copy is used while no other process saved the session since
+            revision_found, revision = shared_store.get("search_session_revisions", key)
+            if not revision_found or revision == session.revision:
+                return session
+        shared_found, fields = shared_store.get("search_sessions", key)
+    except Exception as e:
+        print(e)
+        shared_found = False
+    if not shared_found:
+        return session if found else None
+    session = SearchSession.from_dict(fields)
+    search_sessions.set(key, session)
+    return session
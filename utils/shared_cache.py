@@ -0,0 +1,52 @@
+from typing import Any
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+
+# Fraction of writes which also remove the expired entries
+PURGE_PROBABILITY = 0.01
+
+
+# Cache of JSON values in an SQLite file shared by all processes of the application, entries expire after their TTL.
+# Every process and thread opens its own connection, so the store can be created before the server forks its workers.
+class SharedStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    # Get a stored value, returns a tuple of (found, value)
+    def get(self, kind: str, key: str) -> tuple[bool, Any]:
+        row = self._connection().execute("SELECT value FROM cache WHERE kind = ? AND key = ? AND expires > ?", (kind, key, time.time())).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    # Store a value for the given time in seconds
+    def set(self, kind: str, key: str, value: Any, ttl: float) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO cache (kind, key, expires, value) VALUES (?, ?, ?, ?)", (kind, key, time.time() + ttl, json.dumps(value, ensure_ascii=False)))
+            if random.random() < PURGE_PROBABILITY:
+                connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+    # Remove all entries of the given kind
+    def clear(self, kind: str) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM cache WHERE kind = ?", (kind,))
+
+    # Connection of the current thread, opened again in a forked process
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (kind TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, key))")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
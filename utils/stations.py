@@ -0,0 +1,143 @@
+from typing import Callable
+import threading
+import unicodedata
+
+
+# How often (in seconds) the station index re-fetches the queries it has already covered
+STATION_INDEX_REFRESH_INTERVAL = 24 * 60 * 60
+
+# Letters that do not decompose into a base letter and a combining mark
+_EXTRA_FOLDS = str.maketrans({"ł": "l", "Ł": "l"})
+
+
+# Normalize a station name for case- and diacritic-insensitive matching
+def normalize_station_name(name: str) -> str:
+    name = unicodedata.normalize("NFKD", name.translate(_EXTRA_FOLDS))
+    return "".join(c for c in name if not unicodedata.combining(c)).lower().strip()
+
+
+# Node of the prefix tree, keeps the keys of all stations reachable below it
+class _TrieNode:
+    __slots__ = ("children", "keys")
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.keys = set()
+
+
+# In-memory index of stations built from the responses of the station search endpoint.
+# Every query sent upstream is remembered as "covered" and answered locally when repeated. Longer queries starting with it
+# are still sent upstream, the endpoint may cap its results, so a response does not prove that it lists every station matching the prefix.
+class StationIndex:
+    def __init__(self, loader: Callable[[str], list[dict]], refresh_interval: float = STATION_INDEX_REFRESH_INTERVAL) -> None:
+        self._loader = loader
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._stations = {}  # normalized name -> (name, id1, id2)
+        self._root = _TrieNode()
+        self._covered = set()
+        self._refresher = None
+        self._merged_during_refresh = None  # responses merged while a refresh runs, None when no refresh runs
+        self._generation = 0  # incremented by clear, a refresh started before it is discarded
+
+    # Check if the query was already fetched from the API
+    def covers(self, query: str) -> bool:
+        normalized = normalize_station_name(query)
+        with self._lock:
+            return normalized in self._covered
+
+    # Add stations returned by the API for the given query to the index
+    def merge(self, query: str, stations: list[dict]) -> None:
+        normalized = normalize_station_name(query)
+        with self._lock:
+            self._merge(normalized, stations)
+            if self._merged_during_refresh is not None:
+                self._merged_during_refresh.append((normalized, stations))
+        self._start_refresher()
+
+    # Find the station names matching the query, stations starting with the query go first
+    def search(self, query: str) -> list[str]:
+        normalized = normalize_station_name(query)
+        with self._lock:
+            node = self._root
+            for char in normalized:
+                node = node.children.get(char)
+                if node is None:
+                    return []
+            matches = [(key, self._stations[key][0]) for key in node.keys]
+
+        matches.sort(key=lambda match: (not match[0].startswith(normalized), match[1]))
+        return [name for _, name in matches]
+
+    # Get both station IDs for the exact station name, returns None if the station is not indexed
+    def lookup(self, station_name: str) -> tuple[str, str] | None:
+        with self._lock:
+            station = self._stations.get(normalize_station_name(station_name))
+        if station is None:
+            return None
+        return station[1], station[2]
+
+    # Forget all indexed stations and covered queries
+    def clear(self) -> None:
+        with self._lock:
+            self._stations = {}
+            self._root = _TrieNode()
+            self._covered = set()
+            self._merged_during_refresh = None
+            self._generation += 1
+
+    def _merge(self, normalized: str, stations: list[dict]) -> None:
+        for station in stations:
+            self._insert(station)
+        if normalized:
+            self._covered.add(normalized)
+
+    def _insert(self, station: dict) -> None:
+        name = station["n"]
+        key = normalize_station_name(name)
+        self._stations[key] = (name, station["h"], station["e"])
+        if "dowolna" in name.lower():
+            return
+
+        # Index every word of the name so "Główny" finds "Kraków Główny"
+        words = key.split(" ")
+        for i in range(len(words)):
+            node = self._root
+            for char in " ".join(words[i:]):
+                node = node.children.setdefault(char, _TrieNode())
+                node.keys.add(key)
+
+    # Start the background thread refreshing the index, once
+    def _start_refresher(self) -> None:
+        with self._lock:
+            if self._refresher is not None or self._refresh_interval <= 0:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="station-index-refresh", daemon=True)
+        self._refresher.start()
+
+    # Periodically re-fetch all covered queries and swap in a freshly built index.
+    # Responses merged while the refresh runs are merged into the fresh index too, so their stations are not dropped.
+    def _refresh_loop(self) -> None:
+        stop = threading.Event()
+        while not stop.wait(self._refresh_interval):
+            with self._lock:
+                queries = sorted(self._covered)
+                generation = self._generation
+                self._merged_during_refresh = []
+
+            fresh = StationIndex(self._loader, refresh_interval=0)
+            try:
+                for query in queries:
+                    fresh.merge(query, self._loader(query))
+            except Exception as e:
+                print(f"Nie udało się odświeżyć indeksu stacji: {e}")
+                with self._lock:
+                    self._merged_during_refresh = None
+                continue
+
+            with self._lock:
+                if self._generation == generation:
+                    for normalized, stations in self._merged_during_refresh:
+                        fresh._merge(normalized, stations)
+                    self._stations, self._root, self._covered = fresh._stations, fresh._root, fresh._covered
+                self._merged_during_refresh = None
@@ -0,0 +1,150 @@
+from html import unescape
+from typing import Iterator
+from .seatmap import CarriageSeats, SEAT_TYPE_CODES, intern_index
+import re
+import xml.etree.ElementTree as ET
+
+
+# Scripts and comments are stripped before the whitespace in a separate pass, one pattern with both alternatives is several times slower
+_STRIP = re.compile(r"<script\b.*?</script\s*>|<!--.*?-->", re.DOTALL)
+_WHITESPACE_BETWEEN_TAGS = re.compile(r">\s+<")
+_SEAT_START = re.compile(r"<g\b[^>]*?\bdata-class=([\"'])([^\"']*)\1[^>]*>")
+_GROUP_TAG = re.compile(r"<(/?)g\b[^>]*?(/?)>")
+_STATUS = re.compile(r"<image\b[^>]*?\bstatus=[\"']([^\"']*)[\"']")
+_NUMBER = re.compile(r"<text\b[^>]*>([^<]*)")
+_SPECIAL = re.compile(r"<[\w.-]+:special\b[^>]*?\bref=[\"']([^\"']*)[\"']")
+_STATUS_VALUE = re.compile(r"(<image\b[^>]*?\bstatus=[\"'])[^\"']*")
+_IMAGE_HREF = re.compile(r"(<image\b[^>]*?\s(?:xlink:)?href=[\"'])([^\"']*)")
+_SVG_START = re.compile(r"<svg\b")
+
+# Seat type codes of the offered seats by their special ref: regular, bike (1) and quiet zone (7)
+_SPECIAL_SEAT_TYPES = {None: SEAT_TYPE_CODES["normal_seat"], "1": SEAT_TYPE_CODES["bike_seat"], "7": SEAT_TYPE_CODES["quiet_zone_seat"]}
+
+
+# Parse the available seats from an SVG carriage seat map, return a dictionary of available seats with their types
+def parse_available_seats(carriage_seats: str) -> dict[str, str]:
+    root = ET.fromstring(carriage_seats)
+
+    namespace = {
+        "svg": "http://www.w3.org/2000/svg",
+        "eic": "http://www.intercity.pl/eic"
+    }
+
+    seats = root.findall(".//svg:g", namespace) # Find all seats
+
+    available_seats = {}
+    for seat in seats:
+        seat_class = seat.get("data-class") # Get the seat class
+        if seat_class == "" or seat_class is None:
+            continue
+        seat_number = seat.find(".//svg:text", namespace).text.strip() # Get the seat number
+        seat_status = seat.find(".//svg:image", namespace).get("status") # Get the seat status (0 - occupied, 1 - available)
+        is_special = seat.find(".//eic:special", namespace) # Check if the seat is special (bike, quiet zone)
+
+        if seat_class == "first class":
+            continue
+
+        if is_special is not None:
+            is_special = is_special.get("ref")
+
+        if seat_status == "1" and (is_special in [None, "1", "7"]):
+            available_seats[seat_number] = "normal_seat"
+            if is_special == "1":
+                available_seats[seat_number] = "bike_seat"
+            if is_special == "7":
+                available_seats[seat_number] = "quiet_zone_seat"
+
+    return available_seats
+
+
+# Find the seat groups of a cleaned seat map, yields the start and end of each group, its seat class and its body.
+# The end of a group is found by counting the nested groups, so seat groups wrapping their image or text in a group are found whole.
+def _seat_groups(cleaned: str) -> Iterator[tuple[int, int, str, str]]:
+    for start in _SEAT_START.finditer(cleaned):
+        # Groups with an empty class are not seats, e.g. the legend
+        if not start.group(2) or start.group(0).endswith("/>"):
+            continue
+        depth = 1
+        for tag in _GROUP_TAG.finditer(cleaned, start.end()):
+            if tag.group(2):
+                continue
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                yield start.start(), tag.end(), start.group(2), cleaned[start.end():tag.start()]
+                break
+
+
+# Parse an SVG carriage seat map without building an element tree, returns a compact SVG and the available seats of the carriage.
+# Scripts, comments and whitespace between tags are stripped first, then the seat groups are scanned in the stripped text.
+# Gives the same seats as parse_available_seats, the index lists every seat of the layout with its type.
+def parse_seat_map(svg_text: str) -> tuple[str, CarriageSeats]:
+    cleaned = _WHITESPACE_BETWEEN_TAGS.sub("><", _STRIP.sub("", svg_text))
+
+    numbers = []
+    types = bytearray()
+    available = 0
+    for _, _, seat_class, body in _seat_groups(cleaned):
+        seat_number = _NUMBER.search(body)
+        if seat_number is None:
+            continue
+        seat_number = seat_number.group(1).strip()
+        if "&" in seat_number:
+            seat_number = unescape(seat_number)
+
+        is_special = _SPECIAL.search(body)
+        if is_special is not None:
+            is_special = is_special.group(1)
+
+        seat_type = 0
+        if seat_class != "first class":
+            seat_type = _SPECIAL_SEAT_TYPES.get(is_special, 0)
+
+        seat_status = _STATUS.search(body)
+        if seat_type and seat_status is not None and seat_status.group(1) == "1":
+            available |= 1 << len(numbers)
+        numbers.append(seat_number)
+        types.append(seat_type)
+
+    return cleaned, CarriageSeats(intern_index(tuple(numbers), bytes(types)), available)
+
+
+# Build the layout template of a cleaned seat map, the geometry shared by all seat maps of the carriage layout.
+# Every seat group gets its seat number in a data-seat attribute and its seat image is reset to an occupied seat: status "0" and
+# the image of the occupied seats. The images of the free and occupied seats are kept in data-seat-free and data-seat-taken
+# attributes of the svg element, the client marks the available seats on the template with them.
+# A seat group nested in another one is marked with the outer group. Returns the template and whether both seat images are known,
+# a seat map with only free or only occupied seats does not show the image of the other ones.
+def build_layout_template(cleaned: str) -> tuple[str, bool]:
+    seats = []
+    images = {}
+    last = 0
+    for start, end, _, body in _seat_groups(cleaned):
+        if start < last:
+            continue
+        seat_number = _NUMBER.search(body)
+        if seat_number is None:
+            continue
+        seats.append((start, end, seat_number.group(1).strip()))
+        last = end
+
+        seat_status = _STATUS.search(body)
+        image = _IMAGE_HREF.search(body)
+        if seat_status is not None and image is not None:
+            images.setdefault("1" if seat_status.group(1) == "1" else "0", image.group(2))
+
+    taken_image = images.get("0")
+    parts = []
+    last = 0
+    for start, end, seat_number in seats:
+        seat = _STATUS_VALUE.sub(r"\g<1>0", cleaned[start + 2:end])
+        if taken_image is not None:
+            seat = _IMAGE_HREF.sub(lambda image: image.group(1) + taken_image, seat)
+        parts.append(cleaned[last:start])
+        parts.append(f'<g data-seat="{seat_number}"' + seat)
+        last = end
+    parts.append(cleaned[last:])
+    template = "".join(parts)
+
+    attributes = "".join(f' data-seat-{name}="{images[status]}"' for status, name in (("1", "free"), ("0", "taken")) if status in images)
+    template = _SVG_START.sub(lambda svg: svg.group(0) + attributes, template, count=1)
+    return template, len(images) == 2
@@ -0,0 +1,171 @@
+from .models import Stop
+from .stations import normalize_station_name
+from datetime import datetime, timedelta
+import heapq
+import os
+import threading
+import time
+
+
+# Minimum time (in minutes) to change trains at a station
+MIN_TRANSFER_MINUTES = int(os.environ.get("TRICKYTRAIN_MIN_TRANSFER", "5"))
+
+# Stations where journeys with a change of trains are searched for, besides the stations already known from routes
+TRANSFER_HUBS = [hub.strip() for hub in os.environ.get("TRICKYTRAIN_TRANSFER_HUBS", "Warszawa Centralna,Kraków Główny,Poznań Główny,Wrocław Główny,Gdańsk Główny,Katowice,Łódź Fabryczna,Kutno").split(",") if hub.strip()]
+
+# Time (in seconds) for which a connection search between two stations on a date is not repeated, its trains stay in the index
+SEARCH_TTL = float(os.environ.get("TRICKYTRAIN_TIMETABLE_TTL", "900"))
+
+# Number of journeys returned by the search and the maximum number of train changes in a journey
+MAX_JOURNEYS = 3
+MAX_TRANSFERS = 2
+
+
+# Ride of a train between two consecutive known stops, the elementary connection of the timetable
+class Connection:
+    __slots__ = ("departure", "arrival", "from_station", "to_station", "trip")
+
+    def __init__(self, departure: datetime, arrival: datetime, from_station: str, to_station: str, trip: tuple) -> None:
+        self.departure = departure
+        self.arrival = arrival
+        self.from_station = from_station
+        self.to_station = to_station
+        self.trip = trip  # (train category, train number, train name, date of the search)
+
+
+# Timetable of the connections seen in connection searches and train routes, grouped by the date of the search.
+# Stations are identified by their normalized names, the trips by the train and the date.
+class TimetableIndex:
+    def __init__(self) -> None:
+        self._names = {}  # normalized station name -> station name
+        self._days = {}  # date -> {(trip, from station, to station): connection}
+        self._sorted = {}  # date -> connections sorted by departure
+        self._searched = {}  # (from station id, to station id, date) -> time of the search
+        self._lock = threading.Lock()
+
+    # Add the ride of a train between two stations
+    def add(self, date: str, trip: tuple, from_station: str, to_station: str, departure: datetime | None, arrival: datetime | None) -> None:
+        if not departure or not arrival or from_station == to_station:
+            return
+        from_key, to_key = normalize_station_name(from_station), normalize_station_name(to_station)
+        connection = Connection(departure, arrival, from_key, to_key, trip)
+        with self._lock:
+            self._names.setdefault(from_key, from_station)
+            self._names.setdefault(to_key, to_station)
+            self._days.setdefault(date, {})[(trip, from_key, to_key)] = connection
+            self._sorted.pop(date, None)
+
+    # Add the rides between the consecutive stops of a train route
+    def add_route(self, date: str, trip: tuple, stops: list[Stop]) -> None:
+        for start, end in zip(stops, stops[1:]):
+            self.add(date, trip, start.station_name, end.station_name, start.departure, end.arrival)
+
+    # Name of a station by its normalized name
+    def name(self, key: str) -> str:
+        with self._lock:
+            return self._names.get(key, key)
+
+    # Check whether the connections between two stations on a date were searched recently, and mark them as searched
+    def claim_search(self, from_station_id: str, to_station_id: str, date: str) -> bool:
+        key = (from_station_id, to_station_id, date)
+        now = time.time()
+        with self._lock:
+            if now - self._searched.get(key, 0) < SEARCH_TTL:
+                return False
+            self._searched[key] = now
+            return True
+
+    # Mark a failed search as not done, so the next journey search repeats it
+    def release_search(self, from_station_id: str, to_station_id: str, date: str) -> None:
+        with self._lock:
+            self._searched.pop((from_station_id, to_station_id, date), None)
+
+    # Connections of the dates sorted by departure, journeys late in the evening continue with the connections of the next date
+    def connections(self, *dates: str) -> list[Connection]:
+        with self._lock:
+            days = []
+            for date in dates:
+                connections = self._sorted.get(date)
+                if connections is None:
+                    connections = self._sorted[date] = sorted(self._days.get(date, {}).values(), key=connection_order)
+                days.append(connections)
+        return days[0] if len(days) == 1 else list(heapq.merge(*days, key=connection_order))
+
+    # Forget the days before the given date
+    def expire(self, today: str) -> None:
+        with self._lock:
+            for date in [date for date in self._days if date < today]:
+                del self._days[date]
+                self._sorted.pop(date, None)
+            self._searched = {key: searched for key, searched in self._searched.items() if key[2] >= today}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._names.clear()
+            self._days.clear()
+            self._sorted.clear()
+            self._searched.clear()
+
+
+def connection_order(connection: Connection) -> tuple[datetime, datetime]:
+    return connection.departure, connection.arrival
+
+
+# Earliest arrival journey from a station departing not before the given time, by the Connection Scan Algorithm.
+# Changing trains needs the minimum transfer time, staying on the same trip does not. Returns the legs of the journey
+# on one trip each, given by their first and last connection, or None if the arrival station cannot be reached.
+def scan(connections: list[Connection], departure_station: str, arrival_station: str, departure: datetime, min_transfer: timedelta, max_transfers: int = MAX_TRANSFERS) -> list[tuple[Connection, Connection]] | None:
+    arrival = {departure_station: departure}  # station -> earliest arrival
+    transfers = {departure_station: -1}  # station -> number of legs of the journey reaching it, minus one
+    boarded = {}  # trip -> (connection where the trip was boarded, legs before it)
+    reached_by = {}  # station -> (boarding connection, last connection)
+
+    for connection in connections:
+        if connection.departure < departure:
+            continue
+        if arrival_station in arrival and connection.departure >= arrival[arrival_station]:
+            break
+
+        if connection.trip not in boarded:
+            reached = arrival.get(connection.from_station)
+            if reached is None:
+                continue
+            ready = reached if connection.from_station == departure_station else reached + min_transfer
+            if ready > connection.departure or transfers[connection.from_station] + 1 > max_transfers:
+                continue
+            boarded[connection.trip] = (connection, transfers[connection.from_station] + 1)
+
+        boarding, legs = boarded[connection.trip]
+        if connection.arrival < arrival.get(connection.to_station, datetime.max):
+            arrival[connection.to_station] = connection.arrival
+            transfers[connection.to_station] = legs
+            reached_by[connection.to_station] = (boarding, connection)
+
+    if arrival_station not in reached_by:
+        return None
+
+    # Walk back from the arrival station leg by leg
+    journey = []
+    station = arrival_station
+    while station != departure_station:
+        boarding, last = reached_by[station]
+        journey.append((boarding, last))
+        station = boarding.from_station
+    journey.reverse()
+    return journey
+
+
+# Journeys with the earliest arrival, each departing later than the previous one, as lists of legs given by their first and last connection
+def find_journeys(connections: list[Connection], departure_station: str, arrival_station: str, departure: datetime, count: int = MAX_JOURNEYS, min_transfer_minutes: int = MIN_TRANSFER_MINUTES) -> list[list[tuple[Connection, Connection]]]:
+    departure_station, arrival_station = normalize_station_name(departure_station), normalize_station_name(arrival_station)
+    journeys = []
+    while len(journeys) < count:
+        journey = scan(connections, departure_station, arrival_station, departure, timedelta(minutes=min_transfer_minutes))
+        if journey is None:
+            break
+        journeys.append(journey)
+        departure = journey[0][0].departure + timedelta(minutes=1)
+    return journeys
+
+
+timetable = TimetableIndex()
@@ -0,0 +1,140 @@
+from .seatmap import CarriageSeats, count_seats, intersect_segments
+import os
+import time
+
+
+# Upper bounds of the upstream calls and of the time (in seconds) spent by one seat transfer search
+TRANSFER_MAX_CALLS = int(os.environ.get("TRICKYTRAIN_TRANSFER_MAX_CALLS", "300"))
+TRANSFER_MAX_SECONDS = float(os.environ.get("TRICKYTRAIN_TRANSFER_MAX_SECONDS", "120"))
+
+
+# Number of consecutive segments from the first one on which some seat stays free, intersecting the seat bitmaps segment by segment
+def longest_run(segments: list[dict[str, CarriageSeats] | None], first: int) -> int:
+    longest = 0
+    for carriage_number, seats in segments[first].items():
+        last = first
+        while seats.available and last + 1 < len(segments):
+            following = segments[last + 1]
+            other = following.get(carriage_number) if following is not None else None
+            common = seats & other if other is not None else None
+            if common is None or not common.available:
+                break
+            seats = common
+            last += 1
+        if seats.available:
+            longest = max(longest, last - first + 1)
+
+    return longest
+
+
+# Plan the seat changes over the segment x seat availability matrix with the fewest changes.
+# Each leg keeps the seat that stays free the longest from its first segment; for covering a line with runs this greedy choice is optimal.
+# Returns a list of (first segment, last segment + 1) legs or None if some segment has no free seat.
+def plan_fewest_seat_changes(segments: list[dict[str, CarriageSeats] | None]) -> list[tuple[int, int]] | None:
+    legs = []
+    current = 0
+    while current < len(segments):
+        reach = longest_run(segments, current) if segments[current] is not None else 0
+        if reach == 0:
+            return None
+        legs.append((current, current + reach))
+        current += reach
+
+    return legs
+
+
+# Results of the probes made during one transfer search keyed by span of the route (first station, last station).
+# A result is the tuple (carriage SVG seat maps, available seats, seat count), or None if the train does not run on the span.
+# Results of unprobed spans are implied where possible: a seat free on a span is free on every span inside it,
+# and a span containing a span without free seats has no free seats either.
+class ProbeMemo:
+    def __init__(self, known: dict[tuple[int, int], tuple | None] | None = None) -> None:
+        self._results = dict(known or {})
+
+    def __contains__(self, span: tuple[int, int]) -> bool:
+        return span in self._results
+
+    def get(self, span: tuple[int, int]) -> tuple | None:
+        return self._results.get(span)
+
+    def add(self, span: tuple[int, int], result: tuple | None) -> None:
+        self._results[span] = result
+
+    # Whether the span has free seats as implied by the probed spans, None if unknown
+    def implied(self, span: tuple[int, int]) -> bool | None:
+        first, last = span
+        for (known_first, known_last), result in self._results.items():
+            if result is None:
+                continue
+            if result[2] > 0 and known_first <= first and last <= known_last:
+                return True
+            if result[2] == 0 and first <= known_first and known_last <= last:
+                return False
+        return None
+
+
+# Count the upstream calls the binary search of get_seat_transfers makes over the same segments, with the same memo of probed and implied spans.
+# The seats of a span are the seats free on all of its segments. Probing a span costs the train details and the seat maps of its carriages,
+# or only the train details when the train does not run on one of its segments. Spans in known were checked before the search and cost nothing.
+def count_binary_search_calls(segments: list[dict[str, CarriageSeats] | None], known: list[tuple[int, int]]) -> int:
+    def result(span: tuple[int, int]) -> tuple | None:
+        span_segments = segments[span[0]:span[1]]
+        if any(segment is None for segment in span_segments):
+            return None
+        seats = intersect_segments(span_segments)
+        return None, seats, count_seats(seats)
+
+    memo = ProbeMemo({span: result(span) for span in known})
+    calls = 0
+
+    def probe(span: tuple[int, int]) -> None:
+        nonlocal calls
+        memo.add(span, result(span))
+        calls += 1 if memo.get(span) is None else 1 + len(segments[span[0]])
+
+    current = 0
+    while current != len(segments):
+        left, right = current + 1, len(segments)
+        best_next = None
+        while left <= right:
+            mid = (left + right) // 2
+            span = (current, mid)
+            if span not in memo and memo.implied(span) is None:
+                probe(span)
+            has_seats = memo.implied(span) if span not in memo else memo.get(span) is not None and memo.get(span)[2] > 0
+            if has_seats:
+                best_next = mid
+                left = mid + 1
+            else:
+                right = mid - 1
+
+        if best_next is None:
+            break
+
+        # The search fetches the seat maps of a span it only knows by implication
+        span = (current, best_next)
+        if span not in memo:
+            probe(span)
+        if memo.get(span) is None or memo.get(span)[2] == 0:
+            break
+        current = best_next
+
+    return calls
+
+
+# Budget of upstream calls and wall time of one transfer search, started when created
+class SearchBudget:
+    def __init__(self, max_calls: int = TRANSFER_MAX_CALLS, max_seconds: float = TRANSFER_MAX_SECONDS) -> None:
+        self.max_calls = max_calls
+        self.max_seconds = max_seconds
+        self.calls = 0
+        self.started = time.monotonic()
+
+    def charge(self, calls: int) -> None:
+        self.calls += calls
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def exhausted(self) -> bool:
+        return self.calls >= self.max_calls or self.elapsed() >= self.max_seconds
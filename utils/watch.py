@@ -0,0 +1,422 @@
+from utils import fetch_train_details
+from utils.client import run_async
+from utils.data_precessor import extract_carriage_type, fetch_and_parse_seat_map, get_intercity_link
+from utils.limiter import PRIORITY_BACKGROUND, current_priority, current_user
+from utils.models import SeatMap, Train
+from utils.seatmap import SEAT_TYPE_CODES, SEAT_TYPES, CarriageSeats
+from urllib.parse import urlsplit
+import asyncio
+import ipaddress
+import os
+import queue
+import random
+import requests
+import secrets
+import socket
+import threading
+import time
+
+
+# Mean time (in seconds) between two polls of a watched train, and the fraction by which each interval is randomly stretched or shortened
+WATCH_INTERVAL = float(os.environ.get("TRICKYTRAIN_WATCH_INTERVAL", "120"))
+WATCH_JITTER = 0.2
+
+# Upstream calls per minute which the polls of all watched trains may use together
+WATCH_BUDGET = float(os.environ.get("TRICKYTRAIN_WATCH_BUDGET", "60"))
+
+# Maximum number of watches, of watches of one client, and carriage seat maps fetched concurrently in a poll
+MAX_WATCHES = 1000
+MAX_CLIENT_WATCHES = int(os.environ.get("TRICKYTRAIN_WATCH_CLIENT_LIMIT", "10"))
+WATCH_WORKERS = 2
+
+# Hosts to which webhooks may be sent, without them only hosts resolving to public addresses are accepted.
+# Timeout of webhook calls in seconds, and events waiting to be sent, newer events are dropped when the queue is full.
+WEBHOOK_HOSTS = {host.strip().lower() for host in os.environ.get("TRICKYTRAIN_WEBHOOK_HOSTS", "").split(",") if host.strip()}
+WEBHOOK_TIMEOUT = 5
+WEBHOOK_QUEUE_SIZE = 1000
+
+# Events kept for an SSE subscriber which does not read them, older events are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+# Token bucket of upstream calls shared by all polls, refilled continuously up to the calls of one minute.
+# A poll starts when the bucket is not empty and is charged with the calls it made, so a large poll delays the next ones.
+class CallBudget:
+    def __init__(self, calls_per_minute: float) -> None:
+        self.rate = calls_per_minute / 60
+        self.capacity = max(1.0, calls_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Seconds until the next poll can start, 0 if it can start now
+    def wait(self) -> float:
+        with self._lock:
+            self._refill()
+            if self.tokens > 0:
+                return 0.0
+            return (1 - self.tokens) / self.rate if self.rate > 0 else WATCH_INTERVAL
+
+    # Take the calls made by a poll
+    def charge(self, calls: int) -> None:
+        with self._lock:
+            self._refill()
+            self.tokens -= calls
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+# Registration of a user watching the seats of a train: the seat types of interest and where the changes are sent
+class Watch:
+    __slots__ = ("id", "target", "seat_types", "webhook", "client", "subscribers", "seats")
+
+    def __init__(self, target: "WatchTarget", seat_types: set[str] | None, webhook: str | None, client: str) -> None:
+        self.id = secrets.token_urlsafe(12)
+        self.target = target
+        self.seat_types = seat_types
+        self.webhook = webhook
+        self.client = client
+        self.subscribers = []
+        self.seats = None  # carriage number -> {seat number: seat type} at the last poll
+
+    # Available seats of the watched types
+    def filter(self, carriages: dict[str, CarriageSeats]) -> dict[str, dict[str, str]]:
+        result = {}
+        for carriage_number, seats in carriages.items():
+            seats = {number: seat_type for number, seat_type in seats.to_dict().items() if self.seat_types is None or seat_type in self.seat_types}
+            if seats:
+                result[carriage_number] = seats
+        return result
+
+    # Compare the seats with the last poll, returns the "seats" event or None if nothing changed
+    def diff(self, seats: dict[str, dict[str, str]]) -> dict | None:
+        previous = self.seats
+        self.seats = seats
+
+        added, removed = {}, {}
+        for carriage_number in set(seats) | set(previous or {}):
+            now, before = seats.get(carriage_number, {}), (previous or {}).get(carriage_number, {})
+            if now.keys() - before.keys():
+                added[carriage_number] = {number: now[number] for number in now.keys() - before.keys()}
+            if before.keys() - now.keys():
+                removed[carriage_number] = sorted(before.keys() - now.keys())
+
+        if previous is not None and not added and not removed:
+            return None
+        return {
+            "type": "seats",
+            "watch": self.id,
+            "initial": previous is None,
+            "seat_count": sum(len(carriage) for carriage in seats.values()),
+            "added": added,
+            "removed": removed,
+            "link": self.target.link
+        }
+
+
+# Train watched by one or more users, polled once for all of them.
+# The first poll fetches every carriage, later polls only the carriages with seats of the watched types in their layout.
+class WatchTarget:
+    __slots__ = ("key", "train", "stations", "link", "departure", "carriages_types", "relevant", "carriages", "watches", "next_poll")
+
+    def __init__(self, key: tuple, train: Train, stations: dict) -> None:
+        self.key = key
+        self.train = train
+        self.stations = stations
+        self.link = get_intercity_link(train.departure_date, stations.get("departure_station_id1"), stations.get("arrival_station_id1"), train.departure_time)
+        self.departure = train.departure.timestamp()
+        self.carriages_types = None  # carriage number -> carriage type, fetched until the composition is known
+        self.relevant = {}  # carriage number -> seat type codes offered in its layout
+        self.carriages = {}  # carriage number -> available seats at the last poll
+        self.watches = {}
+        self.next_poll = time.time()
+
+    # Carriages whose seats can change the outcome for some of the watches, carriages with a layout not seen yet are always fetched
+    def carriages_to_fetch(self) -> list[str]:
+        codes = set()
+        for watch in self.watches.values():
+            codes |= set(SEAT_TYPE_CODES.values()) if watch.seat_types is None else {SEAT_TYPE_CODES[seat_type] for seat_type in watch.seat_types}
+        return [carriage_number for carriage_number in self.carriages_types if carriage_number not in self.relevant or self.relevant[carriage_number] & codes]
+
+    # Fetch the seats of the carriages which can change the outcome, the other carriages keep their seats from the last poll.
+    # Returns the number of upstream calls made.
+    def poll(self) -> int:
+        train_category, train_number = self.train.train_category, self.train.train_number
+        departure_datetime, arrival_datetime = self.train.departure_compact, self.train.arrival_compact
+        departure_station_id2 = self.stations.get("departure_station_id2")
+        arrival_station_id2 = self.stations.get("arrival_station_id2")
+
+        calls = 0
+        if self.carriages_types is None:
+            calls += 1
+            train_info = fetch_train_details(train_category, train_number, departure_datetime, departure_station_id2, arrival_datetime, arrival_station_id2)
+            # The composition may not be published yet, it is fetched again on the next poll
+            if train_info.get("statusCode") == 404:
+                return calls
+            self.carriages_types = extract_carriage_type(train_info)
+
+        async def fetch_all() -> list:
+            semaphore = asyncio.Semaphore(WATCH_WORKERS)
+
+            async def fetch(carriage_number: str) -> SeatMap:
+                async with semaphore:
+                    return await fetch_and_parse_seat_map(carriage_number, self.carriages_types[carriage_number], train_category, train_number, departure_datetime, arrival_datetime, departure_station_id2, arrival_station_id2)
+
+            return await asyncio.gather(*(fetch(carriage_number) for carriage_number in carriages), return_exceptions=True)
+
+        carriages = self.carriages_to_fetch()
+        for result in run_async(fetch_all()):
+            # A failed carriage keeps its seats from the last poll
+            if isinstance(result, BaseException):
+                print(result)
+                continue
+            self.carriages[result.carriage_number] = result.seats
+            # A seat map without seats tells nothing about the layout, the carriage is fetched again
+            if result.seats.index.numbers:
+                self.relevant[result.carriage_number] = set(result.seats.index.types) - {0}
+
+        return calls + len(carriages)
+
+
+# Scheduler polling the watched trains in one background thread, with jittered intervals and a shared budget of upstream calls.
+# Changes of the available seats are pushed to the webhook of each watch and to its SSE subscribers.
+class WatchScheduler:
+    def __init__(self, interval: float = WATCH_INTERVAL, budget: float = WATCH_BUDGET, max_watches: int = MAX_WATCHES, max_client_watches: int = MAX_CLIENT_WATCHES) -> None:
+        self.interval = interval
+        self.budget = CallBudget(budget)
+        self.max_watches = max_watches
+        self.max_client_watches = max_client_watches
+        self.targets = {}
+        self.watches = {}
+        self.clients = {}  # client -> number of its watches
+        self.webhooks = WebhookSender()
+        self.polls = 0
+        self.requests = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    # Start watching the direct seats of a train between the stations of a search for a client, returns the watch
+    def add(self, train: Train, stations: dict, seat_types: set[str] | None = None, webhook: str | None = None, client: str = "") -> Watch:
+        key = (train.train_category, train.train_number, train.departure_datetime, stations.get("departure_station_id2"), stations.get("arrival_station_id2"))
+        if webhook is not None:
+            check_webhook(webhook)
+        with self._condition:
+            if len(self.watches) >= self.max_watches:
+                raise ValueError("Osiągnięto limit obserwowanych pociągów, spróbuj ponownie później")
+            if self.clients.get(client, 0) >= self.max_client_watches:
+                raise ValueError(f"Osiągnięto limit obserwacji ({self.max_client_watches}), usuń jedną z nich")
+            target = self.targets.get(key)
+            if target is None:
+                target = self.targets[key] = WatchTarget(key, train, stations)
+            watch = Watch(target, seat_types, webhook, client)
+            target.watches[watch.id] = watch
+            self.watches[watch.id] = watch
+            self.clients[client] = self.clients.get(client, 0) + 1
+
+            # A new watch of an already polled train gets the current seats on the next poll
+            target.next_poll = min(target.next_poll, time.time())
+            self._condition.notify()
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="seat-watch", daemon=True)
+                self._thread.start()
+        return watch
+
+    # Stop a watch, returns False if it does not exist
+    def remove(self, watch_id: str) -> bool:
+        with self._condition:
+            watch = self.watches.pop(watch_id, None)
+            if watch is None:
+                return False
+            self._release(watch)
+            watch.target.watches.pop(watch_id, None)
+            if not watch.target.watches:
+                self.targets.pop(watch.target.key, None)
+        self._publish(watch, {"type": "closed", "watch": watch_id})
+        return True
+
+    def get(self, watch_id: str) -> Watch | None:
+        with self._condition:
+            return self.watches.get(watch_id)
+
+    # Subscribe to the events of a watch, returns the queue receiving them, or None if the watch does not exist
+    def subscribe(self, watch_id: str) -> queue.Queue | None:
+        with self._condition:
+            watch = self.watches.get(watch_id)
+            if watch is None:
+                return None
+            subscriber = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+            watch.subscribers.append(subscriber)
+
+            # A late subscriber starts from the seats of the last poll
+            if watch.seats is not None:
+                subscriber.put({"type": "seats", "watch": watch.id, "initial": True, "seat_count": sum(len(carriage) for carriage in watch.seats.values()), "added": watch.seats, "removed": {}, "link": watch.target.link})
+            return subscriber
+
+    def unsubscribe(self, watch_id: str, subscriber: queue.Queue) -> None:
+        with self._condition:
+            watch = self.watches.get(watch_id)
+            if watch is not None and subscriber in watch.subscribers:
+                watch.subscribers.remove(subscriber)
+
+    # Number of watches and watched trains, polls and the requests they made, seat maps still cached from recent searches included,
+    # and the webhook events sent, failed and dropped
+    def stats(self) -> dict:
+        with self._condition:
+            return {"watches": len(self.watches), "trains": len(self.targets), "polls": self.polls, "requests": self.requests, "webhooks": self.webhooks.stats()}
+
+    # Poll the watched trains as they become due, until there is nothing to watch
+    def _run(self) -> None:
+        current_user.set("watch")
+        current_priority.set(PRIORITY_BACKGROUND)
+
+        while True:
+            with self._condition:
+                self._expire()
+                if not self.targets:
+                    self._thread = None
+                    return
+                target = min(self.targets.values(), key=lambda target: target.next_poll)
+                delay = target.next_poll - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                wait = self.budget.wait()
+                if wait > 0:
+                    target.next_poll = time.time() + wait
+                    continue
+                target.next_poll = time.time() + self.interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+            try:
+                calls = target.poll()
+            except Exception as e:
+                print(e)
+                continue
+            self.budget.charge(calls)
+
+            with self._condition:
+                self.polls += 1
+                self.requests += calls
+                watches = list(target.watches.values())
+            for watch in watches:
+                event = watch.diff(watch.filter(target.carriages))
+                if event is not None:
+                    self._publish(watch, event)
+
+    # Remove the watches of trains which have already departed
+    def _expire(self) -> None:
+        now = time.time()
+        for key, target in list(self.targets.items()):
+            if target.departure <= now:
+                del self.targets[key]
+                for watch_id, watch in target.watches.items():
+                    if self.watches.pop(watch_id, None) is not None:
+                        self._release(watch)
+                    self._publish(watch, {"type": "closed", "watch": watch_id})
+
+    # Send an event to the webhook and the subscribers of a watch
+    def _publish(self, watch: Watch, event: dict) -> None:
+        for subscriber in list(watch.subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass
+
+        if watch.webhook:
+            self.webhooks.submit(watch.webhook, event)
+
+    # Count the watch off the limit of its client
+    def _release(self, watch: Watch) -> None:
+        count = self.clients.get(watch.client, 0) - 1
+        if count > 0:
+            self.clients[watch.client] = count
+        else:
+            self.clients.pop(watch.client, None)
+
+
+# Sender of the webhook events of all watches: one background thread posts the queued events in order, with a timeout.
+# A slow or unreachable webhook delays the others at most by the timeout, events over the size of the queue are dropped.
+class WebhookSender:
+    def __init__(self, queue_size: int = WEBHOOK_QUEUE_SIZE) -> None:
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # Queue an event for the webhook
+    def submit(self, url: str, event: dict) -> None:
+        try:
+            self._queue.put_nowait((url, event))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="webhook-sender", daemon=True)
+                self._thread.start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sent": self.sent, "failed": self.failed, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+    def _run(self) -> None:
+        session = requests.Session()
+        while True:
+            url, event = self._queue.get()
+            try:
+                send_webhook(session, url, event)
+            except (requests.RequestException, ValueError) as e:
+                print(e)
+                with self._lock:
+                    self.failed += 1
+            else:
+                with self._lock:
+                    self.sent += 1
+
+
+# Post an event of a watch to its webhook. The host is checked again before every call, its address may have changed since
+# the watch was registered, and redirects are not followed, so the events cannot be sent to an address which is not allowed.
+def send_webhook(session: requests.Session, url: str, event: dict) -> None:
+    check_webhook(url)
+    session.post(url, json=event, timeout=WEBHOOK_TIMEOUT, allow_redirects=False).raise_for_status()
+
+
+# Check that a webhook can be called: an http(s) URL of an allowed host, or without allowed hosts one with only public addresses.
+# Raises ValueError otherwise, so webhooks cannot reach the server itself or services of its private network.
+def check_webhook(url: str) -> None:
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("Adres webhooka musi zaczynać się od http:// lub https://")
+    host = parts.hostname.lower()
+    if WEBHOOK_HOSTS:
+        if host not in WEBHOOK_HOSTS:
+            raise ValueError(f"Webhooki można wysyłać tylko do: {', '.join(sorted(WEBHOOK_HOSTS))}")
+        return
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or (443 if parts.scheme == "https" else 80), proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"Nie znaleziono adresu webhooka {host}")
+    if not all(ipaddress.ip_address(address.split("%")[0]).is_global for address in addresses):
+        raise ValueError("Webhook musi mieć publiczny adres")
+
+
+# Parse the seat types of a watch, None watches all seat types
+def parse_seat_types(value: str | None) -> set[str] | None:
+    if not value:
+        return None
+    seat_types = {seat_type.strip() for seat_type in value.split(",") if seat_type.strip()}
+    unknown = seat_types - set(SEAT_TYPES[1:])
+    if unknown:
+        raise ValueError(f"Nieznany rodzaj miejsca: {', '.join(sorted(unknown))}")
+    return seat_types or None
+
+
+watch_scheduler = WatchScheduler()